@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ChessConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chess'
+
+    def ready(self):
+        # Counts the queries of every connection, see chess.instrumentation
+        from . import instrumentation
@@ -0,0 +1,194 @@
+"""
+Server-side chess clocks. Times are time.monotonic() seconds, remaining times
+are milliseconds.
+"""
+
+import asyncio
+import heapq
+import itertools
+import re
+import time
+from .engine import WHITE, COLOR_NAMES
+
+
+# "<minutes>+<increment seconds>", minutes may have up to three decimals
+TIME_CONTROL_PATTERN = re.compile(r"(\d{1,3}(?:\.\d{1,3})?)\+(\d{1,3})")
+MAX_MINUTES = 180
+MAX_INCREMENT = 180
+
+
+def parse_time_control(value):
+    """
+    Parses "<minutes>+<increment seconds>", e.g. "3+2", into (initial ms, increment ms).
+    Returns None for untimed games, written as "".
+    """
+    if not value:
+        return None
+    match = TIME_CONTROL_PATTERN.fullmatch(value) if isinstance(value, str) else None
+    if match is None:
+        raise ValueError(f"Invalid time control: {value!r}")
+    minutes, increment = float(match[1]), int(match[2])
+    if not 0 < minutes <= MAX_MINUTES or increment > MAX_INCREMENT:
+        raise ValueError(f"Invalid time control: {value!r}")
+    return round(minutes * 60000), increment * 1000
+
+
+def normalize_time_control(value):
+    """
+    Returns the canonical spelling of a time control, e.g. "3+2" for "03.0+2", so
+    that equal time controls share matchmaking queues and rating categories.
+    Raises ValueError like parse_time_control().
+    """
+    parsed = parse_time_control(value)
+    if parsed is None:
+        return ""
+    initial_ms, increment_ms = parsed
+    return f"{initial_ms / 60000:g}+{increment_ms // 1000}"
+
+
+class GameClock:
+    """
+    Remaining time of both players. The clock of the side to move runs from the
+    moment the previous move was made, starting with the first move of the game.
+    """
+
+    def __init__(self, initial_ms, increment_ms, remaining=None, turn=WHITE, running_since=None):
+        self.increment_ms = increment_ms
+        self.remaining = list(remaining or (initial_ms, initial_ms))
+        self.turn = turn
+        self.running_since = running_since
+
+    @classmethod
+    def from_time_control(cls, time_control, **kwargs):
+        parsed = parse_time_control(time_control)
+        return None if parsed is None else cls(*parsed, **kwargs)
+
+    def time_left(self, color, now):
+        left = self.remaining[color]
+        if color == self.turn and self.running_since is not None:
+            left -= (now - self.running_since) * 1000
+        return max(0, int(left))
+
+    def deadline(self):
+        if self.running_since is None:
+            return None
+        return self.running_since + self.remaining[self.turn] / 1000
+
+    def is_flagged(self, now):
+        return self.running_since is not None and self.time_left(self.turn, now) <= 0
+
+    def press(self, now):
+        """
+        Ends the turn of the side to move and starts the opponent's clock.
+        Returns the time the mover has left, increment included.
+        """
+        mover = self.turn
+        left = self.time_left(mover, now)
+        if self.running_since is not None:
+            left += self.increment_ms
+        self.remaining[mover] = left
+        self.turn = mover ^ 1
+        self.running_since = now
+        return left
+
+    def sync(self, times, now):
+        """
+        Applies the times announced with a move made in another process.
+        """
+        self.remaining = [times[name] for name in COLOR_NAMES]
+        self.turn ^= 1
+        self.running_since = now
+
+    def as_dict(self, now):
+        return {name: self.time_left(color, now) for color, name in enumerate(COLOR_NAMES)}
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "args", "active")
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.active = True
+
+
+class TimerScheduler:
+    """
+    Calls functions at monotonic deadlines. Pending timers are kept in a heap and
+    only the earliest deadline is registered with the event loop, so a process can
+    hold timers of any number of games without a task or periodic tick per game.
+    Cancelled timers are dropped lazily, the heap is compacted when they pile up.
+    """
+
+    def __init__(self):
+        # (deadline, insertion order, timer)
+        self.heap = []
+        self.cancelled = 0
+        self.counter = itertools.count()
+        self.loop = None
+        self.handle = None
+        self.handle_deadline = None
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    def schedule(self, deadline, callback, *args):
+        """
+        Calls callback(*args) from the running event loop once time.monotonic() reaches deadline.
+        """
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            # Timers of a previous event loop can never fire, e.g. between tests
+            self.heap = []
+            self.cancelled = 0
+            self.loop = loop
+            self.handle = None
+        timer = Timer(deadline, callback, args)
+        heapq.heappush(self.heap, (deadline, next(self.counter), timer))
+        if self.handle is None or deadline < self.handle_deadline:
+            self.arm()
+        return timer
+
+    def cancel(self, timer):
+        if timer is None or not timer.active:
+            return
+        timer.active = False
+        self.cancelled += 1
+        if self.cancelled > 64 and self.cancelled > len(self.heap) // 2:
+            self.heap = [entry for entry in self.heap if entry[2].active]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+    def arm(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        while self.heap and not self.heap[0][2].active:
+            heapq.heappop(self.heap)
+            self.cancelled -= 1
+        if not self.heap:
+            return
+        self.handle_deadline = self.heap[0][0]
+        delay = self.handle_deadline - time.monotonic()
+        self.handle = self.loop.call_at(self.loop.time() + delay, self.run)
+
+    def run(self):
+        self.handle = None
+        now = time.monotonic()
+        while self.heap and self.heap[0][0] <= now:
+            _, _, timer = heapq.heappop(self.heap)
+            if not timer.active:
+                self.cancelled -= 1
+                continue
+            timer.active = False
+            try:
+                timer.callback(*timer.args)
+            except Exception as exc:
+                self.loop.call_exception_handler(
+                    {"message": "Timer callback failed", "exception": exc}
+                )
+        self.arm()
+
+
+timers = TimerScheduler()
@@ -1,90 +1,210 @@
-import json
-from channels.generic.websocket import (
-    AsyncWebsocketConsumer,
-    AsyncJsonWebsocketConsumer,
+import time
+from urllib.parse import parse_qs
+from channels.generic.websocket import AsyncWebsocketConsumer
+from .presence import get_presence_store, presence_keeper, user_group_name
+from .events import get_event_store
+from .engine import (
+    COLOR_NAMES,
+    KNIGHT,
+    BISHOP,
+    ROOK,
+    QUEEN,
+    Outcome,
+    parse_square,
+    square_name,
+    move_to_uci,
 )
-from channels.db import database_sync_to_async
-from .models import UserChannel
+from .models import Game
+from .live import (
+    game_id_from_room,
+    game_room,
+    join_live_game,
+    leave_live_game,
+    arm_clock,
+    flag_outcome,
+    publish,
+    end_live_game,
+)
+from .movelog import move_log
+from .matchmaking import Ticket, is_playing, matchmaker, player_rating
+from .clock import normalize_time_control
+from .spectators import latest_snapshot, spectator_group_name, spectator_stream
+from .protocol import ProtocolMixin, game_protocol, main_protocol
+from .instrumentation import InstrumentedConsumerMixin
+
+# Promotion piece names accepted from clients, "" stands for no promotion
+PROMOTION_PIECES = {
+    "": 0,
+    "q": QUEEN,
+    "queen": QUEEN,
+    "r": ROOK,
+    "rook": ROOK,
+    "b": BISHOP,
+    "bishop": BISHOP,
+    "n": KNIGHT,
+    "knight": KNIGHT,
+}
+
+
+def requested_last_seq(scope):
+    values = parse_qs(scope.get("query_string", b"").decode()).get("last_seq")
+    try:
+        last_seq = int(values[0])
+    except (TypeError, ValueError):
+        return None
+    return last_seq if last_seq >= 0 else None
+
 
+class MainConsumer(InstrumentedConsumerMixin, ProtocolMixin, AsyncWebsocketConsumer):
+    protocol = main_protocol
 
-class MainConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope["user"]
         if self.user.is_anonymous:
-            self.close()
+            await self.close()
         else:
-            try:
-                channel = await database_sync_to_async(UserChannel.objects.get)(
-                    user=self.user.pk
-                )
-                channel.name = self.channel_name
-                await database_sync_to_async(channel.save)()
-            except UserChannel.DoesNotExist:
-                await database_sync_to_async(UserChannel.objects.create)(
-                    name=self.channel_name, user=self.user
-                )
-            finally:
-                await self.accept()
+            # Every device of the user joins the same group, events are fanned out to all of them
+            await self.channel_layer.group_add(
+                user_group_name(self.user.pk), self.channel_name
+            )
+            await get_presence_store().aconnect(self.user.pk, self.channel_name)
+            presence_keeper.add(self.user.pk, self.channel_name)
+            await self.accept_protocol()
 
     async def receive(self, text_data=None, bytes_data=None):
-        print(text_data)
+        content = self.decode_command(text_data, bytes_data)
+        if not self.allow(content):
+            return
+        # Sockets are renewed by presence_keeper, frames from the client renew them sooner
+        await get_presence_store().atouch(self.user.pk, self.channel_name)
+        if content is None:
+            return
+        command = content.get("command")
+        if command == "queue":
+            await self.join_queue(content)
+        elif command == "leave_queue":
+            matchmaker.leave(self.user.pk)
+            await self.send_message({"type": "queue_left"})
+        elif command == "ack":
+            await self.acknowledge(content)
 
     async def disconnect(self, code):
-        await self.delete_channel()
-        await self.close()
+        if not self.user.is_anonymous:
+            await self.channel_layer.group_discard(
+                user_group_name(self.user.pk), self.channel_name
+            )
+            presence_keeper.remove(self.channel_name)
+            await get_presence_store().adisconnect(self.user.pk, self.channel_name)
+            matchmaker.leave(self.user.pk, self.channel_name)
+
+    async def join_queue(self, content):
+        try:
+            time_control = normalize_time_control(content.get("time_control"))
+        except ValueError:
+            time_control = ""
+        if not time_control:
+            await self.send_message({"type": "error", "message": "Invalid time control"})
+            return
+        if await is_playing(self.user.pk):
+            await self.send_message({"type": "error", "message": "You are already playing"})
+            return
+        rating = await player_rating(self.user.pk, time_control)
+        matchmaker.join(
+            Ticket(self.user.pk, self.user.username, self.channel_name, rating), time_control
+        )
+        await self.send_message({"type": "queued", "time_control": time_control})
+
+    async def on_queue_left(self, event):
+        await self.send_message({"type": "queue_left"})
 
     async def on_challenge(self, event):
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "challenge",
-                    "request_id": event["request_id"],
-                    "user": {
-                        "id": self.user.pk,
-                        "username": self.user.username,
-                        "name": self.user.first_name + self.user.last_name,
-                    },
-                }
-            )
+        await self.send_message(
+            {
+                "type": "challenge",
+                "request_id": event["request_id"],
+                "time_control": event.get("time_control", ""),
+                "user": {
+                    "id": self.user.pk,
+                    "username": self.user.username,
+                    "name": self.user.first_name + self.user.last_name,
+                },
+            }
         )
 
     async def on_challenge_accept(self, event):
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "challenge_accepted",
-                    "game_id": event["game_id"],
-                }
-            )
+        await self.send_message(
+            {
+                "type": "challenge_accepted",
+                "game_id": event["game_id"],
+            }
+        )
+
+    async def on_match(self, event):
+        await self.send_message(
+            {
+                "type": "match",
+                "game_id": event["game_id"],
+                "color": event["color"],
+                "time_control": event["time_control"],
+                "opponent": event["opponent"],
+            }
         )
 
     async def on_movement(self, event):
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "move",
-                    "game_id": event["game_id"],
-                    "from": event["from"],
-                    "to": event["to"],
-                }
-            )
+        await self.send_message(
+            {
+                "type": "move",
+                "game_id": event["game_id"],
+                "from": event["from"],
+                "to": event["to"],
+            }
         )
 
-    @database_sync_to_async
-    def delete_channel(self):
-        UserChannel.objects.filter(name=self.channel_name).delete()
 
+class GameConsumer(InstrumentedConsumerMixin, ProtocolMixin, AsyncWebsocketConsumer):
+    """
+    Relays moves between the players of a room after validating them against
+    the server-side board of the game. Other users watch through SpectatorConsumer.
+    Every event of a game carries a sequence number. A client that reconnects with
+    ?last_seq=<n> receives the events it missed, or a snapshot of the game if they
+    are no longer buffered.
+    """
+
+    protocol = game_protocol
 
-class GameConsumer(AsyncJsonWebsocketConsumer):
     async def connect(self):
+        self.live_game = None
         if self.scope["user"].is_anonymous:
             await self.close()
-        else:
-            self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
-            await self.channel_layer.group_add(self.room_name, self.channel_name)
-            await self.accept()
+            return
+        room_name = self.scope["url_route"]["kwargs"]["room_name"]
+        self.room_name = game_room(game_id_from_room(room_name))
+        self.live_game = await join_live_game(self.room_name)
+        if self.live_game is None:
+            await self.close()
+            return
+        self.color = self.live_game.color_of(self.scope["user"].pk)
+        if self.color is None:
+            leave_live_game(self.room_name)
+            self.live_game = None
+            await self.close()
+            return
+        # Sequence number of the last event sent to this socket
+        self.last_seq = 0
+        await self.channel_layer.group_add(self.room_name, self.channel_name)
+        await self.accept_protocol()
+        last_seq = requested_last_seq(self.scope)
+        if last_seq is not None:
+            await self.resume(last_seq)
 
-    async def receive_json(self, content, **kwargs):
+    async def receive(self, text_data=None, bytes_data=None):
+        content = self.decode_command(text_data, bytes_data)
+        if not self.allow(content):
+            if content is not None and content.get("command") in ("move", "promote", "resign"):
+                await self.reject(content["command"], "Too many requests")
+            return
+        if content is None:
+            return
         command = content.get("command", None)
         if command == "move":
             await self.send_move(content)
@@ -92,57 +212,304 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
             await self.send_promotion(content)
         elif command == "resign":
             await self.send_resign(content)
-        
+        elif command == "ack":
+            await self.acknowledge(content)
+
     async def disconnect(self, code):
+        if self.live_game is None:
+            return
         await self.channel_layer.group_discard(self.room_name, self.channel_name)
+        await move_log.flush(self.live_game.game_id)
+        leave_live_game(self.room_name)
+
+    async def reject(self, command, message):
+        await self.send_message(
+            {"msg_type": "error", "command": command, "message": message}, droppable=True
+        )
+
+    async def resume(self, last_seq):
+        """
+        Sends the events that followed `last_seq`, or a snapshot if some of them were evicted.
+        Joining the group happens first, so events published meanwhile are not lost,
+        only received twice and skipped by send_event().
+        """
+        store = get_event_store()
+        messages = await store.asince(self.live_game.game_id, last_seq)
+        if messages is None:
+            await self.send_snapshot(await store.alast_seq(self.live_game.game_id))
+            return
+        for message in messages:
+            await self.send_event(message)
+
+    async def send_snapshot(self, seq):
+        live_game = self.live_game
+        board = live_game.board
+        outcome = live_game.outcome
+        pending = live_game.pending_promotion
+        self.last_seq = seq
+        await self.send_message({
+            "msg_type": "snapshot",
+            "seq": seq,
+            "fen": board.fen(),
+            "moves": [move_to_uci(move) for move in board.move_stack],
+            "pending_promotion": None if pending is None else [square_name(s) for s in pending],
+            "result": None if outcome is None else outcome.result,
+            "reason": None if outcome is None else outcome.reason,
+            "winner": (
+                None if outcome is None or outcome.winner is None else COLOR_NAMES[outcome.winner]
+            ),
+            "clock": self.clock_state(time.monotonic()),
+        })
+
+    async def send_event(self, message, encoded=None):
+        """
+        Sends a numbered message once, `encoded` is its encoding shared by the whole room.
+        """
+        if message["seq"] <= self.last_seq:
+            return
+        self.last_seq = message["seq"]
+        await self.send_message(message, encoded)
+
+    def clock_state(self, now):
+        clock = self.live_game.clock
+        return None if clock is None else clock.as_dict(now)
+
+    async def flag_fell(self, now):
+        """
+        Ends the game on time if the side to move has run out of it, even when
+        the flag timer has not fired yet.
+        """
+        live_game = self.live_game
+        if live_game.clock is None or not live_game.clock.is_flagged(now):
+            return False
+        await end_live_game(self.room_name, live_game, flag_outcome(live_game))
+        return True
+
+    def play(self, legal_move, now):
+        """
+        Plays a validated move, switches the clocks and logs the move with the mover's time.
+        """
+        live_game = self.live_game
+        live_game.board.push(legal_move)
+        remaining = None
+        if live_game.clock is not None:
+            remaining = live_game.clock.press(now)
+            arm_clock(self.room_name, live_game)
+        move_log.add(live_game.game_id, live_game.board.ply, legal_move, remaining)
+
+    def can_move(self):
+        live_game = self.live_game
+        return (
+            live_game.outcome is None
+            and live_game.pending_promotion is None
+            and self.color == live_game.board.turn
+        )
 
     async def send_move(self, move):
-        await self.channel_layer.group_send(
+        live_game = self.live_game
+        board = live_game.board
+        if not self.can_move():
+            await self.reject("move", "It is not your turn")
+            return
+        now = time.monotonic()
+        if await self.flag_fell(now):
+            return
+        try:
+            from_square = parse_square(move["from"])
+            to_square = parse_square(move["to"])
+            promotion = PROMOTION_PIECES[(move.get("promotion") or "").lower()]
+        except (AttributeError, KeyError, TypeError, ValueError):
+            await self.reject("move", "Invalid move")
+            return
+        uci = None
+        if not promotion and board.is_promotion(from_square, to_square):
+            # The promotion piece arrives with the following promote command
+            live_game.pending_promotion = (from_square, to_square)
+        else:
+            legal_move = board.find_move(from_square, to_square, promotion)
+            if legal_move is None:
+                await self.reject("move", "Illegal move")
+                return
+            self.play(legal_move, now)
+            uci = move_to_uci(legal_move)
+        await publish(
             self.room_name,
+            live_game,
+            "chess.move",
             {
-                "type": "chess.move",
-                "player": move["player"],
+                "msg_type": "move",
+                "player": COLOR_NAMES[self.color],
                 "from": move["from"],
                 "to": move["to"],
-                "timestamp": move["timestamp"],
+                "timestamp": move.get("timestamp"),
+                "clock": self.clock_state(now),
             },
+            uci=uci,
+            ply=board.ply,
         )
-    
+        if uci is not None:
+            await self.end_if_over()
+
     async def send_promotion(self, promotion):
-        await self.channel_layer.group_send(
+        live_game = self.live_game
+        board = live_game.board
+        pending = live_game.pending_promotion
+        if (
+            live_game.outcome is not None
+            or pending is None
+            or self.color != board.turn
+        ):
+            await self.reject("promote", "There is no pawn to promote")
+            return
+        now = time.monotonic()
+        if await self.flag_fell(now):
+            return
+        try:
+            square = parse_square(promotion["square"])
+            piece = PROMOTION_PIECES[promotion["piece"].lower()]
+        except (AttributeError, KeyError, TypeError, ValueError):
+            await self.reject("promote", "Invalid promotion")
+            return
+        from_square, to_square = pending
+        legal_move = board.find_move(from_square, to_square, piece)
+        if not piece or square != to_square or legal_move is None:
+            await self.reject("promote", "Invalid promotion")
+            return
+        live_game.pending_promotion = None
+        self.play(legal_move, now)
+        await publish(
             self.room_name,
+            live_game,
+            "chess.promote",
             {
-                "type": "chess.promote",
-                "player": promotion["player"],
+                "msg_type": "promote",
+                "player": COLOR_NAMES[self.color],
                 "square": promotion["square"],
                 "piece": promotion["piece"],
-                "timestamp": promotion["timestamp"],
-            }
+                "timestamp": promotion.get("timestamp"),
+                "clock": self.clock_state(now),
+            },
+            uci=move_to_uci(legal_move),
+            ply=board.ply,
         )
+        await self.end_if_over()
 
     async def send_resign(self, data):
-        pass
+        if not await end_live_game(
+            self.room_name, self.live_game, Outcome("resignation", self.color ^ 1)
+        ):
+            await self.reject("resign", "The game is over")
+
+    async def end_if_over(self):
+        outcome = self.live_game.board.outcome()
+        if outcome is not None:
+            await end_live_game(self.room_name, self.live_game, outcome)
+
+    def sync_board(self, event):
+        """
+        Applies a move validated by a consumer in another process to this process' board and clock.
+        """
+        live_game = self.live_game
+        board = live_game.board
+        if event["uci"] is not None and board.ply < event["ply"]:
+            board.push(board.parse_uci(event["uci"]))
+            clock = event["message"].get("clock")
+            if live_game.clock is not None and clock is not None:
+                live_game.clock.sync(clock, time.monotonic())
+                arm_clock(self.room_name, live_game)
 
     async def chess_move(self, event):
-        await self.send_json({
-            "msg_type": "move",
-            "player": event["player"],
-            "from": event["from"],
-            "to": event["to"],
-            "timestamp": event["timestamp"],
-        })
+        self.sync_board(event)
+        await self.send_event(event["message"], event.get("encoded"))
 
     async def chess_promote(self, event):
-        await self.send_json({
-            "msg_type": "promote",
-            "player": event["player"],
-            "square": event["square"],
-            "piece": event["piece"],
-            "timestamp": event["timestamp"],
-        })
+        self.sync_board(event)
+        await self.send_event(event["message"], event.get("encoded"))
+
+    async def chess_end(self, event):
+        message = event["message"]
+        winner = message["winner"]
+        self.live_game.outcome = Outcome(
+            message["reason"], None if winner is None else COLOR_NAMES.index(winner)
+        )
+        # Stops the flag timer of games ended by another process
+        arm_clock(self.room_name, self.live_game)
+        await self.send_event(message, event.get("encoded"))
 
     async def chess_resign(self, event):
         pass
 
     async def chess_win(self, event):
         pass
+
+
+class SpectatorConsumer(InstrumentedConsumerMixin, ProtocolMixin, AsyncWebsocketConsumer):
+    """
+    Read-only view of a game for anybody who is not playing it. Spectators share a
+    group per game that receives frames already encoded by the publisher, see
+    chess.spectators, so a move costs one encoding however many people watch.
+    Frames are numbered separately from the players' events: a new spectator gets a
+    snapshot of the last known position, one that reconnects with ?last_seq=<n> gets
+    every frame it missed, or the snapshot if some of them were evicted.
+    """
+
+    protocol = game_protocol
+
+    async def connect(self):
+        self.group_name = None
+        room_name = self.scope["url_route"]["kwargs"]["room_name"]
+        self.game_id = game_id_from_room(room_name)
+        if not await Game.objects.filter(pk=self.game_id).aexists():
+            await self.close()
+            return
+        # Sequence number of the last frame sent to this socket
+        self.last_seq = 0
+        self.group_name = spectator_group_name(game_room(self.game_id))
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept_protocol()
+        last_seq = requested_last_seq(self.scope)
+        if last_seq is None:
+            await self.send_snapshot()
+        else:
+            await self.resume(last_seq)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # Spectators cannot play, they only acknowledge frames
+        content = self.decode_command(text_data, bytes_data)
+        if self.allow(content) and content is not None and content.get("command") == "ack":
+            await self.acknowledge(content)
+
+    async def disconnect(self, code):
+        if self.group_name is not None:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def resume(self, last_seq):
+        frames = await get_event_store().asince(spectator_stream(self.game_id), last_seq)
+        if frames is None:
+            await self.send_snapshot()
+            return
+        for frame in frames:
+            await self.send_frame(frame["seq"], game_protocol.encode(frame))
+
+    async def send_snapshot(self):
+        """
+        Sends the position of the last frame, shared by every spectator who joins after it.
+        """
+        snapshot = await latest_snapshot(self.game_id)
+        if snapshot is None:
+            return
+        seq, encoded = snapshot
+        if seq <= self.last_seq:
+            return
+        self.last_seq = seq
+        await self.send_message(None, encoded)
+
+    async def send_frame(self, seq, encoded):
+        if seq <= self.last_seq:
+            return
+        self.last_seq = seq
+        # Every frame carries the position, a client that falls behind can skip some
+        await self.send_message(None, encoded, droppable=True)
+
+    async def spectator_frame(self, event):
+        await self.send_frame(event["seq"], event["encoded"])
@@ -0,0 +1,596 @@
+"""
+Bitboard chess engine used to keep the authoritative board of live games.
+
+Squares are numbered from 0 (a1) to 63 (h8) and every bitboard is an int whose
+bit `i` is set when square `i` is occupied. Moves are ints packing the from
+square (bits 0-5), the to square (bits 6-11), the promotion piece (bits 12-14)
+and a move flag (bits 15-16).
+"""
+
+from collections import namedtuple
+
+WHITE, BLACK = 0, 1
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+COLOR_NAMES = ["white", "black"]
+PIECE_SYMBOLS = "pnbrqk"
+
+QUIET, DOUBLE_PUSH, EN_PASSANT, CASTLING = range(4)
+
+WHITE_KINGSIDE, WHITE_QUEENSIDE, BLACK_KINGSIDE, BLACK_QUEENSIDE = 1, 2, 4, 8
+
+STARTING_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+FULL = (1 << 64) - 1
+FILE_A = 0x0101010101010101
+FILE_H = FILE_A << 7
+RANK_1 = 0xFF
+RANK_3 = RANK_1 << 16
+RANK_6 = RANK_1 << 40
+RANK_8 = RANK_1 << 56
+
+A1, C1, D1, E1, F1, G1, H1 = 0, 2, 3, 4, 5, 6, 7
+A8, C8, D8, E8, F8, G8, H8 = 56, 58, 59, 60, 61, 62, 63
+
+PROMOTIONS = (QUEEN, ROOK, BISHOP, KNIGHT)
+
+# Rook move that accompanies each castling king move, keyed by the king's target square
+CASTLING_ROOK_MOVES = {G1: (H1, F1), C1: (A1, D1), G8: (H8, F8), C8: (A8, D8)}
+
+# Castling rights that survive a move from or to a square
+CASTLING_MASKS = [15] * 64
+CASTLING_MASKS[E1] = 15 & ~(WHITE_KINGSIDE | WHITE_QUEENSIDE)
+CASTLING_MASKS[H1] = 15 & ~WHITE_KINGSIDE
+CASTLING_MASKS[A1] = 15 & ~WHITE_QUEENSIDE
+CASTLING_MASKS[E8] = 15 & ~(BLACK_KINGSIDE | BLACK_QUEENSIDE)
+CASTLING_MASKS[H8] = 15 & ~BLACK_KINGSIDE
+CASTLING_MASKS[A8] = 15 & ~BLACK_QUEENSIDE
+
+
+def _leaper_attacks(offsets):
+    table = []
+    for square in range(64):
+        rank, file = divmod(square, 8)
+        attacks = 0
+        for rank_step, file_step in offsets:
+            r, f = rank + rank_step, file + file_step
+            if 0 <= r < 8 and 0 <= f < 8:
+                attacks |= 1 << (r * 8 + f)
+        table.append(attacks)
+    return table
+
+
+def _ray_table(rank_step, file_step):
+    table = []
+    for square in range(64):
+        rank, file = divmod(square, 8)
+        ray = 0
+        r, f = rank + rank_step, file + file_step
+        while 0 <= r < 8 and 0 <= f < 8:
+            ray |= 1 << (r * 8 + f)
+            r, f = r + rank_step, f + file_step
+        table.append(ray)
+    return table
+
+
+KNIGHT_ATTACKS = _leaper_attacks(
+    [(1, 2), (2, 1), (-1, 2), (-2, 1), (1, -2), (2, -1), (-1, -2), (-2, -1)]
+)
+KING_ATTACKS = _leaper_attacks(
+    [(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)]
+)
+# Squares attacked by a pawn of the given color standing on a square
+PAWN_ATTACKS = [_leaper_attacks([(1, -1), (1, 1)]), _leaper_attacks([(-1, -1), (-1, 1)])]
+
+# (ray table, whether square numbers increase along the ray)
+ROOK_RAYS = [
+    (_ray_table(1, 0), True),
+    (_ray_table(0, 1), True),
+    (_ray_table(-1, 0), False),
+    (_ray_table(0, -1), False),
+]
+BISHOP_RAYS = [
+    (_ray_table(1, 1), True),
+    (_ray_table(1, -1), True),
+    (_ray_table(-1, 1), False),
+    (_ray_table(-1, -1), False),
+]
+
+
+def _slider_attacks(square, occupied, rays):
+    attacks = 0
+    for table, increasing in rays:
+        ray = table[square]
+        blockers = ray & occupied
+        if blockers:
+            # Cut the ray behind the nearest blocker
+            if increasing:
+                blocker = (blockers & -blockers).bit_length() - 1
+            else:
+                blocker = blockers.bit_length() - 1
+            ray ^= table[blocker]
+        attacks |= ray
+    return attacks
+
+
+def bishop_attacks(square, occupied):
+    return _slider_attacks(square, occupied, BISHOP_RAYS)
+
+
+def rook_attacks(square, occupied):
+    return _slider_attacks(square, occupied, ROOK_RAYS)
+
+
+def squares_of(bitboard):
+    while bitboard:
+        lowest = bitboard & -bitboard
+        yield lowest.bit_length() - 1
+        bitboard ^= lowest
+
+
+def encode_move(from_square, to_square, promotion=0, flag=QUIET):
+    return from_square | to_square << 6 | promotion << 12 | flag << 15
+
+
+def move_from_square(move):
+    return move & 63
+
+
+def move_to_square(move):
+    return (move >> 6) & 63
+
+
+def move_promotion(move):
+    return (move >> 12) & 7
+
+
+def move_flag(move):
+    return move >> 15
+
+
+def compact_move(move):
+    """
+    16-bit code of a move: from square, to square and promotion piece.
+    The flag is dropped, it can be recovered from the position, see Board.decode_move.
+    """
+    return move & 0x7FFF
+
+
+def square_name(square):
+    return "abcdefgh"[square & 7] + str((square >> 3) + 1)
+
+
+def parse_square(name):
+    if len(name) != 2 or name[0] not in "abcdefgh" or name[1] not in "12345678":
+        raise ValueError(f"Invalid square: {name!r}")
+    return (int(name[1]) - 1) * 8 + "abcdefgh".index(name[0])
+
+
+def move_to_uci(move):
+    uci = square_name(move_from_square(move)) + square_name(move_to_square(move))
+    promotion = move_promotion(move)
+    if promotion:
+        uci += PIECE_SYMBOLS[promotion]
+    return uci
+
+
+class Outcome(namedtuple("Outcome", ["reason", "winner"])):
+    """
+    How a game ended. `winner` is WHITE, BLACK or None for a draw.
+    """
+
+    @property
+    def result(self):
+        if self.winner is None:
+            return "1/2-1/2"
+        return "1-0" if self.winner == WHITE else "0-1"
+
+
+class Board:
+    """
+    A chess position with legal move generation and game end detection.
+    """
+
+    def __init__(self, fen=STARTING_FEN):
+        self.set_fen(fen)
+
+    def set_fen(self, fen):
+        fields = fen.split()
+        if len(fields) < 4:
+            raise ValueError(f"Invalid FEN: {fen!r}")
+        placement, turn, castling, ep_square = fields[:4]
+        halfmove_clock = fields[4] if len(fields) > 4 else "0"
+        fullmove_number = fields[5] if len(fields) > 5 else "1"
+
+        # Bitboards indexed by color * 6 + piece type
+        self.pieces = [0] * 12
+        # Piece index standing on every square, -1 for empty squares
+        self.squares = [-1] * 64
+        self.occupancy = [0, 0]
+        ranks = placement.split("/")
+        if len(ranks) != 8:
+            raise ValueError(f"Invalid FEN: {fen!r}")
+        for rank_index, rank in enumerate(ranks):
+            file = 0
+            for symbol in rank:
+                if symbol.isdigit():
+                    file += int(symbol)
+                    continue
+                if symbol.lower() not in PIECE_SYMBOLS or file > 7:
+                    raise ValueError(f"Invalid FEN: {fen!r}")
+                color = WHITE if symbol.isupper() else BLACK
+                piece = color * 6 + PIECE_SYMBOLS.index(symbol.lower())
+                square = (7 - rank_index) * 8 + file
+                self.pieces[piece] |= 1 << square
+                self.occupancy[color] |= 1 << square
+                self.squares[square] = piece
+                file += 1
+
+        self.turn = WHITE if turn == "w" else BLACK
+        self.castling = 0
+        for symbol, right in zip(
+            "KQkq", (WHITE_KINGSIDE, WHITE_QUEENSIDE, BLACK_KINGSIDE, BLACK_QUEENSIDE)
+        ):
+            if symbol in castling:
+                self.castling |= right
+        self.ep_square = -1 if ep_square == "-" else parse_square(ep_square)
+        self.halfmove_clock = int(halfmove_clock)
+        self.fullmove_number = int(fullmove_number)
+        self.move_stack = []
+        self._states = []
+        self._keys = [self.position_key()]
+
+    def fen(self):
+        ranks = []
+        for rank in range(7, -1, -1):
+            row = ""
+            empty = 0
+            for file in range(8):
+                piece = self.squares[rank * 8 + file]
+                if piece == -1:
+                    empty += 1
+                    continue
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                symbol = PIECE_SYMBOLS[piece % 6]
+                row += symbol.upper() if piece < 6 else symbol
+            if empty:
+                row += str(empty)
+            ranks.append(row)
+        castling = "".join(
+            symbol
+            for symbol, right in zip(
+                "KQkq",
+                (WHITE_KINGSIDE, WHITE_QUEENSIDE, BLACK_KINGSIDE, BLACK_QUEENSIDE),
+            )
+            if self.castling & right
+        )
+        ep_square = "-" if self.ep_square == -1 else square_name(self.ep_square)
+        return (
+            f"{'/'.join(ranks)} {'wb'[self.turn]} {castling or '-'} {ep_square} "
+            f"{self.halfmove_clock} {self.fullmove_number}"
+        )
+
+    @property
+    def ply(self):
+        return len(self.move_stack)
+
+    def king_square(self, color):
+        return self.pieces[color * 6 + KING].bit_length() - 1
+
+    def is_attacked(self, square, by_color):
+        pieces = self.pieces
+        base = by_color * 6
+        if PAWN_ATTACKS[by_color ^ 1][square] & pieces[base + PAWN]:
+            return True
+        if KNIGHT_ATTACKS[square] & pieces[base + KNIGHT]:
+            return True
+        if KING_ATTACKS[square] & pieces[base + KING]:
+            return True
+        occupied = self.occupancy[0] | self.occupancy[1]
+        queens = pieces[base + QUEEN]
+        if bishop_attacks(square, occupied) & (pieces[base + BISHOP] | queens):
+            return True
+        return bool(rook_attacks(square, occupied) & (pieces[base + ROOK] | queens))
+
+    def is_check(self):
+        return self.is_attacked(self.king_square(self.turn), self.turn ^ 1)
+
+    def pseudo_legal_moves(self):
+        us = self.turn
+        them = us ^ 1
+        pieces = self.pieces
+        own = self.occupancy[us]
+        enemy = self.occupancy[them]
+        occupied = own | enemy
+        empty = ~occupied & FULL
+        base = us * 6
+        moves = []
+        append = moves.append
+
+        pawns = pieces[base + PAWN]
+        if us == WHITE:
+            single = (pawns << 8) & empty
+            double = ((single & RANK_3) << 8) & empty
+            left = ((pawns & ~FILE_A) << 7) & enemy
+            right = ((pawns & ~FILE_H) << 9) & enemy
+            push, left_step, right_step, last_rank = 8, 7, 9, RANK_8
+        else:
+            single = (pawns >> 8) & empty
+            double = ((single & RANK_6) >> 8) & empty
+            left = ((pawns & ~FILE_A) >> 9) & enemy
+            right = ((pawns & ~FILE_H) >> 7) & enemy
+            push, left_step, right_step, last_rank = -8, -9, -7, RANK_1
+        for targets, step in ((single, push), (left, left_step), (right, right_step)):
+            for to in squares_of(targets & ~last_rank):
+                append(to - step | to << 6)
+            for to in squares_of(targets & last_rank):
+                for promotion in PROMOTIONS:
+                    append(to - step | to << 6 | promotion << 12)
+        for to in squares_of(double):
+            append(to - 2 * push | to << 6 | DOUBLE_PUSH << 15)
+        if self.ep_square != -1:
+            for frm in squares_of(PAWN_ATTACKS[them][self.ep_square] & pawns):
+                append(frm | self.ep_square << 6 | EN_PASSANT << 15)
+
+        not_own = ~own
+        for frm in squares_of(pieces[base + KNIGHT]):
+            for to in squares_of(KNIGHT_ATTACKS[frm] & not_own):
+                append(frm | to << 6)
+        queens = pieces[base + QUEEN]
+        for frm in squares_of(pieces[base + BISHOP] | queens):
+            for to in squares_of(bishop_attacks(frm, occupied) & not_own):
+                append(frm | to << 6)
+        for frm in squares_of(pieces[base + ROOK] | queens):
+            for to in squares_of(rook_attacks(frm, occupied) & not_own):
+                append(frm | to << 6)
+        king = self.king_square(us)
+        for to in squares_of(KING_ATTACKS[king] & not_own):
+            append(king | to << 6)
+
+        if us == WHITE:
+            kingside, queenside, e, f, g, d, c, b = WHITE_KINGSIDE, WHITE_QUEENSIDE, E1, F1, G1, D1, C1, 1
+        else:
+            kingside, queenside, e, f, g, d, c, b = BLACK_KINGSIDE, BLACK_QUEENSIDE, E8, F8, G8, D8, C8, 57
+        if self.castling & (kingside | queenside) and king == e:
+            if (
+                self.castling & kingside
+                and not occupied & (1 << f | 1 << g)
+                and not self.is_attacked(e, them)
+                and not self.is_attacked(f, them)
+                and not self.is_attacked(g, them)
+            ):
+                append(e | g << 6 | CASTLING << 15)
+            if (
+                self.castling & queenside
+                and not occupied & (1 << d | 1 << c | 1 << b)
+                and not self.is_attacked(e, them)
+                and not self.is_attacked(d, them)
+                and not self.is_attacked(c, them)
+            ):
+                append(e | c << 6 | CASTLING << 15)
+        return moves
+
+    def legal_moves(self):
+        us = self.turn
+        them = us ^ 1
+        legal = []
+        for move in self.pseudo_legal_moves():
+            self._make(move)
+            if not self.is_attacked(self.pieces[us * 6 + KING].bit_length() - 1, them):
+                legal.append(move)
+            self._unmake()
+        return legal
+
+    def has_legal_moves(self):
+        us = self.turn
+        them = us ^ 1
+        for move in self.pseudo_legal_moves():
+            self._make(move)
+            legal = not self.is_attacked(self.pieces[us * 6 + KING].bit_length() - 1, them)
+            self._unmake()
+            if legal:
+                return True
+        return False
+
+    def find_move(self, from_square, to_square, promotion=0):
+        """
+        Returns the legal move between two squares, or None if there is no such move.
+        """
+        for move in self.legal_moves():
+            if (
+                move & 63 == from_square
+                and (move >> 6) & 63 == to_square
+                and (move >> 12) & 7 == promotion
+            ):
+                return move
+        return None
+
+    def decode_move(self, code):
+        """
+        Returns the legal move with the given compact code.
+        """
+        for move in self.legal_moves():
+            if move & 0x7FFF == code:
+                return move
+        raise ValueError(f"Illegal move code: {code}")
+
+    def is_promotion(self, from_square, to_square):
+        return self.find_move(from_square, to_square, QUEEN) is not None
+
+    def parse_uci(self, uci):
+        promotion = PIECE_SYMBOLS.index(uci[4]) if len(uci) == 5 else 0
+        move = self.find_move(parse_square(uci[:2]), parse_square(uci[2:4]), promotion)
+        if move is None:
+            raise ValueError(f"Illegal move: {uci!r}")
+        return move
+
+    def san(self, move, legal_moves=None):
+        """
+        Standard algebraic notation of a legal move in the current position.
+        Pass the position's legal moves if they are already known to skip generating them again.
+        """
+        from_square = move_from_square(move)
+        to_square = move_to_square(move)
+        piece = self.squares[from_square] % 6
+        if move_flag(move) == CASTLING:
+            san = "O-O" if to_square > from_square else "O-O-O"
+        else:
+            is_capture = self.squares[to_square] != -1 or move_flag(move) == EN_PASSANT
+            if piece == PAWN:
+                san = square_name(from_square)[0] + "x" if is_capture else ""
+            else:
+                san = PIECE_SYMBOLS[piece].upper()
+                rivals = [
+                    move_from_square(other)
+                    for other in (legal_moves or self.legal_moves())
+                    if move_to_square(other) == to_square
+                    and move_from_square(other) != from_square
+                    and self.squares[move_from_square(other)] % 6 == piece
+                ]
+                if rivals:
+                    if all(rival & 7 != from_square & 7 for rival in rivals):
+                        san += square_name(from_square)[0]
+                    elif all(rival >> 3 != from_square >> 3 for rival in rivals):
+                        san += square_name(from_square)[1]
+                    else:
+                        san += square_name(from_square)
+                if is_capture:
+                    san += "x"
+            san += square_name(to_square)
+            if move_promotion(move):
+                san += "=" + PIECE_SYMBOLS[move_promotion(move)].upper()
+        self._make(move)
+        if self.is_check():
+            san += "+" if self.has_legal_moves() else "#"
+        self._unmake()
+        return san
+
+    def push(self, move):
+        """
+        Plays a legal move. Use legal_moves() or find_move() to obtain one.
+        """
+        self._make(move)
+        self.move_stack.append(move)
+        self._keys.append(self.position_key())
+
+    def pop(self):
+        self._keys.pop()
+        self._unmake()
+        return self.move_stack.pop()
+
+    def _make(self, move):
+        self._states.append(
+            (
+                self.pieces[:],
+                self.squares[:],
+                self.occupancy[:],
+                self.castling,
+                self.ep_square,
+                self.halfmove_clock,
+                self.fullmove_number,
+            )
+        )
+        frm = move & 63
+        to = (move >> 6) & 63
+        promotion = (move >> 12) & 7
+        flag = move >> 15
+        us = self.turn
+        them = us ^ 1
+        pieces = self.pieces
+        squares = self.squares
+        occupancy = self.occupancy
+
+        piece = squares[frm]
+        captured = squares[to]
+        from_bb = 1 << frm
+        to_bb = 1 << to
+        if captured != -1:
+            pieces[captured] ^= to_bb
+            occupancy[them] ^= to_bb
+        pieces[piece] ^= from_bb | to_bb
+        occupancy[us] ^= from_bb | to_bb
+        squares[frm] = -1
+        squares[to] = piece
+
+        if flag == EN_PASSANT:
+            captured_square = to - 8 if us == WHITE else to + 8
+            captured_bb = 1 << captured_square
+            pieces[them * 6 + PAWN] ^= captured_bb
+            occupancy[them] ^= captured_bb
+            squares[captured_square] = -1
+        elif flag == CASTLING:
+            rook_from, rook_to = CASTLING_ROOK_MOVES[to]
+            rook = us * 6 + ROOK
+            rook_bb = 1 << rook_from | 1 << rook_to
+            pieces[rook] ^= rook_bb
+            occupancy[us] ^= rook_bb
+            squares[rook_from] = -1
+            squares[rook_to] = rook
+        if promotion:
+            promoted = us * 6 + promotion
+            pieces[piece] ^= to_bb
+            pieces[promoted] |= to_bb
+            squares[to] = promoted
+
+        self.castling &= CASTLING_MASKS[frm] & CASTLING_MASKS[to]
+        self.ep_square = (frm + to) >> 1 if flag == DOUBLE_PUSH else -1
+        if piece == us * 6 + PAWN or captured != -1 or flag == EN_PASSANT:
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+        if us == BLACK:
+            self.fullmove_number += 1
+        self.turn = them
+
+    def _unmake(self):
+        (
+            self.pieces,
+            self.squares,
+            self.occupancy,
+            self.castling,
+            self.ep_square,
+            self.halfmove_clock,
+            self.fullmove_number,
+        ) = self._states.pop()
+        self.turn ^= 1
+
+    def position_key(self):
+        """
+        Hashable key of the position as understood by the repetition rule.
+        The en passant square only counts when a capture on it is possible.
+        """
+        ep_square = self.ep_square
+        if ep_square != -1 and not (
+            PAWN_ATTACKS[self.turn ^ 1][ep_square] & self.pieces[self.turn * 6 + PAWN]
+        ):
+            ep_square = -1
+        return (*self.pieces, self.turn, self.castling, ep_square)
+
+    def is_checkmate(self):
+        return self.is_check() and not self.has_legal_moves()
+
+    def is_stalemate(self):
+        return not self.is_check() and not self.has_legal_moves()
+
+    def is_threefold_repetition(self):
+        # Positions before the last capture or pawn move can never repeat
+        recent = self._keys[-(self.halfmove_clock + 1):]
+        return recent.count(self._keys[-1]) >= 3
+
+    def is_fifty_moves(self):
+        return self.halfmove_clock >= 100
+
+    def outcome(self):
+        """
+        Returns an Outcome if the game is over, otherwise None.
+        """
+        if not self.has_legal_moves():
+            if self.is_check():
+                return Outcome("checkmate", self.turn ^ 1)
+            return Outcome("stalemate", None)
+        if self.is_threefold_repetition():
+            return Outcome("threefold_repetition", None)
+        if self.is_fifty_moves():
+            return Outcome("fifty_moves", None)
+        return None
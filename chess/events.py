@@ -0,0 +1,193 @@
+import functools
+import json
+import time
+from collections import OrderedDict, deque
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+
+class BaseGameEventStore:
+    """
+    Numbers the events of every live game and keeps the last `size` of them,
+    so that a player whose socket dropped can catch up on what was missed.
+    Games without new events for `ttl` seconds are forgotten.
+    """
+
+    def __init__(self, size=200, ttl=3600):
+        self.size = size
+        self.ttl = ttl
+
+    def append(self, game_id, message):
+        """
+        Assigns the next sequence number of the game to a message, stores it
+        and returns the message with its "seq".
+        """
+        raise NotImplementedError
+
+    def since(self, game_id, last_seq):
+        """
+        Returns the messages that followed `last_seq` in order, or None if some
+        of them have already been evicted and the client needs a full snapshot.
+        """
+        raise NotImplementedError
+
+    def last_seq(self, game_id):
+        raise NotImplementedError
+
+    async def aappend(self, game_id, message):
+        return await sync_to_async(self.append)(game_id, message)
+
+    async def asince(self, game_id, last_seq):
+        return await sync_to_async(self.since)(game_id, last_seq)
+
+    async def alast_seq(self, game_id):
+        return await sync_to_async(self.last_seq)(game_id)
+
+
+class InMemoryGameEventStore(BaseGameEventStore):
+    """
+    Process-local store. Only suitable for tests and single-process deployments.
+    """
+
+    def __init__(self, size=200, ttl=3600):
+        super().__init__(size, ttl)
+        # game id -> [last seq, deque of messages, expires at], least recently updated first
+        self.games = OrderedDict()
+
+    def evict_expired(self):
+        now = time.monotonic()
+        while self.games:
+            game_id, (_, _, expires_at) = next(iter(self.games.items()))
+            if expires_at > now:
+                break
+            del self.games[game_id]
+
+    def append(self, game_id, message):
+        self.evict_expired()
+        entry = self.games.pop(game_id, None) or [0, deque(maxlen=self.size), 0]
+        entry[0] += 1
+        message = {**message, "seq": entry[0]}
+        entry[1].append(message)
+        entry[2] = time.monotonic() + self.ttl
+        self.games[game_id] = entry
+        return message
+
+    def since(self, game_id, last_seq):
+        self.evict_expired()
+        seq, messages, _ = self.games.get(game_id, (0, (), 0))
+        if last_seq == seq:
+            return []
+        if last_seq > seq or not messages or messages[0]["seq"] > last_seq + 1:
+            return None
+        return [message for message in messages if message["seq"] > last_seq]
+
+    def last_seq(self, game_id):
+        self.evict_expired()
+        return self.games[game_id][0] if game_id in self.games else 0
+
+    async def aappend(self, game_id, message):
+        return self.append(game_id, message)
+
+    async def asince(self, game_id, last_seq):
+        return self.since(game_id, last_seq)
+
+    async def alast_seq(self, game_id):
+        return self.last_seq(game_id)
+
+
+class RedisGameEventStore(BaseGameEventStore):
+    """
+    Keeps a counter and a sorted set of "<seq>:<JSON message>" members scored by
+    their sequence number per game. Both keys expire `ttl` seconds after the last event.
+    """
+
+    APPEND_SCRIPT = """
+    local seq = redis.call("incr", KEYS[1])
+    redis.call("zadd", KEYS[2], seq, seq .. ":" .. ARGV[1])
+    redis.call("zremrangebyrank", KEYS[2], 0, -ARGV[2] - 1)
+    redis.call("expire", KEYS[1], ARGV[3])
+    redis.call("expire", KEYS[2], ARGV[3])
+    return seq
+    """
+    SINCE_SCRIPT = """
+    local seq = tonumber(redis.call("get", KEYS[1]) or 0)
+    local last_seq = tonumber(ARGV[1])
+    if last_seq == seq then
+        return {seq, 0, {}}
+    end
+    local oldest = redis.call("zrange", KEYS[2], 0, 0, "WITHSCORES")
+    if last_seq > seq or #oldest == 0 or tonumber(oldest[2]) > last_seq + 1 then
+        return {seq, 1, {}}
+    end
+    return {seq, 0, redis.call("zrangebyscore", KEYS[2], "(" .. last_seq, "+inf")}
+    """
+
+    def __init__(self, size=200, ttl=3600, prefix="game-events", **connection_kwargs):
+        import redis
+        import redis.asyncio
+
+        super().__init__(size, ttl)
+        self.prefix = prefix
+        self.client = redis.Redis(decode_responses=True, **connection_kwargs)
+        self.async_client = redis.asyncio.Redis(decode_responses=True, **connection_kwargs)
+        self.scripts = {}
+        self.async_scripts = {}
+        for name in ("append", "since"):
+            source = getattr(self, f"{name.upper()}_SCRIPT")
+            self.scripts[name] = self.client.register_script(source)
+            self.async_scripts[name] = self.async_client.register_script(source)
+
+    def keys(self, game_id):
+        return [f"{self.prefix}:{game_id}:seq", f"{self.prefix}:{game_id}"]
+
+    def append_args(self, game_id, message):
+        payload = json.dumps(message, separators=(",", ":"))
+        return {"keys": self.keys(game_id), "args": [payload, self.size, self.ttl]}
+
+    def decode_since(self, result):
+        _, evicted, members = result
+        if evicted:
+            return None
+        messages = []
+        for member in members:
+            seq, payload = member.split(":", 1)
+            messages.append({**json.loads(payload), "seq": int(seq)})
+        return messages
+
+    def append(self, game_id, message):
+        seq = self.scripts["append"](**self.append_args(game_id, message))
+        return {**message, "seq": seq}
+
+    def since(self, game_id, last_seq):
+        result = self.scripts["since"](keys=self.keys(game_id), args=[last_seq])
+        return self.decode_since(result)
+
+    def last_seq(self, game_id):
+        return int(self.client.get(self.keys(game_id)[0]) or 0)
+
+    async def aappend(self, game_id, message):
+        seq = await self.async_scripts["append"](**self.append_args(game_id, message))
+        return {**message, "seq": seq}
+
+    async def asince(self, game_id, last_seq):
+        result = await self.async_scripts["since"](keys=self.keys(game_id), args=[last_seq])
+        return self.decode_since(result)
+
+    async def alast_seq(self, game_id):
+        return int(await self.async_client.get(self.keys(game_id)[0]) or 0)
+
+
+@functools.cache
+def get_event_store():
+    config = settings.GAME_EVENT_STORE
+    store_class = import_string(config["BACKEND"])
+    return store_class(**config.get("OPTIONS", {}))
+
+
+@receiver(setting_changed)
+def reset_event_store(setting, **kwargs):
+    if setting == "GAME_EVENT_STORE":
+        get_event_store.cache_clear()
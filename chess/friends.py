@@ -0,0 +1,74 @@
+"""
+Friend ids of every user, cached in the default cache so that friendship checks
+cost a set lookup instead of a query.
+
+An entry is served for FRIENDS_CACHE_TIMEOUT seconds. After that a single request
+reloads it, chosen by a lock in the cache, while the others keep serving the old
+set. When the entry is missing altogether, requests wait for the one holding the
+lock rather than all loading the same set.
+"""
+
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+# Seconds a reload may take before another request is allowed to try
+LOCK_TIMEOUT = 10
+# Seconds a request waits for a missing entry that another request is loading
+LOCK_WAIT = 0.5
+LOCK_POLL_INTERVAL = 0.02
+
+
+def cache_key(user_id):
+    return f"friends:{user_id}"
+
+
+def lock_key(user_id):
+    return f"friends:{user_id}:lock"
+
+
+def load_friend_ids(user_id):
+    from .models import Friendship
+
+    ids = frozenset(Friendship.objects.filter(user_id=user_id).values_list("friend_id", flat=True))
+    timeout = settings.FRIENDS_CACHE_TIMEOUT
+    # Kept for twice as long as it is fresh, stale sets are served while one request reloads
+    cache.set(cache_key(user_id), (time.time() + timeout, ids), 2 * timeout)
+    cache.delete(lock_key(user_id))
+    return ids
+
+
+def friend_ids(user_id):
+    """
+    Returns the frozenset of the ids of a user's friends.
+    """
+    entry = cache.get(cache_key(user_id))
+    if entry is not None:
+        refresh_at, ids = entry
+        if time.time() < refresh_at or not cache.add(lock_key(user_id), 1, LOCK_TIMEOUT):
+            return ids
+        return load_friend_ids(user_id)
+    if cache.add(lock_key(user_id), 1, LOCK_TIMEOUT):
+        return load_friend_ids(user_id)
+    deadline = time.monotonic() + LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = cache.get(cache_key(user_id))
+        if entry is not None:
+            return entry[1]
+    return load_friend_ids(user_id)
+
+
+def are_friends(user_id, other_id):
+    return other_id in friend_ids(user_id)
+
+
+def invalidate_friend_ids(*user_ids):
+    """
+    Drops the cached friends of users whose friendships changed, right away and again
+    once the transaction commits, in case a concurrent request cached the old set in between.
+    """
+    keys = [cache_key(user_id) for user_id in user_ids]
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
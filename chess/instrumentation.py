@@ -0,0 +1,257 @@
+"""
+Query count, database time and latency of every HTTP request and websocket message,
+totalled in memory per route: the view name of a request, the consumer and message
+type or command of a websocket message.
+
+The stats of the request or message being handled live in a context variable, which
+asgiref copies into the threads that run sync code, so queries made through
+sync_to_async and database_sync_to_async are counted too.
+"""
+
+import threading
+import time
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from . import metrics
+
+current_stats = ContextVar("current_stats", default=None)
+routes = {}
+routes_lock = threading.Lock()
+
+request_duration = metrics.Histogram(
+    "http_request_duration_seconds", "Latency of HTTP requests.", ["route"]
+)
+request_queries = metrics.Counter(
+    "http_request_queries", "SQL queries of HTTP requests.", ["route"]
+)
+message_duration = metrics.Histogram(
+    "websocket_message_duration_seconds",
+    "Time websocket consumers take to handle a message.",
+    ["consumer", "type"],
+)
+connects = metrics.Counter("websocket_connects", "Websocket connection attempts.", ["consumer"])
+disconnects = metrics.Counter(
+    "websocket_disconnects", "Closed websocket connections.", ["consumer"]
+)
+connections = metrics.Gauge("websocket_connections", "Open websocket connections.", ["consumer"])
+
+
+class Stats:
+    __slots__ = ("name", "queries", "db_time", "started_at", "latency")
+
+    def __init__(self, name=None):
+        self.name = name
+        self.queries = 0
+        self.db_time = 0.0
+        self.started_at = time.perf_counter()
+        self.latency = None
+
+    def finish(self):
+        self.latency = time.perf_counter() - self.started_at
+
+
+class RouteTotals:
+    __slots__ = ("count", "queries", "max_queries", "db_time", "latency", "max_latency")
+
+    def __init__(self):
+        self.count = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.db_time = 0.0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def add(self, stats):
+        self.count += 1
+        self.queries += stats.queries
+        self.max_queries = max(self.max_queries, stats.queries)
+        self.db_time += stats.db_time
+        self.latency += stats.latency
+        self.max_latency = max(self.max_latency, stats.latency)
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+def record(stats):
+    with routes_lock:
+        totals = routes.get(stats.name)
+        if totals is None:
+            totals = routes[stats.name] = RouteTotals()
+        totals.add(stats)
+
+
+def snapshot():
+    """
+    Returns {route: totals dict} of everything recorded since the last reset.
+    """
+    with routes_lock:
+        return {name: totals.as_dict() for name, totals in routes.items()}
+
+
+def reset():
+    with routes_lock:
+        routes.clear()
+
+
+def name_current(name):
+    """
+    Names the request or message being handled more precisely than its route,
+    e.g. the command of a websocket frame.
+    """
+    stats = current_stats.get()
+    if stats is not None:
+        stats.name = name
+
+
+def record_query(execute, sql, params, many, context):
+    stats = current_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started_at = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.db_time += time.perf_counter() - started_at
+
+
+@receiver(connection_created)
+def instrument_connection(connection, **kwargs):
+    # The wrapper object outlives its database connection, which may be reopened
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def route_name(request):
+    match = request.resolver_match
+    return f"{request.method} {match.view_name if match else '<unresolved>'}"
+
+
+def finish_request(stats):
+    stats.finish()
+    record(stats)
+    request_duration.labels(stats.name).observe(stats.latency)
+    request_queries.labels(stats.name).inc(stats.queries)
+
+
+def stream(content, stats):
+    """
+    Yields the chunks of a streaming response body, counting their queries in the
+    stats of its request, which are recorded when the body ends or is closed.
+    """
+    iterator = iter(content)
+    try:
+        while True:
+            token = current_stats.set(stats)
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                current_stats.reset(token)
+            yield chunk
+    finally:
+        finish_request(stats)
+
+
+async def astream(content, stats):
+    """
+    stream() of an asynchronous body.
+    """
+    iterator = aiter(content)
+    try:
+        while True:
+            token = current_stats.set(stats)
+            try:
+                chunk = await anext(iterator)
+            except StopAsyncIteration:
+                return
+            finally:
+                current_stats.reset(token)
+            yield chunk
+    finally:
+        finish_request(stats)
+
+
+class InstrumentationMiddleware:
+    """
+    Records the stats of every request. With DEBUG on they are also sent in the
+    X-Query-Count and Server-Timing headers of the response, except for streaming
+    responses, whose stats are recorded once their body has been sent.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        stats = Stats()
+        token = current_stats.set(stats)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_stats.reset(token)
+        return self.process_stats(request, response, stats)
+
+    async def __acall__(self, request):
+        stats = Stats()
+        token = current_stats.set(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_stats.reset(token)
+        return self.process_stats(request, response, stats)
+
+    def process_stats(self, request, response, stats):
+        stats.name = route_name(request)
+        if response.streaming:
+            # The body is produced after the response is returned, queries included
+            if response.is_async:
+                response.streaming_content = astream(response.streaming_content, stats)
+            else:
+                response.streaming_content = stream(response.streaming_content, stats)
+            return response
+        finish_request(stats)
+        if settings.DEBUG:
+            response["X-Query-Count"] = str(stats.queries)
+            response["Server-Timing"] = (
+                f"db;dur={stats.db_time * 1000:.2f}, total;dur={stats.latency * 1000:.2f}"
+            )
+        return response
+
+
+class InstrumentedConsumerMixin:
+    """
+    Records the stats of every message a consumer handles, named after the consumer
+    and the message type unless the handler names it with name_current(), and counts
+    the connections of the consumer.
+    """
+
+    async def dispatch(self, message):
+        consumer = type(self).__name__
+        if message["type"] == "websocket.connect":
+            connects.labels(consumer).inc()
+            connections.labels(consumer).inc()
+        elif message["type"] == "websocket.disconnect":
+            disconnects.labels(consumer).inc()
+            connections.labels(consumer).dec()
+        stats = Stats(f"{consumer} {message['type']}")
+        token = current_stats.set(stats)
+        try:
+            await super().dispatch(message)
+        finally:
+            current_stats.reset(token)
+            stats.finish()
+            record(stats)
+            message_duration.labels(*stats.name.split(" ", 1)).observe(stats.latency)
@@ -0,0 +1,69 @@
+"""
+Channel layers that time their sends and count the channels this process adds to
+groups, see chess.metrics. CHANNEL_LAYERS uses them in place of the layers they extend.
+
+Group sizes are those of this process' members: the Redis layer keeps groups of
+every process, and counting them all would take a query per group.
+"""
+
+import time
+from channels.layers import InMemoryChannelLayer as BaseInMemoryChannelLayer
+from channels_redis.core import RedisChannelLayer as BaseRedisChannelLayer
+from . import metrics
+
+send_duration = metrics.Histogram(
+    "channel_layer_send_seconds", "Latency of channel layer sends.", ["method"]
+)
+# group -> channels this process added to it
+group_sizes = {}
+metrics.Distribution(
+    "channel_layer_group_size",
+    "Channels this process added to each group.",
+    lambda: [((group_kind(group),), size) for group, size in list(group_sizes.items())],
+    ["kind"],
+    buckets=(1, 2, 3, 5, 10, 20, 50, 100, 500),
+)
+
+
+def group_kind(group):
+    # Kinds rather than names keep the number of series bounded,
+    # see user_group_name() and spectator_group_name()
+    if group.startswith("user-"):
+        return "user"
+    if group.startswith("spectators."):
+        return "spectators"
+    return "game"
+
+
+class InstrumentedLayerMixin:
+    async def send(self, channel, message):
+        started_at = time.perf_counter()
+        try:
+            await super().send(channel, message)
+        finally:
+            send_duration.labels("send").observe(time.perf_counter() - started_at)
+
+    async def group_send(self, group, message):
+        started_at = time.perf_counter()
+        try:
+            await super().group_send(group, message)
+        finally:
+            send_duration.labels("group_send").observe(time.perf_counter() - started_at)
+
+    async def group_add(self, group, channel):
+        await super().group_add(group, channel)
+        group_sizes[group] = group_sizes.get(group, 0) + 1
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        size = group_sizes.pop(group, 0) - 1
+        if size > 0:
+            group_sizes[group] = size
+
+
+class InMemoryChannelLayer(InstrumentedLayerMixin, BaseInMemoryChannelLayer):
+    pass
+
+
+class RedisChannelLayer(InstrumentedLayerMixin, BaseRedisChannelLayer):
+    pass
@@ -0,0 +1,170 @@
+import functools
+from itertools import islice
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from sortedcontainers import SortedList
+
+
+class BaseLeaderboard:
+    """
+    Players of every rating category ordered by rating, best first.
+    Ranks are 0-based and every lookup costs O(log n).
+    """
+
+    def update(self, category, entries):
+        """
+        Sets the ratings of (user id, rating) entries.
+        """
+        raise NotImplementedError
+
+    def reset(self, category, entries):
+        """
+        Replaces the whole leaderboard of a category.
+        """
+        raise NotImplementedError
+
+    def size(self, category):
+        raise NotImplementedError
+
+    def top(self, category, count):
+        """
+        Returns the (user id, rating) entries of the `count` best players.
+        """
+        raise NotImplementedError
+
+    def rank(self, category, user_id):
+        """
+        Returns the rank of a player, None if the player is not ranked.
+        """
+        raise NotImplementedError
+
+    def around(self, category, user_id, count):
+        """
+        Returns the rank of the first entry and the (user id, rating) entries of
+        up to `count` players above and below a player, or None if the player is not ranked.
+        """
+        raise NotImplementedError
+
+
+class InMemoryLeaderboard(BaseLeaderboard):
+    """
+    Process-local leaderboard, loaded from the Rating table on first use of a category.
+    Only suitable for tests and single-process deployments.
+    """
+
+    def __init__(self):
+        # category -> SortedList of (-rating, user id)
+        self.boards = {}
+        # category -> {user id: rating}
+        self.ratings = {}
+
+    def board(self, category):
+        if category not in self.boards:
+            from .models import Rating
+
+            entries = Rating.objects.filter(category=category).values_list("user_id", "rating")
+            self.reset(category, entries)
+        return self.boards[category]
+
+    def update(self, category, entries):
+        board = self.board(category)
+        ratings = self.ratings[category]
+        for user_id, rating in entries:
+            if user_id in ratings:
+                board.remove((-ratings[user_id], user_id))
+            ratings[user_id] = rating
+            board.add((-rating, user_id))
+
+    def reset(self, category, entries):
+        self.ratings[category] = dict(entries)
+        self.boards[category] = SortedList(
+            (-rating, user_id) for user_id, rating in self.ratings[category].items()
+        )
+
+    def size(self, category):
+        return len(self.board(category))
+
+    def top(self, category, count):
+        return [(user_id, -rating) for rating, user_id in islice(self.board(category), count)]
+
+    def rank(self, category, user_id):
+        board = self.board(category)
+        rating = self.ratings[category].get(user_id)
+        return None if rating is None else board.index((-rating, user_id))
+
+    def around(self, category, user_id, count):
+        rank = self.rank(category, user_id)
+        if rank is None:
+            return None
+        start = max(0, rank - count)
+        entries = self.board(category)[start : rank + count + 1]
+        return start, [(user_id, -rating) for rating, user_id in entries]
+
+
+class RedisLeaderboard(BaseLeaderboard):
+    """
+    Keeps a sorted set of user ids scored by rating per category.
+    """
+
+    def __init__(self, prefix="leaderboard", **connection_kwargs):
+        import redis
+
+        self.prefix = prefix
+        self.client = redis.Redis(decode_responses=True, **connection_kwargs)
+
+    def key(self, category):
+        return f"{self.prefix}:{category}"
+
+    def update(self, category, entries):
+        mapping = dict(entries)
+        if mapping:
+            self.client.zadd(self.key(category), mapping)
+
+    def reset(self, category, entries):
+        key = self.key(category)
+        entries = iter(entries)
+        # Replaced in one MULTI/EXEC, readers never see a partial leaderboard
+        with self.client.pipeline() as pipeline:
+            pipeline.delete(key)
+            while batch := dict(islice(entries, 10000)):
+                pipeline.zadd(key, batch)
+            pipeline.execute()
+
+    def size(self, category):
+        return self.client.zcard(self.key(category))
+
+    def decode(self, entries):
+        return [(int(user_id), rating) for user_id, rating in entries]
+
+    def top(self, category, count):
+        if count <= 0:
+            return []
+        return self.decode(self.client.zrevrange(self.key(category), 0, count - 1, withscores=True))
+
+    def rank(self, category, user_id):
+        return self.client.zrevrank(self.key(category), user_id)
+
+    def around(self, category, user_id, count):
+        rank = self.rank(category, user_id)
+        if rank is None:
+            return None
+        start = max(0, rank - count)
+        entries = self.client.zrevrange(
+            self.key(category), start, rank + count, withscores=True
+        )
+        return start, self.decode(entries)
+
+
+@functools.cache
+def get_leaderboard():
+    config = settings.LEADERBOARD_STORE
+    store_class = import_string(config["BACKEND"])
+    return store_class(**config.get("OPTIONS", {}))
+
+
+@receiver(setting_changed)
+def reset_leaderboard(setting, **kwargs):
+    if setting == "LEADERBOARD_STORE":
+        get_leaderboard.cache_clear()
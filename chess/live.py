@@ -0,0 +1,229 @@
+import time
+from datetime import timedelta
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.utils import timezone
+from .clock import GameClock, timers
+from .engine import Board, Outcome, WHITE, BLACK, COLOR_NAMES
+from .events import get_event_store
+from .models import Game
+from .movelog import move_log
+from .spectators import spectate
+from .protocol import game_protocol
+from . import metrics
+
+
+class LiveGame:
+    """
+    Authoritative state of a game in progress, shared by every socket of its room
+    that is connected to this process.
+    """
+
+    def __init__(self, game_id, white_id, black_id, board=None, clock=None):
+        self.game_id = game_id
+        self.white_id = white_id
+        self.black_id = black_id
+        self.board = board or Board()
+        # None for untimed games
+        self.clock = clock
+        # Scheduled flag fall of the side to move, see arm_clock
+        self.flag_timer = None
+        # (from, to) squares of a pawn move to the last rank waiting for the promotion piece
+        self.pending_promotion = None
+        self.outcome = None
+        self.connections = 0
+
+    def color_of(self, user_id):
+        if user_id == self.white_id:
+            return WHITE
+        if user_id == self.black_id:
+            return BLACK
+        return None
+
+    def player_id(self, color):
+        return self.white_id if color == WHITE else self.black_id
+
+
+# room name -> LiveGame
+live_games = {}
+metrics.Gauge("live_games", "Games played on this process.", function=lambda: len(live_games))
+
+
+def game_id_from_room(room_name):
+    return int(room_name.rsplit("-", 1)[1])
+
+
+def game_room(game_id):
+    """
+    Room of a game, whatever prefix its sockets were opened with.
+    """
+    return f"game-{game_id}"
+
+
+@database_sync_to_async
+def load_game(game_id):
+    """
+    Builds the live game of an unfinished game, replaying its logged moves.
+    The clock of the side to move is charged for the time since the last logged move.
+    """
+    game = Game.objects.filter(pk=game_id, is_active=True).first()
+    if game is None:
+        return None
+    board = Board()
+    for code in game.move_codes():
+        board.push(board.decode_move(code))
+    clock = GameClock.from_time_control(game.time_control, turn=board.turn)
+    if clock is not None and board.ply:
+        last_moves = list(game.moves.order_by("-ply").values_list("ply", "clock", "created_at")[:2])
+        for ply, remaining, _ in last_moves:
+            if remaining is not None:
+                # Odd plies are white moves
+                clock.remaining[WHITE if ply % 2 else BLACK] = remaining
+        if last_moves:
+            elapsed = max(timedelta(0), timezone.now() - last_moves[0][2])
+            clock.running_since = time.monotonic() - elapsed.total_seconds()
+        else:
+            # Packed storage keeps no clock times, the running clock restarts
+            clock.running_since = time.monotonic()
+    return LiveGame(game.pk, game.challenger_id, game.opponent_id, board, clock)
+
+
+async def join_live_game(room_name):
+    """
+    Returns the live game of a room, loading it on first use, or None if the game
+    does not exist or is already finished.
+    """
+    live_game = live_games.get(room_name)
+    if live_game is None:
+        live_game = await load_game(game_id_from_room(room_name))
+        if live_game is None:
+            return None
+        # Another socket may have loaded the game while we were waiting for the database
+        live_game = live_games.setdefault(room_name, live_game)
+        if live_game.connections == 0:
+            arm_clock(room_name, live_game)
+    live_game.connections += 1
+    return live_game
+
+
+def leave_live_game(room_name):
+    live_game = live_games.get(room_name)
+    if live_game is None:
+        return
+    live_game.connections -= 1
+    if live_game.connections <= 0:
+        timers.cancel(live_game.flag_timer)
+        del live_games[room_name]
+
+
+def arm_clock(room_name, live_game):
+    """
+    (Re)schedules the flag fall of the side to move.
+    """
+    timers.cancel(live_game.flag_timer)
+    live_game.flag_timer = None
+    clock = live_game.clock
+    if clock is None or live_game.outcome is not None or clock.deadline() is None:
+        return
+    live_game.flag_timer = timers.schedule(clock.deadline(), on_flag_fall, room_name, live_game)
+
+
+def on_flag_fall(room_name, live_game):
+    if live_game.outcome is None and live_game.clock.is_flagged(time.monotonic()):
+        timers.loop.create_task(end_live_game(room_name, live_game, flag_outcome(live_game)))
+
+
+def flag_outcome(live_game):
+    return Outcome("timeout", live_game.board.turn ^ 1)
+
+
+async def publish(room_name, live_game, event_type, message, **event):
+    """
+    Numbers a message, keeps it for reconnecting players and sends it to the room,
+    encoded once for all of its sockets. Spectators get it with the position after it.
+    """
+    numbered = await get_event_store().aappend(live_game.game_id, message)
+    await get_channel_layer().group_send(
+        room_name,
+        {
+            "type": event_type,
+            "message": numbered,
+            "encoded": game_protocol.encode(numbered),
+            **event,
+        },
+    )
+    await spectate(room_name, live_game.game_id, {**message, "fen": live_game.board.fen()})
+
+
+async def end_live_game(room_name, live_game, outcome):
+    """
+    Stops the clock, saves the moves and the result and announces the end to the room.
+    Every process that holds the game may get here, only the one that actually
+    finishes it in the database sends the event. Returns whether this call finished it.
+    """
+    if live_game.outcome is not None:
+        return False
+    live_game.outcome = outcome
+    timers.cancel(live_game.flag_timer)
+    await move_log.flush(live_game.game_id)
+    if not await finish_live_game(live_game, outcome):
+        return False
+    now = time.monotonic()
+    await publish(
+        room_name,
+        live_game,
+        "chess.end",
+        {
+            "msg_type": "end",
+            "result": outcome.result,
+            "reason": outcome.reason,
+            "winner": None if outcome.winner is None else COLOR_NAMES[outcome.winner],
+            "clock": None if live_game.clock is None else live_game.clock.as_dict(now),
+        },
+    )
+    return True
+
+
+async def resign_live_game(game_id, color):
+    """
+    Ends a game by the resignation of `color`, through the live game of this process
+    or one loaded for the occasion, so that the players' sockets in every process
+    learn about it. Returns whether the game was still in progress.
+    """
+    room_name = game_room(game_id)
+    live_game = live_games.get(room_name) or await load_game(game_id)
+    if live_game is None:
+        return False
+    return await end_live_game(room_name, live_game, Outcome("resignation", color ^ 1))
+
+
+async def settle_game(game_id):
+    """
+    Ends a game whose result the server can already tell, on the board or on time,
+    e.g. when a player's clock shows the opponent's flag down before the flag timer
+    of the server fires. Returns the outcome, None while the game goes on.
+    """
+    room_name = game_room(game_id)
+    live_game = live_games.get(room_name) or await load_game(game_id)
+    if live_game is None:
+        return None
+    if live_game.outcome is not None:
+        return live_game.outcome
+    outcome = live_game.board.outcome()
+    if outcome is None and live_game.clock is not None:
+        if live_game.clock.is_flagged(time.monotonic()):
+            outcome = flag_outcome(live_game)
+    if outcome is not None:
+        await end_live_game(room_name, live_game, outcome)
+    return outcome
+
+
+@database_sync_to_async
+def finish_live_game(live_game, outcome):
+    game = Game.objects.select_related("challenger", "opponent").get(pk=live_game.game_id)
+    winner = None
+    if outcome.winner == WHITE:
+        winner = game.challenger
+    elif outcome.winner == BLACK:
+        winner = game.opponent
+    return game.finish(winner, timezone.now())
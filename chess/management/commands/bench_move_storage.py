@@ -0,0 +1,114 @@
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection, transaction
+from chess.models import Game, GameMove, User
+from chess.packing import pack_moves
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares storage size and read latency of row-per-move and packed move storage. "
+        "All data is created inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--games", type=int, default=1000)
+        parser.add_argument("--plies", type=int, default=80)
+        parser.add_argument("--reads", type=int, default=200)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options["games"], options["plies"], options["reads"])
+            transaction.set_rollback(True)
+
+    def run(self, game_count, plies, reads):
+        rng = random.Random(0)
+        white = User(email="white@bench.invalid", username="bench-white", password="!")
+        black = User(email="black@bench.invalid", username="bench-black", password="!")
+        User.objects.bulk_create([white, black])
+
+        # Storage size and read latency do not depend on the moves being legal
+        move_lists = [[rng.getrandbits(15) for _ in range(plies)] for _ in range(game_count)]
+
+        row_size_before = self.table_size("chess_gamemove")
+        row_games = Game.objects.bulk_create(
+            [Game(challenger=white, opponent=black) for _ in range(game_count)]
+        )
+        GameMove.objects.bulk_create(
+            [
+                GameMove(game=game, ply=ply, move=code)
+                for game, codes in zip(row_games, move_lists)
+                for ply, code in enumerate(codes, 1)
+            ],
+            batch_size=5000,
+        )
+        if row_size_before is None:
+            # Without relation sizes only the move payload itself can be reported
+            row_size = game_count * plies * 2
+        else:
+            row_size = self.table_size("chess_gamemove") - row_size_before
+
+        packed_games = Game.objects.bulk_create(
+            [
+                Game(challenger=white, opponent=black, packed_moves=pack_moves(codes))
+                for codes in move_lists
+            ]
+        )
+        packed_size = sum(len(pack_moves(codes)) for codes in move_lists)
+
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE chess_gamemove")
+                cursor.execute("ANALYZE chess_game")
+
+        sample = rng.sample(range(game_count), min(reads, game_count))
+        row_timings = self.time_reads(
+            lambda index: list(row_games[index].move_codes()), sample
+        )
+        packed_timings = self.time_reads(
+            lambda index: list(Game.objects.get(pk=packed_games[index].pk).move_codes()),
+            sample,
+        )
+
+        size_note = " (payload only)" if row_size_before is None else ""
+        self.stdout.write(f"{game_count} games x {plies} plies")
+        for name, size, timings in [
+            ("rows", row_size, row_timings),
+            ("packed", packed_size, packed_timings),
+        ]:
+            self.stdout.write(
+                f"{name}: {size / 1024:.1f} KiB ({size / game_count:.0f} B/game)"
+                f"{size_note if name == 'rows' else ''}, "
+                f"read median {statistics.median(timings):.3f}ms"
+            )
+
+    def table_size(self, table):
+        """
+        On-disk size of a table including its indexes, None if the database can't tell.
+        """
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute("SELECT pg_total_relation_size(%s)", [table])
+            elif connection.vendor == "sqlite":
+                try:
+                    cursor.execute(
+                        "SELECT SUM(pgsize) FROM dbstat WHERE name = %s OR name IN "
+                        "(SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s)",
+                        [table, table],
+                    )
+                except DatabaseError:
+                    # SQLite was built without the dbstat virtual table
+                    return None
+            else:
+                return None
+            return cursor.fetchone()[0] or 0
+
+    def time_reads(self, read, sample):
+        timings = []
+        for index in sample:
+            start = time.perf_counter()
+            read(index)
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
@@ -0,0 +1,89 @@
+import json
+import random
+import time
+from django.core.management.base import BaseCommand
+from chess.engine import Board, COLOR_NAMES, move_from_square, move_to_square, square_name
+from chess.protocol import game_protocol
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the JSON and msgpack websocket formats on the messages of a random game: "
+        "bytes per move and encode/decode time per message."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--plies", type=int, default=80)
+        parser.add_argument("--repeat", type=int, default=200)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        commands, messages = self.random_game(options["plies"], random.Random(options["seed"]))
+        formats = [
+            ("json", json.dumps, json.loads, json.dumps, json.loads),
+            (
+                "msgpack",
+                game_protocol.encode_message,
+                game_protocol.decode_message,
+                game_protocol.encode_command,
+                game_protocol.decode_command,
+            ),
+        ]
+        repeat = options["repeat"]
+        for name, encode_message, decode_message, encode_command, decode_command in formats:
+            sent = sum(len(encode_command(command)) for command in commands)
+            received = sum(len(encode_message(message)) for message in messages)
+            frames = [encode_message(message) for message in messages]
+
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for message in messages:
+                    encode_message(message)
+            encode_us = (time.perf_counter() - start) / (repeat * len(messages)) * 1e6
+
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for frame in frames:
+                    decode_message(frame)
+            decode_us = (time.perf_counter() - start) / (repeat * len(frames)) * 1e6
+
+            self.stdout.write(
+                f"{name}: {sent / len(commands):.1f} bytes per move command, "
+                f"{received / len(messages):.1f} bytes per move event, "
+                f"encode {encode_us:.2f}us, decode {decode_us:.2f}us"
+            )
+
+    def random_game(self, plies, rng):
+        board = Board()
+        commands = []
+        messages = []
+        clock = {name: 300000 for name in COLOR_NAMES}
+        timestamp = 1718000000000
+        for seq in range(1, plies + 1):
+            legal_moves = board.legal_moves()
+            if not legal_moves:
+                break
+            move = rng.choice(legal_moves)
+            player = COLOR_NAMES[board.turn]
+            timestamp += rng.randint(500, 5000)
+            clock[player] -= rng.randint(500, 5000)
+            command = {
+                "command": "move",
+                "from": square_name(move_from_square(move)),
+                "to": square_name(move_to_square(move)),
+                "timestamp": timestamp,
+            }
+            board.push(move)
+            commands.append(command)
+            messages.append(
+                {
+                    "msg_type": "move",
+                    "player": player,
+                    "from": command["from"],
+                    "to": command["to"],
+                    "timestamp": timestamp,
+                    "clock": dict(clock),
+                    "seq": seq,
+                }
+            )
+        return commands, messages
@@ -0,0 +1,77 @@
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from chess.models import User, Profile
+from chess.search import search_users
+
+BENCH_EMAIL_DOMAIN = "bench.invalid"
+SYLLABLES = ["al", "be", "chi", "da", "er", "fo", "ga", "hu", "in", "jo", "ka", "li",
+             "mo", "na", "or", "pe", "qu", "ra", "si", "to", "ul", "vi", "wa", "ye", "zo"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks user search. Optionally seeds the user table first, "
+        "e.g. --seed 1000000 to reproduce production volume."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seed", type=int, default=0, help="Number of users to create")
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--query", action="append", dest="queries")
+        parser.add_argument(
+            "--cleanup", action="store_true", help="Delete seeded users and exit"
+        )
+
+    def handle(self, *args, **options):
+        if options["cleanup"]:
+            deleted, _ = User.objects.filter(email__endswith=BENCH_EMAIL_DOMAIN).delete()
+            self.stdout.write(f"Deleted {deleted} rows.")
+            return
+        if options["seed"]:
+            self.seed(options["seed"], options["batch_size"])
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE chess_user")
+
+        # Short queries take the prefix path of search_users(), longer ones the trigram one
+        queries = options["queries"] or ["j", "jo", "kali", "morasi", "zzzz", "al"]
+        for query in queries:
+            timings = []
+            for _ in range(options["repeat"]):
+                start = time.perf_counter()
+                count = len(list(search_users(User.objects.all(), query)))
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+            self.stdout.write(
+                f"{query!r}: {count} results, median {statistics.median(timings):.2f}ms, "
+                f"p95 {p95:.2f}ms, min {timings[0]:.2f}ms"
+            )
+
+    def seed(self, total, batch_size):
+        rng = random.Random(0)
+        offset = User.objects.filter(email__endswith=BENCH_EMAIL_DOMAIN).count()
+        created = 0
+        while created < total:
+            users = []
+            for i in range(offset + created, offset + min(total, created + batch_size)):
+                name = "".join(rng.choices(SYLLABLES, k=rng.randint(2, 4)))
+                users.append(
+                    User(
+                        email=f"user{i}@{BENCH_EMAIL_DOMAIN}",
+                        username=f"{name}{i}",
+                        first_name=name.capitalize(),
+                        last_name="".join(rng.choices(SYLLABLES, k=3)).capitalize(),
+                        # Unusable password, hashing a million passwords is pointless here
+                        password="!",
+                    )
+                )
+            users = User.objects.bulk_create(users)
+            Profile.objects.bulk_create([Profile(user=user) for user in users])
+            created += len(users)
+            self.stdout.write(f"Seeded {created}/{total} users", ending="\r")
+        self.stdout.write("")
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from chess.models import FriendSuggestions, Friendship
+from chess.suggestions import load_graph, refresh_suggestions, save_suggestions
+
+
+class Command(BaseCommand):
+    help = (
+        "Precomputes friend suggestions. By default only the suggestions flagged stale by "
+        "friendship changes are refreshed, --all recomputes those of every user with friends."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", dest="full")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        refreshed = 0
+        if options["full"]:
+            graph = load_graph()
+            user_ids = sorted(graph)
+            for start in range(0, len(user_ids), batch_size):
+                refreshed += len(save_suggestions(user_ids[start : start + batch_size], graph))
+            # Users without friends left have nothing in common with anybody
+            FriendSuggestions.objects.exclude(
+                user__in=Friendship.objects.values("user")
+            ).delete()
+        else:
+            stale = list(
+                FriendSuggestions.objects.filter(is_stale=True).values_list("user_id", flat=True)
+            )
+            for start in range(0, len(stale), batch_size):
+                refreshed += len(refresh_suggestions(stale[start : start + batch_size]))
+        self.stdout.write(self.style.SUCCESS(f"Refreshed the suggestions of {refreshed} users."))
@@ -0,0 +1,72 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from chess.engine import Board, move_to_uci
+from chess.perft import REFERENCE_POSITIONS, divide, perft
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs perft on the reference positions, reports nodes per second "
+        "and fails on any node count mismatch."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--depth", type=int, default=3)
+        parser.add_argument(
+            "--position",
+            action="append",
+            dest="positions",
+            choices=[name for name, _, _ in REFERENCE_POSITIONS],
+        )
+        parser.add_argument("--fen", help="Run a custom position instead")
+        parser.add_argument("--expected", type=int, help="Expected node count for --fen")
+        parser.add_argument(
+            "--divide", action="store_true", help="Print node counts per root move"
+        )
+
+    def handle(self, *args, **options):
+        depth = options["depth"]
+        if depth < 1:
+            raise CommandError("--depth must be at least 1")
+        if options["fen"]:
+            expected = [None] * (depth - 1) + [options["expected"]]
+            positions = [("custom", options["fen"], expected)]
+        else:
+            selected = options["positions"]
+            positions = [
+                position
+                for position in REFERENCE_POSITIONS
+                if not selected or position[0] in selected
+            ]
+
+        mismatches = []
+        total_nodes = 0
+        total_time = 0
+        for name, fen, counts in positions:
+            board = Board(fen)
+            position_depth = min(depth, len(counts))
+            start = time.perf_counter()
+            nodes = perft(board, position_depth)
+            elapsed = time.perf_counter() - start
+            total_nodes += nodes
+            total_time += elapsed
+            expected = counts[position_depth - 1]
+            status = "ok" if expected in (None, nodes) else f"MISMATCH, expected {expected}"
+            self.stdout.write(
+                f"{name} depth {position_depth}: {nodes} nodes in {elapsed:.3f}s, "
+                f"{nodes / max(elapsed, 1e-9):,.0f} nps ({status})"
+            )
+            if options["divide"]:
+                for move, count in sorted(
+                    divide(board, position_depth).items(), key=lambda item: move_to_uci(item[0])
+                ):
+                    self.stdout.write(f"  {move_to_uci(move)}: {count}")
+            if expected not in (None, nodes):
+                mismatches.append(name)
+
+        self.stdout.write(
+            f"Total: {total_nodes} nodes in {total_time:.3f}s, "
+            f"{total_nodes / max(total_time, 1e-9):,.0f} nps"
+        )
+        if mismatches:
+            raise CommandError(f"Node count mismatch in: {', '.join(mismatches)}")
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from chess.leaderboard import get_leaderboard
+from chess.models import Rating
+from chess.ratings import CATEGORIES
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the leaderboards of every rating category from the Rating table."
+
+    def handle(self, *args, **options):
+        rebuild_leaderboards()
+        self.stdout.write(self.style.SUCCESS("Rebuilt the leaderboards."))
+
+
+def rebuild_leaderboards():
+    board = get_leaderboard()
+    for category in CATEGORIES:
+        entries = Rating.objects.filter(category=category).values_list("user_id", "rating")
+        board.reset(category, entries.iterator(chunk_size=10000))
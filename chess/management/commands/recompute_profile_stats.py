@@ -0,0 +1,84 @@
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, Q
+from chess.models import Game, Profile
+
+
+def count_results(games, side):
+    """
+    Returns {user id: [wins, losses, draws]} of the players on one side of `games`.
+    """
+    stats = defaultdict(lambda: [0, 0, 0])
+    rows = games.values(side).annotate(
+        total=Count("pk"),
+        wins=Count("pk", filter=Q(winner=F(side))),
+        draws=Count("pk", filter=Q(winner__isnull=True)),
+    )
+    for row in rows:
+        counters = stats[row[side]]
+        counters[0] += row["wins"]
+        counters[1] += row["total"] - row["wins"] - row["draws"]
+        counters[2] += row["draws"]
+    return stats
+
+
+def profile_results(user_id):
+    finished = Game.objects.filter(is_active=False).order_by()
+    results = [0, 0, 0]
+    for side in ("challenger", "opponent"):
+        counters = count_results(finished.filter(**{side: user_id}), side)[user_id]
+        results = [total + count for total, count in zip(results, counters)]
+    return tuple(results)
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes win/loss/draw counters of all profiles from finished games. "
+        "Safe to run while games finish."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        # Counts of one unlocked snapshot only pick the profiles to check
+        stats = defaultdict(lambda: [0, 0, 0])
+        finished = Game.objects.filter(is_active=False).order_by()
+        for side in ("challenger", "opponent"):
+            for user_id, counters in count_results(finished, side).items():
+                stats[user_id] = [total + count for total, count in zip(stats[user_id], counters)]
+
+        suspects = []
+        profiles = Profile.objects.only("win_count", "loss_count", "draw_count")
+        for profile in profiles.iterator(chunk_size=batch_size):
+            current = (profile.win_count, profile.loss_count, profile.draw_count)
+            if current != tuple(stats.get(profile.pk, (0, 0, 0))):
+                suspects.append(profile.pk)
+
+        updated = sum(self.recompute(user_id) for user_id in suspects)
+        self.stdout.write(self.style.SUCCESS(f"Updated {updated} profiles."))
+
+    def recompute(self, user_id):
+        """
+        Counts and writes the results of one profile while holding its row lock.
+        Game.finish() increments the counters under the same lock: a game finishing
+        meanwhile is either counted here or incremented after this transaction commits.
+        One row is locked at a time, so the command cannot deadlock with finishes.
+        """
+        with transaction.atomic():
+            profile = (
+                Profile.objects.select_for_update()
+                .only("win_count", "loss_count", "draw_count")
+                .filter(pk=user_id)
+                .first()
+            )
+            if profile is None:
+                return False
+            results = profile_results(user_id)
+            if results == (profile.win_count, profile.loss_count, profile.draw_count):
+                return False
+            profile.win_count, profile.loss_count, profile.draw_count = results
+            profile.save(update_fields=["win_count", "loss_count", "draw_count"])
+        return True
@@ -0,0 +1,118 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from chess.models import Game, Rating, RatingHistory
+from .rebuild_leaderboard import rebuild_leaderboards
+from chess.ratings import (
+    DEFAULT_RATING,
+    DEFAULT_DEVIATION,
+    DEFAULT_VOLATILITY,
+    rate_game,
+    time_control_category,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes all ratings and the rating history by replaying finished games "
+        "in chronological order, e.g. after changing the rating formula. Games that "
+        "finish during the run wait for it to end, run it in a quiet window."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        # (user id, category) -> [rating, deviation, volatility, games, updated_at]
+        players = {}
+        history = []
+        replayed = 0
+        games = (
+            Game.objects.filter(is_active=False, finished_at__isnull=False)
+            .order_by("finished_at", "id")
+            .values_list(
+                "pk", "challenger_id", "opponent_id", "winner", "time_control", "finished_at"
+            )
+        )
+        with transaction.atomic():
+            self.lock_ratings()
+            RatingHistory.objects.all().delete()
+            for game_id, white_id, black_id, winner, time_control, finished_at in games.iterator(
+                chunk_size=batch_size
+            ):
+                category = time_control_category(time_control)
+                white = players.setdefault(
+                    (white_id, category),
+                    [DEFAULT_RATING, DEFAULT_DEVIATION, DEFAULT_VOLATILITY, 0, None],
+                )
+                black = players.setdefault(
+                    (black_id, category),
+                    [DEFAULT_RATING, DEFAULT_DEVIATION, DEFAULT_VOLATILITY, 0, None],
+                )
+                if winner is None:
+                    score = 0.5
+                else:
+                    score = 1.0 if winner == white_id else 0.0
+                new_ratings = rate_game(tuple(white[:3]), tuple(black[:3]), score)
+                for user_id, player, rating in zip((white_id, black_id), (white, black), new_ratings):
+                    player[:3] = rating
+                    player[3] += 1
+                    player[4] = finished_at
+                    history.append(
+                        RatingHistory(
+                            user_id=user_id,
+                            game_id=game_id,
+                            category=category,
+                            rating=rating[0],
+                            deviation=rating[1],
+                            created_at=finished_at,
+                        )
+                    )
+                replayed += 1
+                if len(history) >= batch_size:
+                    RatingHistory.objects.bulk_create(history)
+                    history = []
+            RatingHistory.objects.bulk_create(history)
+
+            Rating.objects.all().delete()
+            Rating.objects.bulk_create(
+                [
+                    Rating(
+                        user_id=user_id,
+                        category=category,
+                        rating=rating,
+                        deviation=deviation,
+                        volatility=volatility,
+                        games=count,
+                        updated_at=updated_at,
+                    )
+                    for (user_id, category), (
+                        rating,
+                        deviation,
+                        volatility,
+                        count,
+                        updated_at,
+                    ) in players.items()
+                ],
+                batch_size=batch_size,
+            )
+            transaction.on_commit(rebuild_leaderboards)
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Replayed {replayed} games into {len(players)} ratings.")
+        )
+
+    def lock_ratings(self):
+        """
+        Blocks Rating.record_game() until the rebuilt ratings are committed. The games
+        are read after the lock is granted: a game whose finish committed before is
+        replayed, one that finishes later is rated on top of the rebuilt ratings.
+        SQLite lets a single transaction write at a time already.
+        """
+        if connection.vendor != "postgresql":
+            return
+        tables = ", ".join(
+            connection.ops.quote_name(model._meta.db_table) for model in (Rating, RatingHistory)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(f"LOCK TABLE {tables} IN EXCLUSIVE MODE")
@@ -0,0 +1,254 @@
+import asyncio
+import random
+import time
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils import timezone
+from sortedcontainers import SortedList
+from .models import Game, Rating
+from .presence import user_group_name
+from .ratings import DEFAULT_RATING, time_control_category
+
+
+async def player_rating(user_id, time_control):
+    rating = await (
+        Rating.objects.filter(user_id=user_id, category=time_control_category(time_control))
+        .values_list("rating", flat=True)
+        .afirst()
+    )
+    return DEFAULT_RATING if rating is None else rating
+
+
+def playing(user_ids):
+    """
+    Returns the ids among `user_ids` of players who have a game in progress,
+    each side read from its partial index like Profile.is_playing().
+    """
+    active = Game.objects.filter(is_active=True)
+    return set(
+        active.filter(challenger_id__in=user_ids)
+        .values_list("challenger_id", flat=True)
+        .union(
+            active.filter(opponent_id__in=user_ids).values_list("opponent_id", flat=True),
+            all=True,
+        )
+    )
+
+
+async def is_playing(user_id):
+    return bool(await database_sync_to_async(playing)([user_id]))
+
+
+class Ticket:
+    __slots__ = ("user_id", "username", "channel_name", "rating", "joined_at")
+
+    def __init__(self, user_id, username, channel_name, rating, joined_at=None):
+        self.user_id = user_id
+        self.username = username
+        # Socket that queued the player, the ticket is dropped when it disconnects
+        self.channel_name = channel_name
+        self.rating = rating
+        self.joined_at = time.monotonic() if joined_at is None else joined_at
+
+    @property
+    def key(self):
+        return (self.rating, self.joined_at, self.user_id)
+
+
+def rating_window(waited):
+    """
+    Largest rating difference a player accepts after waiting `waited` seconds.
+    """
+    return min(
+        settings.MATCHMAKING_MAX_WINDOW,
+        settings.MATCHMAKING_INITIAL_WINDOW + settings.MATCHMAKING_WINDOW_GROWTH * waited,
+    )
+
+
+class MatchmakingQueue:
+    """
+    Players waiting for a game of one time control, sorted by rating.
+    """
+
+    def __init__(self):
+        self.by_rating = SortedList()
+        # user id -> Ticket, in the order players joined
+        self.tickets = {}
+
+    def __len__(self):
+        return len(self.tickets)
+
+    def add(self, ticket):
+        self.remove(ticket.user_id)
+        self.tickets[ticket.user_id] = ticket
+        self.by_rating.add(ticket.key)
+
+    def remove(self, user_id):
+        ticket = self.tickets.pop(user_id, None)
+        if ticket is not None:
+            self.by_rating.remove(ticket.key)
+        return ticket
+
+    def closest(self, ticket):
+        """
+        Returns the waiting player whose rating is the closest to the ticket's.
+        """
+        index = self.by_rating.index(ticket.key)
+        best = None
+        for neighbour in (index - 1, index + 1):
+            if 0 <= neighbour < len(self.by_rating):
+                key = self.by_rating[neighbour]
+                if best is None or abs(key[0] - ticket.rating) < abs(best[0] - ticket.rating):
+                    best = key
+        return None if best is None else self.tickets[best[2]]
+
+    def pairs(self, now):
+        """
+        Removes and returns pairs of players, longest waiting first, each paired with
+        the closest rated player within its rating window. Costs O(log n) per player.
+        """
+        pairs = []
+        for ticket in list(self.tickets.values()):
+            if ticket.user_id not in self.tickets:
+                # Already paired with a player who waited longer
+                continue
+            opponent = self.closest(ticket)
+            if opponent is None:
+                break
+            if abs(opponent.rating - ticket.rating) > rating_window(now - ticket.joined_at):
+                continue
+            self.remove(ticket.user_id)
+            self.remove(opponent.user_id)
+            pairs.append((ticket, opponent))
+        return pairs
+
+
+class Matchmaker:
+    """
+    Queues of every time control of this process, paired by a single background task
+    every MATCHMAKING_INTERVAL seconds while anybody is waiting. Games of a pass are
+    created with one bulk insert and both players are notified concurrently.
+    """
+
+    def __init__(self):
+        # time control -> MatchmakingQueue
+        self.queues = {}
+        # user id -> time control the user is queued for
+        self.queued = {}
+        self.task = None
+
+    def join(self, ticket, time_control):
+        self.leave(ticket.user_id)
+        self.queues.setdefault(time_control, MatchmakingQueue()).add(ticket)
+        self.queued[ticket.user_id] = time_control
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+
+    def leave(self, user_id, channel_name=None):
+        """
+        Removes a player from the queue, only if it was queued from `channel_name` when given.
+        """
+        time_control = self.queued.get(user_id)
+        if time_control is None:
+            return False
+        queue = self.queues[time_control]
+        if channel_name is not None and queue.tickets[user_id].channel_name != channel_name:
+            return False
+        queue.remove(user_id)
+        del self.queued[user_id]
+        if not queue:
+            del self.queues[time_control]
+        return True
+
+    async def run(self):
+        while self.queued:
+            await asyncio.sleep(settings.MATCHMAKING_INTERVAL)
+            await self.pair()
+
+    async def pair(self):
+        """
+        Runs a pairing pass and returns the games it started.
+        """
+        now = time.monotonic()
+        matches = []
+        for time_control, queue in list(self.queues.items()):
+            for ticket, opponent in queue.pairs(now):
+                del self.queued[ticket.user_id]
+                del self.queued[opponent.user_id]
+                # Colors are drawn at random, the pair order favours the longest waiting player
+                if random.random() < 0.5:
+                    ticket, opponent = opponent, ticket
+                matches.append((time_control, ticket, opponent))
+            if not queue:
+                del self.queues[time_control]
+        if not matches:
+            return []
+        try:
+            games, busy = await database_sync_to_async(self.create_games)(matches)
+        except DatabaseError:
+            for time_control, white, black in matches:
+                self.requeue(time_control, white, black)
+            return []
+        started = []
+        for time_control, white, black in matches:
+            if white.user_id in busy or black.user_id in busy:
+                # Started a game some other way while queued, the partner waits on
+                free = [ticket for ticket in (white, black) if ticket.user_id not in busy]
+                self.requeue(time_control, *free)
+            else:
+                started.append((time_control, white, black))
+        matches = started
+        channel_layer = get_channel_layer()
+        await asyncio.gather(
+            *(
+                channel_layer.group_send(user_group_name(user_id), {"type": "on.queue.left"})
+                for user_id in busy
+            ),
+            *(
+                channel_layer.group_send(
+                    user_group_name(player.user_id),
+                    {
+                        "type": "on.match",
+                        "game_id": game.pk,
+                        "color": color,
+                        "time_control": time_control,
+                        "opponent": {"id": opponent.user_id, "username": opponent.username},
+                    },
+                )
+                for game, (time_control, white, black) in zip(games, matches)
+                for player, opponent, color in ((white, black, "white"), (black, white, "black"))
+            )
+        )
+        return games
+
+    def requeue(self, time_control, *tickets):
+        for ticket in tickets:
+            if ticket.user_id not in self.queued:
+                self.queues.setdefault(time_control, MatchmakingQueue()).add(ticket)
+                self.queued[ticket.user_id] = time_control
+
+    def create_games(self, matches):
+        """
+        Creates the games of the matches whose players are not already playing, returns
+        them in the order of those matches and the ids of the players who are.
+        """
+        busy = playing([ticket.user_id for _, white, black in matches for ticket in (white, black)])
+        now = timezone.now()
+        games = Game.objects.bulk_create(
+            [
+                Game(
+                    challenger_id=white.user_id,
+                    opponent_id=black.user_id,
+                    time_control=time_control,
+                    started_at=now,
+                )
+                for time_control, white, black in matches
+                if white.user_id not in busy and black.user_id not in busy
+            ]
+        )
+        return games, busy
+
+matchmaker = Matchmaker()
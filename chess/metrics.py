@@ -0,0 +1,187 @@
+"""
+Process-local metrics, exported in the Prometheus text format by the metrics view.
+
+Ad-hoc counters are keyed by name and labels. Metrics on hot paths are declared
+once with their label names, and callers keep the child of a set of label values,
+so an observation is a dict lookup and a few additions. Updates take no lock: a
+rare lost update under concurrent threads is an accepted cost of that.
+"""
+
+import collections
+from bisect import bisect_left
+
+counters = collections.Counter()
+# Declared metrics, in the order they are exported
+registry = []
+
+# Upper bounds in seconds of the buckets of latency histograms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def increment(name, amount=1, **labels):
+    counters[name, tuple(sorted(labels.items()))] += amount
+
+
+def value(name, **labels):
+    return counters[name, tuple(sorted(labels.items()))]
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        registry.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.make_child()
+        return child
+
+    def make_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        """
+        Yields (suffix, labels dict, value) of every series.
+        """
+        raise NotImplementedError
+
+
+class CounterValue:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def make_child(self):
+        return CounterValue()
+
+    def samples(self):
+        for values, child in self.children.items():
+            yield "_total", dict(zip(self.labelnames, values)), child.value
+
+
+class GaugeValue(CounterValue):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, or that `function` reads when metrics are exported.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def make_child(self):
+        return GaugeValue()
+
+    def samples(self):
+        if self.function is not None:
+            yield "", {}, self.function()
+        for values, child in self.children.items():
+            yield "", dict(zip(self.labelnames, values)), child.value
+
+
+class HistogramValue:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # The last count is of values above every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def make_child(self):
+        return HistogramValue(self.buckets)
+
+    def samples(self):
+        for values, child in self.children.items():
+            labels = dict(zip(self.labelnames, values))
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), child.counts):
+                total += count
+                yield "_bucket", {**labels, "le": str(bound)}, total
+            yield "_sum", labels, child.sum
+            yield "_count", labels, total
+
+
+class Distribution(Histogram):
+    """
+    A histogram of values read when metrics are exported: `function` returns
+    (label values, value) pairs, e.g. the sizes of the items of a collection.
+    """
+
+    def __init__(self, name, documentation, function, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames, buckets)
+        self.function = function
+
+    def samples(self):
+        self.children = {}
+        for values, value in self.function():
+            self.labels(*values).observe(value)
+        yield from super().samples()
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_sample(name, labels, value):
+    if labels:
+        pairs = ",".join(f'{key}="{escape(label)}"' for key, label in labels.items())
+        name = f"{name}{{{pairs}}}"
+    return f"{name} {value}"
+
+
+def render():
+    """
+    Returns every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for suffix, labels, sample in metric.samples():
+            lines.append(format_sample(metric.name + suffix, labels, sample))
+    by_name = {}
+    for (name, labels), count in sorted(counters.items()):
+        by_name.setdefault(name, []).append((dict(labels), count))
+    for name, series in by_name.items():
+        lines.append(f"# TYPE {name} counter")
+        for labels, count in series:
+            lines.append(format_sample(f"{name}_total", labels, count))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.6 on 2026-10-18 04:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess', '0019_alter_game_finished_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='draw_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='loss_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='win_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
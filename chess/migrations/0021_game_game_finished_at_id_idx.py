@@ -0,0 +1,17 @@
+# Generated by Django 5.0.6 on 2026-10-18 04:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess', '0020_profile_draw_count_profile_loss_count_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['-finished_at', '-id'], name='game_finished_at_id_idx'),
+        ),
+    ]
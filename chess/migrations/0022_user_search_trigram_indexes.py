@@ -0,0 +1,37 @@
+# Generated by Django 5.0.6 on 2026-10-18 05:10
+
+from django.db import migrations
+
+
+SEARCH_COLUMNS = ["username", "first_name", "last_name"]
+
+
+def create_trigram_indexes(apps, schema_editor):
+    # SQLite has no trigram indexes, search falls back to a plain scan there
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for column in SEARCH_COLUMNS:
+        schema_editor.execute(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS chess_user_{column}_trgm "
+            f"ON chess_user USING gin (UPPER({column}::text) gin_trgm_ops)"
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for column in SEARCH_COLUMNS:
+        schema_editor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS chess_user_{column}_trgm")
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('chess', '0021_game_game_finished_at_id_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 5.0.6 on 2026-10-18 04:08
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess', '0022_user_search_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='UserChannel',
+        ),
+    ]
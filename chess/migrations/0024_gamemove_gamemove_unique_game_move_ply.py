@@ -0,0 +1,30 @@
+# Generated by Django 5.0.6 on 2026-10-18 04:17
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess', '0023_delete_userchannel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameMove',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ply', models.PositiveSmallIntegerField()),
+                ('move', models.PositiveSmallIntegerField()),
+                ('clock', models.PositiveIntegerField(null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='moves', to='chess.game')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='gamemove',
+            constraint=models.UniqueConstraint(fields=('game', 'ply'), name='unique_game_move_ply'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 04:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess', '0024_gamemove_gamemove_unique_game_move_ply'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='packed_moves',
+            field=models.BinaryField(default=b''),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.6 on 2026-10-18 04:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess', '0025_game_packed_moves'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='time_control',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='gamerequest',
+            name='time_control',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+    ]
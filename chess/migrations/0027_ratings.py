@@ -0,0 +1,49 @@
+# Generated by Django 5.0.6 on 2026-10-18 04:36
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess', '0026_game_time_control'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Rating',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(choices=[('bullet', 'bullet'), ('blitz', 'blitz'), ('rapid', 'rapid'), ('classical', 'classical'), ('correspondence', 'correspondence')], max_length=16)),
+                ('rating', models.FloatField(default=1500.0)),
+                ('deviation', models.FloatField(default=350.0)),
+                ('volatility', models.FloatField(default=0.06)),
+                ('games', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ratings', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RatingHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(choices=[('bullet', 'bullet'), ('blitz', 'blitz'), ('rapid', 'rapid'), ('classical', 'classical'), ('correspondence', 'correspondence')], max_length=16)),
+                ('rating', models.FloatField()),
+                ('deviation', models.FloatField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rating_changes', to='chess.game')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rating_history', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='rating',
+            constraint=models.UniqueConstraint(fields=('user', 'category'), name='unique_user_rating_category'),
+        ),
+        migrations.AddIndex(
+            model_name='ratinghistory',
+            index=models.Index(fields=['user', 'category', '-created_at'], name='rating_history_user_idx'),
+        ),
+    ]
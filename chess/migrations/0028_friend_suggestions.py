@@ -0,0 +1,28 @@
+# Generated by Django 5.0.6 on 2026-10-18 05:01
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess', '0027_ratings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FriendSuggestions',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='friend_suggestions', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('candidates', models.BinaryField(default=b'')),
+                ('is_stale', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('is_stale', True)), fields=['user'], name='friend_suggestions_stale_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.0.6 on 2026-10-18 05:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess', '0028_friend_suggestions'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(condition=models.Q(('is_active', False)), fields=['challenger', '-finished_at', '-id'], name='game_challenger_history_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(condition=models.Q(('is_active', False)), fields=['opponent', '-finished_at', '-id'], name='game_opponent_history_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['challenger'], name='game_challenger_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['opponent'], name='game_opponent_active_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.6 on 2026-10-18 06:10
+
+from django.db import migrations
+
+
+def create_prefix_index(apps, schema_editor):
+    # Serves search queries too short for the trigram indexes, see chess.search.username_key
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS chess_user_username_upper_c "
+        'ON chess_user ((UPPER(username::text) COLLATE "C"))'
+    )
+
+
+def drop_prefix_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("DROP INDEX CONCURRENTLY IF EXISTS chess_user_username_upper_c")
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('chess', '0029_game_history_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_prefix_index, drop_prefix_index),
+    ]
@@ -1,5 +1,5 @@
-from django.db import models
-from django.db.models import Q
+from django.db import connection, models, transaction
+from django.db.models import Q, F
 from django.contrib.auth.models import (
     AbstractBaseUser,
     PermissionsMixin,
@@ -7,6 +7,11 @@ from django.contrib.auth.models import (
 )
 from django.utils import timezone
 from django.conf import settings
+from .packing import PackedMoves
+from . import ratings
+from .leaderboard import get_leaderboard
+from .friends import invalidate_friend_ids
+from .suggestions import mark_suggestions_stale
 
 
 # Create your models here.
@@ -57,27 +62,74 @@ class User(AbstractBaseUser, PermissionsMixin):
         return self.is_admin
 
 
+def finished_before(finished_at, pk):
+    """
+    Matches the games after the (finished_at, id) position in game history order.
+    """
+    return Q(finished_at__lt=finished_at) | Q(finished_at=finished_at, pk__lt=pk)
+
+
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
     avatar = models.URLField(null=True)
+    win_count = models.PositiveIntegerField(default=0)
+    loss_count = models.PositiveIntegerField(default=0)
+    draw_count = models.PositiveIntegerField(default=0)
 
     def is_playing(self):
-        return Game.objects.filter(Q(challenger=self.user) | Q(opponent=self.user), is_active=True).exists()
+        active = Game.objects.filter(is_active=True).values("pk")
+        return (
+            active.filter(challenger=self.user)
+            .union(active.filter(opponent=self.user), all=True)
+            .exists()
+        )
 
-    def games(self):
-        return Game.objects.filter(Q(challenger=self.user) | Q(opponent=self.user), is_active=False).order_by("-finished_at")
+    def games(self, before=None, limit=None):
+        """
+        Returns the user's finished games, most recent first.
+        Postgres cannot serve `challenger = u OR opponent = u` from an index, so the ids
+        are the UNION ALL of the games on each side, each read from its own partial index.
+        `before` is the (finished_at, id) position of the game to continue after and
+        `limit` bounds each side where the database allows it, see GameCursorPagination.
+        """
+        sides = [
+            Game.objects.filter(challenger=self.user, is_active=False),
+            Game.objects.filter(opponent=self.user, is_active=False).exclude(challenger=self.user),
+        ]
+        if before is not None or limit is not None:
+            sides = [side.filter(finished_at__isnull=False) for side in sides]
+        if before is not None:
+            sides = [side.filter(finished_before(*before)) for side in sides]
+        if limit is not None and connection.features.supports_slicing_ordering_in_compound:
+            sides = [side.order_by(*Game.HISTORY_ORDERING)[:limit] for side in sides]
+        ids = sides[0].values("pk").union(sides[1].values("pk"), all=True)
+        return (
+            Game.objects.filter(pk__in=ids)
+            .select_related("challenger__profile", "opponent__profile")
+            .order_by(*Game.HISTORY_ORDERING)
+        )
 
     def wins(self):
-        user_games = self.games()
-        return user_games.filter(winner=self.user.pk).count()
+        return self.win_count
 
     def losses(self):
-        user_games = self.games()
-        return user_games.exclude(winner=self.user.pk).count()
+        return self.loss_count
 
     def draws(self):
-        user_games = self.games()
-        return user_games.filter(winner=None).count()
+        return self.draw_count
+
+    @staticmethod
+    def record_result(game):
+        """
+        Increments the counters of both players of a finished game.
+        Must run in the same transaction that finishes the game.
+        """
+        players = Profile.objects.filter(pk__in=[game.challenger_id, game.opponent_id])
+        if game.winner is None:
+            players.update(draw_count=F("draw_count") + 1)
+            return
+        players.filter(pk=game.winner).update(win_count=F("win_count") + 1)
+        players.exclude(pk=game.winner).update(loss_count=F("loss_count") + 1)
 
 
 class Friendship(models.Model):
@@ -97,6 +149,32 @@ class Friendship(models.Model):
         """
         self.delete()
         self.friend.friends.remove(self.user)
+        invalidate_friend_ids(self.user_id, self.friend_id)
+        mark_suggestions_stale(self.user_id, self.friend_id)
+
+
+class FriendSuggestions(models.Model):
+    """
+    Ranked friend suggestions of a user, see chess.suggestions.
+    Stale suggestions are still served until the next refresh.
+    """
+
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="friend_suggestions",
+    )
+    candidates = models.BinaryField(default=b"")
+    is_stale = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["user"], condition=Q(is_stale=True), name="friend_suggestions_stale_idx"
+            ),
+        ]
 
 
 class FriendRequest(models.Model):
@@ -123,6 +201,8 @@ class FriendRequest(models.Model):
         self.receiver.friends.add(self.sender)
         self.is_active = False
         self.save()
+        invalidate_friend_ids(self.sender_id, self.receiver_id)
+        mark_suggestions_stale(self.sender_id, self.receiver_id)
 
     def decline(self):
         """
@@ -144,12 +224,184 @@ class Game(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
     started_at = models.DateTimeField(null=True)
     finished_at = models.DateTimeField(null=True)
+    # "<minutes>+<increment seconds>", empty for untimed games, see chess.clock
+    time_control = models.CharField(max_length=16, blank=True, default="")
+    # Moves packed at 16 bits per ply, used instead of GameMove rows when MOVE_STORAGE is "packed"
+    packed_moves = models.BinaryField(default=b"")
+
+    HISTORY_ORDERING = ("-finished_at", "-id")
+
+    class Meta:
+        indexes = [
+            # Serves keyset pagination of game history, see GameCursorPagination
+            models.Index(fields=["-finished_at", "-id"], name="game_finished_at_id_idx"),
+            # Serve each side of Profile.games() and Profile.is_playing()
+            models.Index(
+                fields=["challenger", "-finished_at", "-id"],
+                condition=Q(is_active=False),
+                name="game_challenger_history_idx",
+            ),
+            models.Index(
+                fields=["opponent", "-finished_at", "-id"],
+                condition=Q(is_active=False),
+                name="game_opponent_history_idx",
+            ),
+            models.Index(
+                fields=["challenger"], condition=Q(is_active=True), name="game_challenger_active_idx"
+            ),
+            models.Index(
+                fields=["opponent"], condition=Q(is_active=True), name="game_opponent_active_idx"
+            ),
+        ]
 
     def finish(self, winner, finished_at):
-        self.is_active = False
-        self.finished_at = finished_at
-        self.winner = winner.pk
-        self.save()
+        """
+        Finishes the game and updates players' win/loss/draw counters atomically.
+        A game that has already been finished is left untouched, so results are never counted twice.
+        Returns whether this call finished the game.
+        """
+        with transaction.atomic():
+            is_active = (
+                Game.objects.select_for_update()
+                .filter(pk=self.pk)
+                .values_list("is_active", flat=True)
+                .first()
+            )
+            if not is_active:
+                return False
+            self.is_active = False
+            self.finished_at = finished_at
+            self.winner = winner.pk if winner else None
+            self.save()
+            Profile.record_result(self)
+            Rating.record_game(self)
+        return True
+
+    def move_codes(self):
+        """
+        Compact codes of the game's moves in play order, from whichever storage holds them.
+        """
+        if self.packed_moves:
+            return PackedMoves(self.packed_moves)
+        if "moves" in getattr(self, "_prefetched_objects_cache", {}):
+            return [move.move for move in sorted(self.moves.all(), key=lambda move: move.ply)]
+        return list(self.moves.order_by("ply").values_list("move", flat=True))
+
+
+class GameMove(models.Model):
+    """
+    One ply of a game. Rows are written in batches by chess.movelog.MoveLogBuffer.
+    """
+
+    game = models.ForeignKey(Game, on_delete=models.CASCADE, related_name="moves")
+    ply = models.PositiveSmallIntegerField()
+    # 16-bit move code, see chess.engine.compact_move
+    move = models.PositiveSmallIntegerField()
+    # Remaining time of the moving player in milliseconds
+    clock = models.PositiveIntegerField(null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["game", "ply"], name="unique_game_move_ply"),
+        ]
+
+
+class Rating(models.Model):
+    """
+    Glicko-2 rating of a user in one rating category, see chess.ratings.
+    """
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="ratings"
+    )
+    category = models.CharField(max_length=16, choices=[(c, c) for c in ratings.CATEGORIES])
+    rating = models.FloatField(default=ratings.DEFAULT_RATING)
+    deviation = models.FloatField(default=ratings.DEFAULT_DEVIATION)
+    volatility = models.FloatField(default=ratings.DEFAULT_VOLATILITY)
+    games = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "category"], name="unique_user_rating_category"),
+        ]
+
+    @staticmethod
+    def record_game(game):
+        """
+        Rates both players of a finished game and records their new ratings in their history.
+        Must run in the same transaction that finishes the game.
+        """
+        category = ratings.time_control_category(game.time_control)
+        player_ids = [game.challenger_id, game.opponent_id]
+        Rating.objects.bulk_create(
+            [Rating(user_id=user_id, category=category) for user_id in player_ids],
+            ignore_conflicts=True,
+        )
+        # Rows are locked in a fixed order so that concurrent finishes cannot deadlock
+        players = {
+            rating.user_id: rating
+            for rating in Rating.objects.select_for_update()
+            .filter(user_id__in=player_ids, category=category)
+            .order_by("user_id")
+        }
+        white, black = players[game.challenger_id], players[game.opponent_id]
+        if game.winner is None:
+            score = 0.5
+        else:
+            score = 1.0 if game.winner == game.challenger_id else 0.0
+        new_ratings = ratings.rate_game(
+            (white.rating, white.deviation, white.volatility),
+            (black.rating, black.deviation, black.volatility),
+            score,
+        )
+        for player, (rating, deviation, volatility) in zip((white, black), new_ratings):
+            player.rating = rating
+            player.deviation = deviation
+            player.volatility = volatility
+            player.games += 1
+            player.updated_at = game.finished_at
+        Rating.objects.bulk_update(
+            [white, black], ["rating", "deviation", "volatility", "games", "updated_at"]
+        )
+        entries = [(player.user_id, player.rating) for player in (white, black)]
+        transaction.on_commit(lambda: get_leaderboard().update(category, entries))
+        RatingHistory.objects.bulk_create(
+            [
+                RatingHistory(
+                    user_id=player.user_id,
+                    game=game,
+                    category=category,
+                    rating=player.rating,
+                    deviation=player.deviation,
+                    created_at=game.finished_at,
+                )
+                for player in (white, black)
+            ]
+        )
+
+
+class RatingHistory(models.Model):
+    """
+    Rating of a player after each rated game.
+    """
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="rating_history"
+    )
+    game = models.ForeignKey(Game, on_delete=models.CASCADE, related_name="rating_changes")
+    category = models.CharField(max_length=16, choices=[(c, c) for c in ratings.CATEGORIES])
+    rating = models.FloatField()
+    deviation = models.FloatField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["user", "category", "-created_at"], name="rating_history_user_idx"
+            ),
+        ]
 
 
 class GameRequest(models.Model):
@@ -161,9 +413,5 @@ class GameRequest(models.Model):
     )
     is_accepted = models.BooleanField(default=False)
     is_active = models.BooleanField(default=True)
+    time_control = models.CharField(max_length=16, blank=True, default="")
     created_at = models.DateTimeField(default=timezone.now)
-
-
-class UserChannel(models.Model):
-    name = models.CharField(max_length=100, unique=True)
-    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -0,0 +1,94 @@
+import asyncio
+from collections import defaultdict
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from .engine import compact_move
+from .models import Game, GameMove
+from .packing import MOVE_SIZE, pack_moves
+
+
+class MoveLogBuffer:
+    """
+    Collects the moves of live games in memory and writes them with bulk_create.
+    Buffered moves are flushed every MOVE_LOG_FLUSH_INTERVAL seconds by a single
+    background task per process, and explicitly when a game ends or a player disconnects.
+    Depending on MOVE_STORAGE, moves become GameMove rows or are appended to Game.packed_moves.
+    """
+
+    def __init__(self):
+        # game id -> list of unsaved GameMove
+        self.pending = {}
+        self.task = None
+
+    def add(self, game_id, ply, move, clock=None):
+        self.pending.setdefault(game_id, []).append(
+            GameMove(game_id=game_id, ply=ply, move=compact_move(move), clock=clock)
+        )
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+
+    async def flush(self, game_id=None):
+        """
+        Writes buffered moves of one game, or of all games. Returns False if the
+        write failed, the moves are then kept for the next flush.
+        """
+        if game_id is None:
+            batch = [move for moves in self.pending.values() for move in moves]
+            self.pending = {}
+        else:
+            batch = self.pending.pop(game_id, [])
+        if not batch:
+            return True
+        if settings.MOVE_STORAGE == "packed":
+            write = self.write_packed
+        else:
+            write = self.write_rows
+        try:
+            deferred = await database_sync_to_async(write)(batch)
+        except DatabaseError:
+            deferred = batch
+        for move in deferred:
+            self.pending.setdefault(move.game_id, []).append(move)
+        return not deferred
+
+    def write_rows(self, batch):
+        GameMove.objects.bulk_create(batch, ignore_conflicts=True)
+        return []
+
+    def write_packed(self, batch):
+        """
+        Appends moves to the packed move lists of their games in two queries.
+        Returns the moves that cannot be written until a missing earlier ply arrives.
+        """
+        moves_by_game = defaultdict(list)
+        for move in batch:
+            moves_by_game[move.game_id].append(move)
+        deferred = []
+        with transaction.atomic():
+            games = list(
+                Game.objects.select_for_update()
+                .filter(pk__in=moves_by_game)
+                .only("packed_moves")
+            )
+            for game in games:
+                data = bytearray(game.packed_moves)
+                for move in sorted(moves_by_game[game.pk], key=lambda move: move.ply):
+                    offset = (move.ply - 1) * MOVE_SIZE
+                    if offset == len(data):
+                        data += pack_moves([move.move])
+                    elif offset > len(data):
+                        deferred.append(move)
+                    # Lower plies have already been written by an earlier flush
+                game.packed_moves = bytes(data)
+            Game.objects.bulk_update(games, ["packed_moves"])
+        return deferred
+
+    async def run(self):
+        while self.pending:
+            await asyncio.sleep(settings.MOVE_LOG_FLUSH_INTERVAL)
+            await self.flush()
+
+
+move_log = MoveLogBuffer()
@@ -0,0 +1,42 @@
+"""
+Packed storage of a game's moves: one little-endian 16-bit code per ply,
+see chess.engine.compact_move.
+"""
+
+import struct
+from collections.abc import Sequence
+
+MOVE_SIZE = 2
+
+
+def pack_moves(codes):
+    return struct.pack(f"<{len(codes)}H", *codes)
+
+
+def unpack_moves(data):
+    return [code for (code,) in struct.iter_unpack("<H", data)]
+
+
+class PackedMoves(Sequence):
+    """
+    Read-only sequence over packed moves that decodes codes only when accessed.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data) // MOVE_SIZE
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("move index out of range")
+        return struct.unpack_from("<H", self.data, index * MOVE_SIZE)[0]
+
+    def __iter__(self):
+        for (code,) in struct.iter_unpack("<H", self.data):
+            yield code
@@ -0,0 +1,84 @@
+import base64
+import binascii
+import json
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from .models import Game, finished_before
+
+
+class GameCursorPagination(BasePagination):
+    """
+    Keyset pagination over finished games ordered by (-finished_at, -id).
+    The cursor encodes the position of the last game of a page, so deep pages cost
+    the same as the first one and stay stable while new games are being finished.
+    """
+
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    page_size = 20
+    max_page_size = 100
+    ordering = Game.HISTORY_ORDERING
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        def fetch(before, limit):
+            games = queryset.filter(finished_at__isnull=False)
+            if before is not None:
+                games = games.filter(finished_before(*before))
+            return games.order_by(*self.ordering)
+
+        return self.paginate_games(fetch, request)
+
+    def paginate_games(self, fetch, request):
+        """
+        Paginates the games returned by `fetch(before, limit)`, which may push the
+        position and the page size down into its query, e.g. Profile.games().
+        """
+        self.request = request
+        page_size = self.get_page_size(request)
+        position = self.decode_cursor(request)
+        # Fetch one extra row to find out whether there is a next page
+        results = list(fetch(position, page_size + 1)[: page_size + 1])
+        self.page = results[:page_size]
+        self.has_next = len(results) > page_size
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(last.finished_at, last.pk)
+        )
+
+    def encode_cursor(self, finished_at, pk):
+        payload = json.dumps([finished_at.isoformat(), pk]).encode()
+        return base64.urlsafe_b64encode(payload).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            payload = base64.urlsafe_b64decode(encoded.encode())
+            finished_at, pk = json.loads(payload)
+            finished_at = parse_datetime(finished_at)
+            if finished_at is None or not isinstance(pk, int):
+                raise ValueError
+        except (binascii.Error, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        return finished_at, pk
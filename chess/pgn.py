@@ -0,0 +1,107 @@
+"""
+PGN export of finished games.
+"""
+
+import itertools
+import textwrap
+from asgiref.sync import sync_to_async
+from django.db.models import Prefetch
+from .engine import Board, WHITE, compact_move
+from .models import GameMove
+
+# Games fetched per database round trip
+QUERY_CHUNK_SIZE = 500
+# Games rendered per chunk of the response body
+GAMES_PER_CHUNK = 50
+
+
+def game_result(game):
+    if game.is_active:
+        return "*"
+    if game.winner is None:
+        return "1/2-1/2"
+    return "1-0" if game.winner == game.challenger_id else "0-1"
+
+
+def quote(value):
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def movetext(codes):
+    """
+    Numbered SAN tokens of a game replayed from its move codes.
+    """
+    board = Board()
+    tokens = []
+    for code in codes:
+        legal_moves = board.legal_moves()
+        for move in legal_moves:
+            if compact_move(move) == code:
+                break
+        else:
+            raise ValueError(f"Illegal move code: {code}")
+        if board.turn == WHITE:
+            tokens.append(f"{board.fullmove_number}.")
+        elif not tokens:
+            tokens.append(f"{board.fullmove_number}...")
+        tokens.append(board.san(move, legal_moves))
+        board.push(move)
+    return tokens
+
+
+def game_pgn(game):
+    """
+    PGN of a single game. Players are read from game.challenger and game.opponent,
+    so select them together with the game.
+    """
+    result = game_result(game)
+    date = game.finished_at or game.started_at or game.created_at
+    tags = [
+        ("Event", "Casual game"),
+        ("Site", "?"),
+        ("Date", date.strftime("%Y.%m.%d")),
+        ("Round", "-"),
+        ("White", game.challenger.username),
+        ("Black", game.opponent.username),
+        ("Result", result),
+    ]
+    header = "".join(f"[{name} {quote(value)}]\n" for name, value in tags)
+    moves = textwrap.fill(
+        " ".join(movetext(game.move_codes()) + [result]),
+        width=80,
+        break_long_words=False,
+        break_on_hyphens=False,
+    )
+    return f"{header}\n{moves}\n\n"
+
+
+def export_queryset(games):
+    """
+    Adds what game_pgn() needs to a game queryset so that a chunk of games
+    is exported with a fixed number of queries.
+    """
+    return games.select_related("challenger", "opponent").prefetch_related(
+        Prefetch("moves", queryset=GameMove.objects.only("game_id", "ply", "move"))
+    )
+
+
+def iter_pgn(games):
+    """
+    Yields the PGN of a game queryset a few games at a time. Games are read with
+    QuerySet.iterator(), so memory use does not grow with the number of games.
+    """
+    pgns = map(game_pgn, export_queryset(games).iterator(chunk_size=QUERY_CHUNK_SIZE))
+    while chunk := "".join(itertools.islice(pgns, GAMES_PER_CHUNK)):
+        yield chunk
+
+
+async def aiter_pgn(games):
+    """
+    Async version of iter_pgn() for StreamingHttpResponse under ASGI.
+    Database reads and move replay run in the sync thread, one chunk at a time,
+    so the event loop is never blocked and the body is never built in full.
+    """
+    chunks = iter_pgn(games)
+    next_chunk = sync_to_async(lambda: next(chunks, None))
+    while (chunk := await next_chunk()) is not None:
+        yield chunk
@@ -0,0 +1,237 @@
+import asyncio
+import functools
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+
+def user_group_name(user_id):
+    """
+    Channel layer group that contains every open MainConsumer socket of a user.
+    """
+    return f"user-{user_id}"
+
+
+class BasePresenceStore:
+    """
+    Counts the open websocket connections of every online user.
+    A user may be connected from several devices at once and stays online
+    until the last of them disconnects. Connections expire after `ttl` seconds
+    unless they are renewed, which the process holding them does while they are
+    open, see PresenceKeeper, so sockets of crashed workers do not keep users
+    online forever.
+    """
+
+    def __init__(self, ttl=120):
+        self.ttl = ttl
+
+    def connect(self, user_id, channel_name):
+        """
+        Registers a connection and returns the number of open connections of the user.
+        """
+        raise NotImplementedError
+
+    def touch(self, user_id, channel_name):
+        raise NotImplementedError
+
+    def disconnect(self, user_id, channel_name):
+        """
+        Removes a connection and returns the number of connections the user has left.
+        """
+        raise NotImplementedError
+
+    def count(self, user_id):
+        raise NotImplementedError
+
+    def is_online(self, user_id):
+        return self.count(user_id) > 0
+
+    async def aconnect(self, user_id, channel_name):
+        return await sync_to_async(self.connect)(user_id, channel_name)
+
+    async def atouch(self, user_id, channel_name):
+        return await sync_to_async(self.touch)(user_id, channel_name)
+
+    async def adisconnect(self, user_id, channel_name):
+        return await sync_to_async(self.disconnect)(user_id, channel_name)
+
+    async def acount(self, user_id):
+        return await sync_to_async(self.count)(user_id)
+
+
+class InMemoryPresenceStore(BasePresenceStore):
+    """
+    Process-local store. Only suitable for tests and single-process deployments.
+    """
+
+    def __init__(self, ttl=120):
+        super().__init__(ttl)
+        # user id -> {channel name: expires at}
+        self.connections = {}
+
+    def live_connections(self, user_id):
+        connections = self.connections.get(user_id)
+        if connections is None:
+            return {}
+        now = time.monotonic()
+        for channel_name in [c for c, expires_at in connections.items() if expires_at <= now]:
+            del connections[channel_name]
+        if not connections:
+            del self.connections[user_id]
+        return connections
+
+    def connect(self, user_id, channel_name):
+        connections = self.connections.setdefault(user_id, {})
+        connections[channel_name] = time.monotonic() + self.ttl
+        return len(self.live_connections(user_id))
+
+    def touch(self, user_id, channel_name):
+        connections = self.live_connections(user_id)
+        if channel_name in connections:
+            connections[channel_name] = time.monotonic() + self.ttl
+
+    def disconnect(self, user_id, channel_name):
+        self.live_connections(user_id).pop(channel_name, None)
+        return len(self.live_connections(user_id))
+
+    def count(self, user_id):
+        return len(self.live_connections(user_id))
+
+    async def aconnect(self, user_id, channel_name):
+        return self.connect(user_id, channel_name)
+
+    async def atouch(self, user_id, channel_name):
+        return self.touch(user_id, channel_name)
+
+    async def adisconnect(self, user_id, channel_name):
+        return self.disconnect(user_id, channel_name)
+
+    async def acount(self, user_id):
+        return self.count(user_id)
+
+
+class RedisPresenceStore(BasePresenceStore):
+    """
+    Keeps a sorted set per user with one member per connection, scored by the
+    time the connection expires at. The set itself expires with its last member.
+    """
+
+    CONNECT_SCRIPT = """
+    redis.call("zremrangebyscore", KEYS[1], "-inf", ARGV[2])
+    redis.call("zadd", KEYS[1], ARGV[2] + ARGV[3], ARGV[1])
+    redis.call("expire", KEYS[1], ARGV[3])
+    return redis.call("zcard", KEYS[1])
+    """
+    TOUCH_SCRIPT = """
+    if redis.call("zadd", KEYS[1], "XX", "CH", ARGV[2] + ARGV[3], ARGV[1]) == 1 then
+        redis.call("expire", KEYS[1], ARGV[3])
+    end
+    return 0
+    """
+    DISCONNECT_SCRIPT = """
+    redis.call("zrem", KEYS[1], ARGV[1])
+    redis.call("zremrangebyscore", KEYS[1], "-inf", ARGV[2])
+    return redis.call("zcard", KEYS[1])
+    """
+
+    def __init__(self, ttl=120, prefix="presence", **connection_kwargs):
+        import redis
+        import redis.asyncio
+
+        super().__init__(ttl)
+        self.prefix = prefix
+        self.client = redis.Redis(decode_responses=True, **connection_kwargs)
+        self.async_client = redis.asyncio.Redis(decode_responses=True, **connection_kwargs)
+        self.scripts = {}
+        self.async_scripts = {}
+        for name in ("connect", "touch", "disconnect"):
+            source = getattr(self, f"{name.upper()}_SCRIPT")
+            self.scripts[name] = self.client.register_script(source)
+            self.async_scripts[name] = self.async_client.register_script(source)
+
+    def key(self, user_id):
+        return f"{self.prefix}:{user_id}"
+
+    def script_args(self, user_id, channel_name):
+        return {"keys": [self.key(user_id)], "args": [channel_name, time.time(), self.ttl]}
+
+    def connect(self, user_id, channel_name):
+        return self.scripts["connect"](**self.script_args(user_id, channel_name))
+
+    def touch(self, user_id, channel_name):
+        self.scripts["touch"](**self.script_args(user_id, channel_name))
+
+    def disconnect(self, user_id, channel_name):
+        return self.scripts["disconnect"](**self.script_args(user_id, channel_name))
+
+    def count(self, user_id):
+        return self.client.zcount(self.key(user_id), time.time(), "+inf")
+
+    async def aconnect(self, user_id, channel_name):
+        return await self.async_scripts["connect"](**self.script_args(user_id, channel_name))
+
+    async def atouch(self, user_id, channel_name):
+        await self.async_scripts["touch"](**self.script_args(user_id, channel_name))
+
+    async def adisconnect(self, user_id, channel_name):
+        return await self.async_scripts["disconnect"](
+            **self.script_args(user_id, channel_name)
+        )
+
+    async def acount(self, user_id):
+        return await self.async_client.zcount(self.key(user_id), time.time(), "+inf")
+
+
+class PresenceKeeper:
+    """
+    MainConsumer sockets of this process, renewed in the presence store by a single
+    background task every third of the store's ttl while there are any. Clients do
+    not have to send anything to stay online.
+    """
+
+    def __init__(self):
+        # channel name -> user id
+        self.connections = {}
+        self.task = None
+
+    def add(self, user_id, channel_name):
+        self.connections[channel_name] = user_id
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+
+    def remove(self, channel_name):
+        self.connections.pop(channel_name, None)
+
+    async def run(self):
+        while self.connections:
+            await asyncio.sleep(get_presence_store().ttl / 3)
+            await self.renew()
+
+    async def renew(self):
+        store = get_presence_store()
+        await asyncio.gather(
+            *(
+                store.atouch(user_id, channel_name)
+                for channel_name, user_id in list(self.connections.items())
+            )
+        )
+
+
+presence_keeper = PresenceKeeper()
+
+
+@functools.cache
+def get_presence_store():
+    config = settings.PRESENCE_STORE
+    store_class = import_string(config["BACKEND"])
+    return store_class(**config.get("OPTIONS", {}))
+
+
+@receiver(setting_changed)
+def reset_presence_store(setting, **kwargs):
+    if setting == "PRESENCE_STORE":
+        get_presence_store.cache_clear()
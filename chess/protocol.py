@@ -0,0 +1,219 @@
+"""
+Websocket frame formats. Clients get JSON text frames unless they ask for the
+"chess.msgpack" subprotocol, which carries msgpack arrays in binary frames:
+[type code, field values...] with the fields in the order of the message schema.
+Fields missing from the end of a message are left out.
+"""
+
+import json
+import time
+import msgpack
+from django.conf import settings
+from . import instrumentation, metrics
+from .engine import COLOR_NAMES
+from .throttling import CommandThrottle, SendWindow
+
+SUBPROTOCOL = "chess.msgpack"
+# Close code of sockets whose client falls a send window behind, see chess.throttling
+SLOW_CLIENT_CLOSE_CODE = 4008
+
+
+def pack_clock(clock):
+    return None if clock is None else [clock[name] for name in COLOR_NAMES]
+
+
+def unpack_clock(clock):
+    return None if clock is None else dict(zip(COLOR_NAMES, clock))
+
+
+class Schema:
+    """
+    Integer codes and field order of the messages a socket sends or receives.
+    `types` is a list of (code, name, fields), the name is the value of `type_key`.
+    Codes are part of the wire format and must never be reused.
+    """
+
+    def __init__(self, type_key, types):
+        self.type_key = type_key
+        self.by_name = {name: (code, fields) for code, name, fields in types}
+        self.by_code = {code: (name, fields) for code, name, fields in types}
+        self.codecs = {"clock": (pack_clock, unpack_clock), "events": (self.pack_all, self.unpack_all)}
+
+    def pack(self, message):
+        code, fields = self.by_name[message[self.type_key]]
+        length = 0
+        for index, field in enumerate(fields):
+            if field in message:
+                length = index + 1
+        frame = [code]
+        for field in fields[:length]:
+            value = message.get(field)
+            if field in self.codecs:
+                value = self.codecs[field][0](value)
+            frame.append(value)
+        return frame
+
+    def unpack(self, frame):
+        if not isinstance(frame, list) or not frame or frame[0] not in self.by_code:
+            raise ValueError("Unknown frame")
+        name, fields = self.by_code[frame[0]]
+        if len(frame) - 1 > len(fields):
+            raise ValueError("Too many fields")
+        message = {self.type_key: name}
+        for field, value in zip(fields, frame[1:]):
+            if field in self.codecs:
+                value = self.codecs[field][1](value)
+            message[field] = value
+        return message
+
+    def pack_all(self, messages):
+        return [self.pack(message) for message in messages]
+
+    def unpack_all(self, frames):
+        return [self.unpack(frame) for frame in frames]
+
+
+class Protocol:
+    def __init__(self, messages, commands):
+        self.messages = messages
+        self.commands = commands
+
+    def encode_message(self, message):
+        return msgpack.packb(self.messages.pack(message))
+
+    def decode_message(self, data):
+        return self.messages.unpack(msgpack.unpackb(data))
+
+    def encode_command(self, command):
+        return msgpack.packb(self.commands.pack(command))
+
+    def decode_command(self, data):
+        return self.commands.unpack(msgpack.unpackb(data))
+
+    def encode(self, message):
+        """
+        Encodes a message once in both formats, for sockets of either kind.
+        """
+        return json.dumps(message), self.encode_message(message)
+
+
+game_protocol = Protocol(
+    Schema(
+        "msg_type",
+        [
+            (1, "move", ("seq", "player", "from", "to", "timestamp", "clock", "fen")),
+            (2, "promote", ("seq", "player", "square", "piece", "timestamp", "clock", "fen")),
+            (3, "end", ("seq", "result", "reason", "winner", "clock", "fen")),
+            (4, "error", ("command", "message")),
+            (
+                5,
+                "snapshot",
+                ("seq", "fen", "clock", "result", "reason", "winner", "moves", "pending_promotion"),
+            ),
+            (6, "batch", ("seq", "events")),
+        ],
+    ),
+    Schema(
+        "command",
+        [
+            (1, "move", ("from", "to", "promotion", "timestamp")),
+            (2, "promote", ("square", "piece", "timestamp")),
+            (3, "resign", ()),
+            (4, "ack", ("received",)),
+        ],
+    ),
+)
+
+main_protocol = Protocol(
+    Schema(
+        "type",
+        [
+            (1, "queued", ("time_control",)),
+            (2, "queue_left", ()),
+            (3, "error", ("message",)),
+            (4, "challenge", ("request_id", "time_control", "user")),
+            (5, "challenge_accepted", ("game_id",)),
+            (6, "match", ("game_id", "color", "time_control", "opponent")),
+            (7, "move", ("game_id", "from", "to")),
+        ],
+    ),
+    Schema(
+        "command",
+        [
+            (1, "queue", ("time_control",)),
+            (2, "leave_queue", ()),
+            (3, "ack", ("received",)),
+        ],
+    ),
+)
+
+
+class ProtocolMixin:
+    """
+    Speaks the frame format negotiated by a websocket consumer's client, limits the
+    commands the client may send and the frames it may be sent without acknowledging
+    them. Clients acknowledge with {"command": "ack", "received": <n>}, n being the
+    number of frames they have received on the socket.
+    """
+
+    protocol = None
+
+    async def accept_protocol(self):
+        self.binary = SUBPROTOCOL in self.scope.get("subprotocols", ())
+        self.throttle = CommandThrottle(settings.WEBSOCKET_RATE_LIMITS)
+        self.window = SendWindow(settings.WEBSOCKET_SEND_WINDOW)
+        await self.accept(SUBPROTOCOL if self.binary else None)
+
+    def decode_command(self, text_data=None, bytes_data=None):
+        """
+        Returns the command dict of a frame, None if it is malformed.
+        """
+        try:
+            if bytes_data is not None:
+                if not self.binary:
+                    return None
+                content = self.protocol.decode_command(bytes_data)
+            else:
+                content = json.loads(text_data or "")
+        except (ValueError, TypeError, msgpack.UnpackException):
+            return None
+        return content if isinstance(content, dict) else None
+
+    def allow(self, content):
+        """
+        Takes a token for the command of a frame, `content` is None if the frame is malformed.
+        """
+        command = None if content is None else content.get("command")
+        instrumentation.name_current(f"{type(self).__name__} {self.throttle.bucket_name(command)}")
+        if self.throttle.allow(command, time.monotonic()):
+            return True
+        metrics.increment(
+            "websocket_commands_throttled", command=self.throttle.bucket_name(command)
+        )
+        return False
+
+    async def send_message(self, message, encoded=None, droppable=False):
+        """
+        Sends a message dict, `encoded` is its (text, bytes) encoding when it has
+        already been encoded once for many sockets. Droppable messages are held back
+        while the send window is full, otherwise the socket is closed and the client
+        has to reconnect and catch up.
+        """
+        if self.binary:
+            frame = {"bytes_data": encoded[1] if encoded else self.protocol.encode_message(message)}
+        else:
+            frame = {"text_data": encoded[0] if encoded else json.dumps(message)}
+        try:
+            frame = self.window.put(frame, droppable)
+        except OverflowError:
+            metrics.increment("websocket_slow_client_closes")
+            self.window.close()
+            await self.close(SLOW_CLIENT_CLOSE_CODE)
+            return
+        if frame is not None:
+            await self.send(**frame)
+
+    async def acknowledge(self, content):
+        frame = self.window.ack(content.get("received"))
+        if frame is not None:
+            await self.send(**frame)
@@ -0,0 +1,114 @@
+"""
+Glicko-2 ratings, see http://www.glicko.net/glicko/glicko2.pdf.
+Every game is rated on its own, as a rating period with a single result.
+"""
+
+import math
+from .clock import parse_time_control
+
+DEFAULT_RATING = 1500.0
+DEFAULT_DEVIATION = 350.0
+DEFAULT_VOLATILITY = 0.06
+# Constrains the change of volatility over time
+TAU = 0.5
+CONVERGENCE_TOLERANCE = 0.000001
+GLICKO2_SCALE = 173.7178
+
+BULLET, BLITZ, RAPID, CLASSICAL, CORRESPONDENCE = (
+    "bullet",
+    "blitz",
+    "rapid",
+    "classical",
+    "correspondence",
+)
+CATEGORIES = [BULLET, BLITZ, RAPID, CLASSICAL, CORRESPONDENCE]
+
+
+def time_control_category(time_control):
+    """
+    Rating category of a time control by estimated game duration,
+    initial time plus 40 increments. Untimed games are correspondence games.
+    """
+    parsed = parse_time_control(time_control)
+    if parsed is None:
+        return CORRESPONDENCE
+    initial_ms, increment_ms = parsed
+    duration = (initial_ms + 40 * increment_ms) / 1000
+    if duration < 180:
+        return BULLET
+    if duration < 480:
+        return BLITZ
+    if duration < 1500:
+        return RAPID
+    return CLASSICAL
+
+
+def glicko2(rating, deviation, volatility, results, tau=TAU):
+    """
+    Returns the (rating, deviation, volatility) of a player after a rating period.
+    `results` is a list of (opponent rating, opponent deviation, score) with scores
+    of 1 for a win, 0.5 for a draw and 0 for a loss.
+    """
+    mu = (rating - DEFAULT_RATING) / GLICKO2_SCALE
+    phi = deviation / GLICKO2_SCALE
+    if not results:
+        phi = min(math.sqrt(phi**2 + volatility**2), DEFAULT_DEVIATION / GLICKO2_SCALE)
+        return rating, phi * GLICKO2_SCALE, volatility
+
+    variance_inverse = 0
+    improvement = 0
+    for opponent_rating, opponent_deviation, score in results:
+        opponent_mu = (opponent_rating - DEFAULT_RATING) / GLICKO2_SCALE
+        opponent_phi = opponent_deviation / GLICKO2_SCALE
+        g = 1 / math.sqrt(1 + 3 * opponent_phi**2 / math.pi**2)
+        expected = 1 / (1 + math.exp(-g * (mu - opponent_mu)))
+        variance_inverse += g**2 * expected * (1 - expected)
+        improvement += g * (score - expected)
+    v = 1 / variance_inverse
+    delta = v * improvement
+
+    # New volatility by the Illinois algorithm
+    a = math.log(volatility**2)
+
+    def f(x):
+        ex = math.exp(x)
+        return ex * (delta**2 - phi**2 - v - ex) / (2 * (phi**2 + v + ex) ** 2) - (x - a) / tau**2
+
+    low = a
+    if delta**2 > phi**2 + v:
+        high = math.log(delta**2 - phi**2 - v)
+    else:
+        k = 1
+        while f(a - k * tau) < 0:
+            k += 1
+        high = a - k * tau
+    f_low, f_high = f(low), f(high)
+    while abs(high - low) > CONVERGENCE_TOLERANCE:
+        middle = low + (low - high) * f_low / (f_high - f_low)
+        f_middle = f(middle)
+        if f_middle * f_high <= 0:
+            low, f_low = high, f_high
+        else:
+            f_low /= 2
+        high, f_high = middle, f_middle
+    new_volatility = math.exp(low / 2)
+
+    phi_star = math.sqrt(phi**2 + new_volatility**2)
+    new_phi = 1 / math.sqrt(1 / phi_star**2 + 1 / v)
+    new_mu = mu + new_phi**2 * improvement
+    return (
+        new_mu * GLICKO2_SCALE + DEFAULT_RATING,
+        new_phi * GLICKO2_SCALE,
+        new_volatility,
+    )
+
+
+def rate_game(white, black, score):
+    """
+    New (rating, deviation, volatility) of both players of a game, given their
+    current ones and white's score.
+    """
+    return (
+        glicko2(*white, [(black[0], black[1], score)]),
+        glicko2(*black, [(white[0], white[1], 1 - score)]),
+    )
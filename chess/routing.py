@@ -1,7 +1,12 @@
 from django.urls import re_path
-from .consumers import MainConsumer, GameConsumer
+from .consumers import MainConsumer, GameConsumer, SpectatorConsumer
 
 websocket_urlpatterns = [
     re_path(r"^ws/main", MainConsumer.as_asgi(), name="main"),
     re_path(r"^ws/games/(?P<room_name>\w+-\d+)/$", GameConsumer.as_asgi(), name="game"),
+    re_path(
+        r"^ws/games/(?P<room_name>\w+-\d+)/watch/$",
+        SpectatorConsumer.as_asgi(),
+        name="game-watch",
+    ),
 ]
\ No newline at end of file
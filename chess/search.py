@@ -0,0 +1,62 @@
+from django.conf import settings
+from django.db import connections
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.db.models.functions import Collate, Upper
+
+# Shortest query the trigram indexes can serve, shorter ones only match username prefixes
+TRIGRAM_LENGTH = 3
+
+
+def username_key(using):
+    """
+    The expression of the username prefix index of migration 0030. Its "C" collation
+    compares bytes, so the index serves both LIKE 'prefix%' and ORDER BY.
+    SQLite compares bytes already and has no such collation.
+    """
+    if connections[using].vendor == "postgresql":
+        return Collate(Upper("username"), "C")
+    return Upper("username")
+
+
+def search_users(queryset, query, limit=None):
+    """
+    Returns at most `limit` users whose username or name contains `query`.
+    Exact username matches come first, then username prefixes, then name prefixes.
+
+    On PostgreSQL the icontains lookups are served by the pg_trgm GIN indexes
+    created in migration 0022, which index the same UPPER() expression Django
+    generates for case-insensitive lookups. Trigrams need 3 characters: shorter
+    queries, the first keystrokes of search-as-you-type, only match username
+    prefixes, read in the order of the index of migration 0030.
+    """
+    if limit is None:
+        limit = settings.USER_SEARCH_LIMIT
+    query = query.strip()
+    if not query:
+        return queryset.none()
+    if len(query) < TRIGRAM_LENGTH:
+        # An exact match sorts before the usernames it is a prefix of
+        return (
+            queryset.alias(username_key=username_key(queryset.db))
+            .filter(username_key__startswith=query.upper())
+            .order_by("username_key")[:limit]
+        )
+    rank = Case(
+        When(username__iexact=query, then=Value(0)),
+        When(username__istartswith=query, then=Value(1)),
+        When(
+            Q(first_name__istartswith=query) | Q(last_name__istartswith=query),
+            then=Value(2),
+        ),
+        default=Value(3),
+        output_field=IntegerField(),
+    )
+    return (
+        queryset.filter(
+            Q(username__icontains=query)
+            | Q(first_name__icontains=query)
+            | Q(last_name__icontains=query)
+        )
+        .annotate(search_rank=rank)
+        .order_by("search_rank", "pk")[:limit]
+    )
@@ -1,6 +1,7 @@
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
 from .models import Profile, FriendRequest, Game
+from .friends import friend_ids
 
 
 User = get_user_model()
@@ -12,6 +13,33 @@ class ProfileSerializer(serializers.ModelSerializer):
         fields = ["user", "avatar", "wins", "losses", "draws"]
 
 
+def load_viewer_relations(context):
+    """
+    Loads the requesting user's friend ids and outgoing friend request ids once
+    per serializer context, so that nested users can be annotated from memory.
+    """
+    request = context.get("request", None)
+    if (
+        request is None
+        or not hasattr(request, "user")
+        or request.user.is_anonymous
+        or "viewer_relations" in context
+    ):
+        return
+    requested_ids = set(
+        FriendRequest.objects.filter(sender=request.user, is_active=True).values_list(
+            "receiver_id", flat=True
+        )
+    )
+    context["viewer_relations"] = (friend_ids(request.user.pk), requested_ids)
+
+
+class UserListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        load_viewer_relations(self.context)
+        return super().to_representation(data)
+
+
 class UserSerializer(serializers.ModelSerializer):
     profile = ProfileSerializer(required=False)
 
@@ -28,6 +56,7 @@ class UserSerializer(serializers.ModelSerializer):
             "profile",
         ]
         extra_kwargs = {"password": {"write_only": True}}
+        list_serializer_class = UserListSerializer
 
     def create(self, validated_data):
         user = User.objects.create_user(**validated_data)
@@ -37,15 +66,25 @@ class UserSerializer(serializers.ModelSerializer):
         representation = super().to_representation(instance)
         request = self.context.get("request", None)
         if request and hasattr(request, "user") and not request.user.is_anonymous:
-            representation["is_friend"] = request.user.friends.filter(
-                pk=instance.pk
-            ).exists()
-            representation["is_requested"] = FriendRequest.objects.filter(
-                sender=request.user, receiver=instance, is_active=True
-            ).exists()
+            relations = self.context.get("viewer_relations", None)
+            if relations is not None:
+                viewer_friend_ids, requested_ids = relations
+                representation["is_friend"] = instance.pk in viewer_friend_ids
+                representation["is_requested"] = instance.pk in requested_ids
+            else:
+                representation["is_friend"] = instance.pk in friend_ids(request.user.pk)
+                representation["is_requested"] = FriendRequest.objects.filter(
+                    sender=request.user, receiver=instance, is_active=True
+                ).exists()
         return representation
 
 
+class FriendRequestListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        load_viewer_relations(self.context)
+        return super().to_representation(data)
+
+
 class FriendRequestSerialier(serializers.ModelSerializer):
     sender = UserSerializer()
 
@@ -53,6 +92,13 @@ class FriendRequestSerialier(serializers.ModelSerializer):
         model = FriendRequest
         fields = ["id", "sender", "created_at", "is_active", "is_accepted"]
         extra_kwargs = {"is_active": {"read_only": True}}
+        list_serializer_class = FriendRequestListSerializer
+
+
+class GameListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        load_viewer_relations(self.context)
+        return super().to_representation(data)
 
 
 class GameSerializer(serializers.ModelSerializer):
@@ -65,7 +111,19 @@ class GameSerializer(serializers.ModelSerializer):
             "created_at",
             "started_at",
             "finished_at",
+            "time_control",
         ]
+        list_serializer_class = GameListSerializer
+
+    def serialize_user(self, user):
+        """
+        Serializes a player once per serializer context.
+        Players usually repeat across a page of games, so the result is reused.
+        """
+        users = self.context.setdefault("serialized_users", {})
+        if user.pk not in users:
+            users[user.pk] = UserSerializer(user, context=self.context).data
+        return users[user.pk]
 
     def to_representation(self, instance):
         ret = super().to_representation(instance)
@@ -74,22 +132,19 @@ class GameSerializer(serializers.ModelSerializer):
             user = self.context.get("user", None)
             if user is None:
                 user = request.user
-            is_white = user == instance.challenger
-            player = "white" if is_white else "black"
-            opponent = instance.opponent if is_white else instance.challenger
-            serializer = UserSerializer(instance.challenger, context={ "request": request })
-            ret["white"] = serializer.data
-            serializer = UserSerializer(instance.opponent, context={ "request": request })
-            ret["black"] = serializer.data
-            serializer = UserSerializer(opponent, context={"request": request})
+            is_white = user.pk == instance.challenger_id
+            white = self.serialize_user(instance.challenger)
+            black = self.serialize_user(instance.opponent)
+            ret["white"] = white
+            ret["black"] = black
             ret["is_white"] = is_white
-            ret["player"] = player
-            ret["opponent"] = serializer.data
+            ret["player"] = "white" if is_white else "black"
+            ret["opponent"] = black if is_white else white
             ret["is_winner"] = user.pk == instance.winner
             winner = None
-            if instance.challenger.pk == instance.winner:
+            if instance.challenger_id == instance.winner:
                 winner = "white"
-            if instance.opponent.pk == instance.winner:
+            if instance.opponent_id == instance.winner:
                 winner = "black"
             ret["winner"] = winner
         return ret
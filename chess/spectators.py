@@ -0,0 +1,148 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .clock import timers
+from .events import get_event_store
+from .protocol import game_protocol
+
+
+def spectator_group_name(room_name):
+    return f"spectators.{room_name}"
+
+
+def spectator_stream(game_id):
+    """
+    Event store key of the frames shown to the spectators of a game. Spectators have
+    their own sequence numbers, they only learn about moves once the delay has passed.
+    """
+    return f"{game_id}:spectators"
+
+
+async def broadcast(room_name, game_id, messages):
+    """
+    Numbers the messages released together as one frame and sends it to every
+    spectator of the room. The frame is encoded once per format, not once per spectator.
+    """
+    if len(messages) == 1:
+        frame = messages[0]
+    else:
+        frame = {"msg_type": "batch", "events": messages}
+    frame = await get_event_store().aappend(spectator_stream(game_id), frame)
+    await get_channel_layer().group_send(
+        spectator_group_name(room_name),
+        {"type": "spectator.frame", "seq": frame["seq"], "encoded": game_protocol.encode(frame)},
+    )
+
+
+# game id -> (seq, encoding) of the snapshot of its latest spectator frame, most recent last
+snapshots = OrderedDict()
+# Games whose snapshot is kept, the least recently joined ones are evicted first
+SNAPSHOT_CACHE_SIZE = 1024
+
+
+def frame_snapshot(seq, frame):
+    """
+    Snapshot of the position after a spectator frame, the moves that led to it are not repeated.
+    """
+    last = frame
+    if frame is not None and frame["msg_type"] == "batch":
+        last = frame["events"][-1]
+    snapshot = {
+        "msg_type": "snapshot",
+        "seq": seq,
+        "fen": None,
+        "clock": None,
+        "result": None,
+        "reason": None,
+        "winner": None,
+    }
+    if last is not None:
+        snapshot.update(fen=last["fen"], clock=last.get("clock"))
+        if last["msg_type"] == "end":
+            snapshot.update(result=last["result"], reason=last["reason"], winner=last["winner"])
+    return snapshot
+
+
+async def latest_snapshot(game_id):
+    """
+    Returns (seq, encoding) of the snapshot of the latest spectator frame of a game,
+    None before the first one. Every frame carries the position, so spectators who join
+    get this one message instead of the whole game, encoded once for all of them.
+    """
+    store = get_event_store()
+    stream = spectator_stream(game_id)
+    seq = await store.alast_seq(stream)
+    if not seq:
+        return None
+    cached = snapshots.get(game_id)
+    if cached is None or cached[0] != seq:
+        frames = await store.asince(stream, seq - 1)
+        cached = (seq, game_protocol.encode(frame_snapshot(seq, frames[-1] if frames else None)))
+        snapshots[game_id] = cached
+    snapshots.move_to_end(game_id)
+    while len(snapshots) > SNAPSHOT_CACHE_SIZE:
+        snapshots.popitem(last=False)
+    return cached
+
+
+class SpectatorFeed:
+    """
+    Messages of a game held back from its spectators for SPECTATOR_DELAY seconds.
+    Messages released within SPECTATOR_BATCH_INTERVAL seconds of each other
+    share a single frame.
+    """
+
+    def __init__(self, room_name, game_id):
+        self.room_name = room_name
+        self.game_id = game_id
+        # (release time, message), oldest first
+        self.pending = deque()
+        self.timer = None
+        # Frames are sent one at a time so that they are numbered in order
+        self.lock = asyncio.Lock()
+
+    def add(self, message, now):
+        self.pending.append((now + settings.SPECTATOR_DELAY, message))
+        if self.timer is None:
+            self.schedule()
+
+    def schedule(self):
+        deadline = self.pending[0][0] + settings.SPECTATOR_BATCH_INTERVAL
+        self.timer = timers.schedule(deadline, self.release)
+
+    def release(self):
+        self.timer = None
+        now = time.monotonic()
+        messages = []
+        while self.pending and self.pending[0][0] <= now:
+            messages.append(self.pending.popleft()[1])
+        if self.pending:
+            self.schedule()
+        elif feeds.get(self.room_name) is self:
+            del feeds[self.room_name]
+        if messages:
+            timers.loop.create_task(self.send(messages))
+
+    async def send(self, messages):
+        async with self.lock:
+            await broadcast(self.room_name, self.game_id, messages)
+
+
+# room name -> SpectatorFeed of the messages published by this process
+feeds = {}
+
+
+async def spectate(room_name, game_id, message):
+    """
+    Shows a message to the spectators of a room, right away unless a delay or
+    batching is configured.
+    """
+    if not settings.SPECTATOR_DELAY and not settings.SPECTATOR_BATCH_INTERVAL:
+        await broadcast(room_name, game_id, [message])
+        return
+    feed = feeds.get(room_name)
+    if feed is None:
+        feed = feeds[room_name] = SpectatorFeed(room_name, game_id)
+    feed.add(message, time.monotonic())
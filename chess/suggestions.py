@@ -0,0 +1,142 @@
+"""
+Friend suggestions: the users with the most friends in common with a user who are
+not yet friends with them. They are computed when first read, again when read after
+a friendship made them stale, and ahead of time by the compute_friend_suggestions
+command. They are stored packed, one little-endian (user id, mutual friends) pair of a
+32-bit and a 16-bit integer per candidate, best candidate first.
+"""
+
+import heapq
+import struct
+from collections import Counter
+from django.conf import settings
+from django.utils import timezone
+from .friends import friend_ids
+
+SUGGESTION_FORMAT = "<IH"
+# Users per IN clause when loading the friend graph
+GRAPH_CHUNK_SIZE = 1000
+
+
+def pack_suggestions(candidates):
+    return b"".join(
+        struct.pack(SUGGESTION_FORMAT, user_id, min(mutual, 0xFFFF))
+        for user_id, mutual in candidates
+    )
+
+
+def unpack_suggestions(data):
+    return list(struct.iter_unpack(SUGGESTION_FORMAT, data))
+
+
+def rank_candidates(user_id, graph, limit):
+    """
+    Returns the `limit` best (user id, mutual friends) candidates of a user.
+    The mutual friends of a candidate are the intersection of both friend sets,
+    counted for all candidates at once by walking the friends of the user's friends.
+    """
+    friends = graph.get(user_id, set())
+    mutual = Counter()
+    for friend_id in friends:
+        mutual.update(graph.get(friend_id, ()))
+    for known_id in friends:
+        mutual.pop(known_id, None)
+    mutual.pop(user_id, None)
+    return heapq.nsmallest(limit, mutual.items(), key=lambda item: (-item[1], item[0]))
+
+
+def load_graph(user_ids=None, graph=None):
+    """
+    Adds the friends of `user_ids`, or of every user, to a {user id: set of friend ids} graph.
+    """
+    from .models import Friendship
+
+    graph = {} if graph is None else graph
+    friendships = Friendship.objects.values_list("user_id", "friend_id")
+    if user_ids is None:
+        batches = [friendships.iterator(chunk_size=10000)]
+    else:
+        user_ids = sorted(set(user_ids) - graph.keys())
+        for user_id in user_ids:
+            graph[user_id] = set()
+        batches = (
+            friendships.filter(user_id__in=user_ids[start : start + GRAPH_CHUNK_SIZE])
+            for start in range(0, len(user_ids), GRAPH_CHUNK_SIZE)
+        )
+    for batch in batches:
+        for user_id, friend_id in batch:
+            graph.setdefault(user_id, set()).add(friend_id)
+    return graph
+
+
+def save_suggestions(user_ids, graph):
+    """
+    Ranks and stores the suggestions of users whose friends and friends' friends are
+    in the graph, returns {user id: candidates}.
+    """
+    from .models import FriendSuggestions
+
+    limit = settings.FRIEND_SUGGESTIONS_LIMIT
+    now = timezone.now()
+    suggestions = {user_id: rank_candidates(user_id, graph, limit) for user_id in user_ids}
+    FriendSuggestions.objects.bulk_create(
+        [
+            FriendSuggestions(
+                user_id=user_id,
+                candidates=pack_suggestions(candidates),
+                is_stale=False,
+                updated_at=now,
+            )
+            for user_id, candidates in suggestions.items()
+        ],
+        update_conflicts=True,
+        unique_fields=["user"],
+        update_fields=["candidates", "is_stale", "updated_at"],
+    )
+    return suggestions
+
+
+def refresh_suggestions(user_ids):
+    """
+    Recomputes the suggestions of some users, loading only the two levels of the
+    friend graph around them.
+    """
+    graph = load_graph(user_ids)
+    second_level = set().union(*(graph[user_id] for user_id in user_ids))
+    load_graph(second_level, graph)
+    return save_suggestions(user_ids, graph)
+
+
+def user_suggestions(user_id):
+    """
+    Returns the stored (user id, mutual friends) candidates of a user, computing them
+    on first use and again once a friendship made them stale. Users who became
+    friends since they were computed are left out.
+    """
+    from .models import FriendSuggestions
+
+    row = (
+        FriendSuggestions.objects.filter(user_id=user_id)
+        .values_list("candidates", "is_stale")
+        .first()
+    )
+    if row is None or row[1]:
+        # Loads only the two levels of the friend graph around the user
+        candidates = refresh_suggestions([user_id])[user_id]
+    else:
+        candidates = unpack_suggestions(row[0])
+    friends = friend_ids(user_id)
+    return [
+        (candidate_id, mutual) for candidate_id, mutual in candidates if candidate_id not in friends
+    ]
+
+
+def mark_suggestions_stale(user_id, other_id):
+    """
+    Flags the suggestions that a new or broken friendship between two users changes:
+    theirs and those of their friends, for whom one of them gained or lost a mutual friend.
+    """
+    from .models import FriendSuggestions
+
+    affected = {user_id, other_id} | friend_ids(user_id) | friend_ids(other_id)
+    FriendSuggestions.objects.filter(user_id__in=affected, is_stale=False).update(is_stale=True)
@@ -1,11 +1,63 @@
-from django.test import TestCase, RequestFactory
+import asyncio
+import json
+import time
+import timeit
+from unittest import mock
+from io import StringIO
+from django.test import TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.db.models import Q
+from django.core.management import call_command, CommandError
+from django.core.cache import cache
+from django.utils import timezone
 from .views import user_signin, CreateUserView
-from .models import User, Friendship, FriendRequest, UserChannel, Game
+from .search import search_users
+from .models import (
+    User,
+    Profile,
+    Friendship,
+    FriendSuggestions,
+    FriendRequest,
+    Game,
+    GameMove,
+    GameRequest,
+    Rating,
+    RatingHistory,
+)
+from .ratings import glicko2, time_control_category
+from .movelog import move_log
+from .packing import PackedMoves, pack_moves, unpack_moves
+from .pgn import game_pgn, iter_pgn
+from .presence import (
+    InMemoryPresenceStore,
+    get_presence_store,
+    presence_keeper,
+    user_group_name,
+)
+from .events import InMemoryGameEventStore, get_event_store
+from .clock import GameClock, TimerScheduler, normalize_time_control, parse_time_control
+from .leaderboard import InMemoryLeaderboard, get_leaderboard
+from .friends import are_friends, cache_key, friend_ids, lock_key
+from .suggestions import pack_suggestions, unpack_suggestions, user_suggestions
+from .matchmaking import MatchmakingQueue, Ticket, matchmaker
 from .serializers import UserSerializer, GameSerializer
 from rest_framework.test import APIClient
 from django.urls import reverse
 from channels.testing import WebsocketCommunicator
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
 from .consumers import MainConsumer
+from .engine import Board, WHITE, BLACK, STARTING_FEN, compact_move, parse_square
+from .live import LiveGame, live_games
+from .spectators import feeds, snapshots
+from .protocol import SLOW_CLIENT_CLOSE_CODE, SUBPROTOCOL, game_protocol, main_protocol
+from .throttling import CommandThrottle, SendWindow, TokenBucket
+from .management.commands import recompute_profile_stats
+from . import instrumentation, layers, metrics
+from .perft import REFERENCE_POSITIONS, perft
+from .routing import websocket_urlpatterns
+from channels.routing import URLRouter
 from core.asgi import application
 
 
@@ -18,6 +70,25 @@ class AuthWebsocketCommunicator(WebsocketCommunicator):
             self.scope["user"] = user
 
 
+class QueryBudgetMixin:
+    """
+    Asserts the queries an endpoint may make, as counted by InstrumentationMiddleware,
+    so that a query per listed row fails the test.
+    """
+
+    def assertQueryBudget(self, budget, url, params=None):
+        # Measured with a cold friend cache
+        cache.clear()
+        instrumentation.reset()
+        response = self.api_client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        (route,) = instrumentation.snapshot().values()
+        self.assertLessEqual(
+            route["max_queries"], budget, f"{url} made {route['max_queries']} queries"
+        )
+        return response
+
+
 class AuthViewTests(TestCase):
     def setUp(self):
         self.factory = RequestFactory()
@@ -81,11 +152,67 @@ class ProfileModelTests(TestCase):
         self.assertEqual(user_games.count(), 3)
 
     def test_user_wins_count(self):
-        self.games[0].finish(winner=self.user.pk)
-        self.games[1].finish(winner=self.user.pk)
+        self.games[0].finish(winner=self.user, finished_at=timezone.now())
+        self.games[1].finish(winner=self.user, finished_at=timezone.now())
+        self.user.profile.refresh_from_db()
         user_wins = self.user.profile.wins()
         self.assertEqual(user_wins, 2)
 
+    def test_finish_updates_counters(self):
+        self.games[0].finish(winner=self.user, finished_at=timezone.now())
+        self.games[1].finish(winner=None, finished_at=timezone.now())
+        self.games[2].finish(winner=self.friend, finished_at=timezone.now())
+        self.user.profile.refresh_from_db()
+        self.friend.profile.refresh_from_db()
+        self.assertEqual(
+            (self.user.profile.wins(), self.user.profile.losses(), self.user.profile.draws()),
+            (1, 1, 1),
+        )
+        self.assertEqual(
+            (self.friend.profile.wins(), self.friend.profile.losses(), self.friend.profile.draws()),
+            (1, 1, 1),
+        )
+
+    def test_finish_twice_counts_once(self):
+        self.games[0].finish(winner=self.user, finished_at=timezone.now())
+        self.games[0].finish(winner=self.user, finished_at=timezone.now())
+        self.user.profile.refresh_from_db()
+        self.assertEqual(self.user.profile.wins(), 1)
+
+    def test_recompute_profile_stats(self):
+        self.games[0].finish(winner=self.user, finished_at=timezone.now())
+        self.games[1].finish(winner=None, finished_at=timezone.now())
+        Profile.objects.update(win_count=7, loss_count=7, draw_count=7)
+        call_command("recompute_profile_stats", stdout=StringIO())
+        self.user.profile.refresh_from_db()
+        self.friend.profile.refresh_from_db()
+        self.assertEqual(
+            (self.user.profile.win_count, self.user.profile.loss_count, self.user.profile.draw_count),
+            (1, 0, 1),
+        )
+        self.assertEqual(
+            (self.friend.profile.win_count, self.friend.profile.loss_count, self.friend.profile.draw_count),
+            (0, 1, 1),
+        )
+
+
+    def test_recompute_profile_stats_keeps_games_finished_meanwhile(self):
+        self.games[0].finish(winner=self.user, finished_at=timezone.now())
+        Profile.objects.update(win_count=7, loss_count=7, draw_count=7)
+        recompute = recompute_profile_stats.Command.recompute
+
+        def finish_during_run(command, user_id):
+            # The game finishes after the counts that pick the profiles to fix
+            self.games[1].finish(winner=None, finished_at=timezone.now())
+            return recompute(command, user_id)
+
+        with mock.patch.object(recompute_profile_stats.Command, "recompute", finish_during_run):
+            call_command("recompute_profile_stats", stdout=StringIO())
+        self.user.profile.refresh_from_db()
+        self.assertEqual(
+            (self.user.profile.win_count, self.user.profile.loss_count, self.user.profile.draw_count),
+            (1, 0, 1),
+        )
 
 class ProfileTests(TestCase):
     def setUp(self):
@@ -103,13 +230,231 @@ class ProfileTests(TestCase):
         response = self.api_client.get(reverse("profile-game-list"))
         self.assertEqual(response.status_code, 200)
         serializer = GameSerializer(self.game)
-        self.assertEqual(response.data, [serializer.data])
+        self.assertEqual(response.data["results"], [serializer.data])
 
     def test_get_user_profile_by_id(self):
         response = self.api_client.get(reverse("user-detail", args=(self.user.pk,)))
         self.assertEqual(response.status_code, 200)
 
 
+class GameSerializerQueryTests(TestCase):
+    def setUp(self):
+        # Friend ids are cached across requests
+        cache.clear()
+        self.user = User.objects.create_user(
+            email="test@test.com", username="test", password="12345"
+        )
+        self.opponents = [
+            User.objects.create_user(
+                email=f"user{i}@test.com", username=f"user{i}", password="12345"
+            )
+            for i in range(5)
+        ]
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.user)
+
+    def play(self, count):
+        for i in range(count):
+            opponent = self.opponents[i % len(self.opponents)]
+            game = Game.objects.create(challenger=self.user, opponent=opponent)
+            game.finish(winner=self.user, finished_at=timezone.now())
+
+    def test_game_list_query_budget(self):
+        self.play(20)
+        # Games, friend ids and outgoing friend request ids
+        with self.assertNumQueries(3):
+            response = self.api_client.get(reverse("profile-game-list"))
+        self.assertEqual(len(response.data["results"]), 20)
+
+    def test_user_games_query_budget(self):
+        self.play(20)
+        # User with profile, games, friend ids and outgoing friend request ids
+        with self.assertNumQueries(4):
+            response = self.api_client.get(
+                reverse("user-game-list", args=(self.user.pk,))
+            )
+        self.assertEqual(len(response.data["results"]), 20)
+
+    def test_opponent_is_reused_player(self):
+        self.play(1)
+        response = self.api_client.get(reverse("profile-game-list"))
+        game = response.data["results"][0]
+        self.assertTrue(game["is_white"])
+        self.assertEqual(game["opponent"], game["black"])
+        self.assertEqual(game["winner"], "white")
+        self.assertTrue(game["is_winner"])
+
+
+class GameCursorPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email="test@test.com", username="test", password="12345"
+        )
+        self.friend = User.objects.create_user(
+            email="friend@test.com", username="friend", password="12345"
+        )
+        finished_at = timezone.now()
+        self.games = []
+        for _ in range(5):
+            game = Game.objects.create(challenger=self.user, opponent=self.friend)
+            # Equal timestamps make the id tie-breaker part of the cursor
+            game.finish(winner=self.user, finished_at=finished_at)
+            self.games.append(game)
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.user)
+
+    def test_walk_pages(self):
+        url = reverse("user-game-list", args=(self.user.pk,))
+        response = self.api_client.get(url, {"page_size": 2})
+        ids = [game["id"] for game in response.data["results"]]
+        # A game finished while paging must not shift the following pages
+        game = Game.objects.create(challenger=self.friend, opponent=self.user)
+        game.finish(winner=None, finished_at=timezone.now())
+        while response.data["next"]:
+            response = self.api_client.get(response.data["next"])
+            ids += [game["id"] for game in response.data["results"]]
+        self.assertEqual(ids, [game.pk for game in reversed(self.games)])
+
+    def test_invalid_cursor(self):
+        response = self.api_client.get(
+            reverse("profile-game-list"), {"cursor": "not-a-cursor"}
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class GameHistoryQueryTests(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(
+                email=f"user{index}@test.com", username=f"user{index}", password="12345"
+            )
+            for index in range(8)
+        ]
+        self.user = self.users[0]
+        start = timezone.now() - timezone.timedelta(days=365)
+        games = []
+        for index in range(5000):
+            challenger = self.users[index % 8]
+            opponent = self.users[(index * 3 + 1) % 8]
+            if challenger == opponent:
+                continue
+            games.append(
+                Game(
+                    challenger=challenger,
+                    opponent=opponent,
+                    is_active=index % 50 == 0,
+                    finished_at=None if index % 50 == 0 else start + timezone.timedelta(hours=index),
+                )
+            )
+        Game.objects.bulk_create(games)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def query_plans(self, run):
+        with CaptureQueriesContext(connection) as context:
+            run()
+        prefix = "EXPLAIN " if connection.vendor == "postgresql" else "EXPLAIN QUERY PLAN "
+        plans = []
+        with connection.cursor() as cursor:
+            for query in context.captured_queries:
+                cursor.execute(prefix + query["sql"])
+                plans.append("\n".join(" ".join(map(str, row)) for row in cursor.fetchall()))
+        return plans
+
+    def assertNoSequentialScan(self, plans):
+        self.assertTrue(plans)
+        for plan in plans:
+            self.assertNotIn("Seq Scan", plan)
+            # SQLite reports index lookups as SEARCH and full scans as SCAN
+            self.assertNotRegex(plan, r"\bSCAN\b")
+
+    def test_games_from_both_sides(self):
+        expected = list(
+            Game.objects.filter(
+                Q(challenger=self.user) | Q(opponent=self.user), is_active=False
+            ).order_by("-finished_at", "-id")
+        )
+        self.assertEqual(list(self.user.profile.games()), expected)
+        last = expected[9]
+        page = self.user.profile.games(before=(last.finished_at, last.pk), limit=10)[:10]
+        self.assertEqual(list(page), expected[10:20])
+
+    def test_history_queries_use_indexes(self):
+        profile = self.user.profile
+        last = profile.games()[20]
+        self.assertNoSequentialScan(self.query_plans(lambda: list(profile.games(limit=21)[:21])))
+        self.assertNoSequentialScan(
+            self.query_plans(
+                lambda: list(profile.games(before=(last.finished_at, last.pk), limit=21)[:21])
+            )
+        )
+        self.assertNoSequentialScan(self.query_plans(profile.is_playing))
+
+
+class EndpointQueryBudgetTests(QueryBudgetMixin, TestCase):
+    # Queries per request, whatever the number of rows listed
+    budgets = [
+        ("home", (), None, 3),
+        ("profile-game-list", (), None, 3),
+        ("user-game-list", ("user",), None, 4),
+        ("profile-friend-list", (), None, 3),
+        ("user-friend-list", ("user",), None, 4),
+        ("profile-request-list", (), None, 3),
+        ("profile-suggestion-list", (), None, 7),
+        ("user-list", (), {"query": "user"}, 3),
+        ("leaderboard", ("category",), None, 2),
+    ]
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email="test@test.com", username="user", password="12345"
+        )
+        self.others = [
+            User.objects.create_user(
+                email=f"user{index}@test.com", username=f"user{index}", password="12345"
+            )
+            for index in range(6)
+        ]
+        for other in self.others[:3]:
+            self.user.friends.add(other)
+            other.friends.add(self.user)
+        for other in self.others[3:]:
+            FriendRequest.objects.create(sender=other, receiver=self.user)
+        self.others[0].friends.add(self.others[3])
+        self.others[3].friends.add(self.others[0])
+        for index, other in enumerate(self.others):
+            game = Game.objects.create(challenger=self.user, opponent=other, time_control="5+0")
+            game.finish(winner=self.user if index % 2 else other, finished_at=timezone.now())
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.user)
+
+    def tearDown(self):
+        get_leaderboard.cache_clear()
+        cache.clear()
+
+    def test_query_budgets(self):
+        kwargs = {"user": self.user.pk, "category": "blitz"}
+        for name, args, params, budget in self.budgets:
+            with self.subTest(name):
+                url = reverse(name, args=[kwargs[arg] for arg in args])
+                self.assertQueryBudget(budget, url, params)
+
+    @override_settings(DEBUG=True)
+    def test_debug_headers(self):
+        response = self.assertQueryBudget(3, reverse("home"))
+        self.assertEqual(response["X-Query-Count"], "3")
+        self.assertRegex(response["Server-Timing"], r"^db;dur=[\d.]+, total;dur=[\d.]+$")
+        second = self.api_client.get(reverse("home"))
+        totals = instrumentation.snapshot()["GET home"]
+        self.assertEqual(
+            (totals["count"], totals["queries"]), (2, 3 + int(second["X-Query-Count"]))
+        )
+
+    def test_no_debug_headers(self):
+        response = self.api_client.get(reverse("home"))
+        self.assertNotIn("X-Query-Count", response)
+
+
 class UserListViewTests(TestCase):
     def setUp(self):
         usernames = ["oscar", "john", "alice", "bob", "william"]
@@ -128,11 +473,115 @@ class UserListViewTests(TestCase):
         self.assertEqual(len(response.data), 0)
 
     def test_with_query_params(self):
-        response = self.api_client.get(reverse("user-list"), {"query": "o"})
+        response = self.api_client.get(reverse("user-list"), {"query": "lia"})
         self.assertEqual(response.status_code, 200)
         data = response.data
-        self.assertEqual(len(data), 2)
-        self.assertEqual([user["username"] for user in data], ["john", "bob"])
+        self.assertEqual(len(data), 1)
+        self.assertEqual([user["username"] for user in data], ["william"])
+
+
+class UserSearchTests(TestCase):
+    def setUp(self):
+        self.viewer = User.objects.create_user(
+            username="viewer", email="viewer@test.com", password="12345"
+        )
+        for username, first_name in [
+            ("kasparov", ""),
+            ("bob", ""),
+            ("bobby", ""),
+            ("mr.bob", ""),
+            ("player", "Bobbie"),
+        ]:
+            User.objects.create_user(
+                username=username,
+                email=f"{username}@test.com",
+                password="12345",
+                first_name=first_name,
+            )
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.viewer)
+
+    def test_exact_and_prefix_matches_first(self):
+        response = self.api_client.get(reverse("user-list"), {"query": "Bob"})
+        self.assertEqual(
+            [user["username"] for user in response.data],
+            ["bob", "bobby", "player", "mr.bob"],
+        )
+
+    def test_short_queries_match_username_prefixes(self):
+        response = self.api_client.get(reverse("user-list"), {"query": "Bo"})
+        self.assertEqual([user["username"] for user in response.data], ["bob", "bobby"])
+        response = self.api_client.get(reverse("user-list"), {"query": "b_"})
+        self.assertEqual(response.data, [])
+
+    def test_blank_query_matches_nobody(self):
+        response = self.api_client.get(reverse("user-list"), {"query": "   "})
+        self.assertEqual(response.data, [])
+        self.assertEqual(list(search_users(User.objects.all(), " ")), [])
+
+    @override_settings(USER_SEARCH_LIMIT=2)
+    def test_result_limit(self):
+        response = self.api_client.get(reverse("user-list"), {"query": "bob"})
+        self.assertEqual([user["username"] for user in response.data], ["bob", "bobby"])
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command("bench_user_search", seed=50, repeat=1, queries=["al"], stdout=out)
+        self.assertIn("'al':", out.getvalue())
+
+
+class UserListSerializerTests(TestCase):
+    def setUp(self):
+        # Friend ids are cached across requests
+        cache.clear()
+        self.user = User.objects.create_user(
+            email="test@test.com", username="test", password="12345"
+        )
+        self.others = [
+            User.objects.create_user(
+                email=f"user{i}@test.com", username=f"user{i}", password="12345"
+            )
+            for i in range(6)
+        ]
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.user)
+
+    def befriend(self, other):
+        self.user.friends.add(other)
+        other.friends.add(self.user)
+
+    def count_queries(self, url, params=None):
+        # Compared with a cold friend cache every time
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.api_client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_relations_annotated_from_memory(self):
+        self.befriend(self.others[0])
+        FriendRequest.objects.create(sender=self.user, receiver=self.others[1])
+        response = self.api_client.get(reverse("user-list"), {"query": "user"})
+        flags = {
+            row["username"]: (row["is_friend"], row["is_requested"])
+            for row in response.data
+        }
+        self.assertEqual(flags["user0"], (True, False))
+        self.assertEqual(flags["user1"], (False, True))
+        self.assertEqual(flags["user2"], (False, False))
+
+    def test_friend_list_query_count_is_constant(self):
+        self.befriend(self.others[0])
+        url = reverse("profile-friend-list")
+        queries_for_one = self.count_queries(url)
+        for other in self.others[1:]:
+            self.befriend(other)
+        self.assertEqual(self.count_queries(url), queries_for_one)
+
+    def test_search_query_count_is_constant(self):
+        url = reverse("user-list")
+        queries_for_one = self.count_queries(url, {"query": "user0"})
+        self.assertEqual(self.count_queries(url, {"query": "user"}), queries_for_one)
 
 
 class FriendshipModelTests(TestCase):
@@ -187,6 +636,8 @@ class FriendRequestModelTests(TestCase):
 
 class FriendRequestViewTests(TestCase):
     def setUp(self):
+        # Friend ids are cached across requests
+        cache.clear()
         self.user = User.objects.create_user(
             email="test@test.com", username="test", password="12345"
         )
@@ -250,6 +701,1287 @@ class FriendRequestViewTests(TestCase):
         self.assertNotIn(self.friend, self.user.friends.all())
 
 
+class FriendGraphCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            email="test@test.com", username="test", password="12345"
+        )
+        self.friend = User.objects.create_user(
+            email="friend@test.com", username="friend", password="12345"
+        )
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_friend_ids_are_cached(self):
+        with self.assertNumQueries(1):
+            self.assertFalse(are_friends(self.user.pk, self.friend.pk))
+        with self.assertNumQueries(0):
+            self.assertFalse(are_friends(self.user.pk, self.friend.pk))
+
+    def test_accept_and_break_invalidate(self):
+        friend_ids(self.user.pk)
+        friend_ids(self.friend.pk)
+        friend_request = FriendRequest.objects.create(sender=self.friend, receiver=self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            friend_request.accept()
+        self.assertTrue(are_friends(self.user.pk, self.friend.pk))
+        self.assertTrue(are_friends(self.friend.pk, self.user.pk))
+        with self.captureOnCommitCallbacks(execute=True):
+            Friendship.objects.filter(user=self.user).first().break_friendship()
+        self.assertEqual(friend_ids(self.user.pk), frozenset())
+        self.assertEqual(friend_ids(self.friend.pk), frozenset())
+
+    def test_stale_set_is_served_while_another_request_reloads(self):
+        cache.set(cache_key(self.user.pk), (0, frozenset([self.friend.pk])))
+        cache.add(lock_key(self.user.pk), 1)
+        with self.assertNumQueries(0):
+            self.assertTrue(are_friends(self.user.pk, self.friend.pk))
+        cache.delete(lock_key(self.user.pk))
+        with self.assertNumQueries(1):
+            self.assertFalse(are_friends(self.user.pk, self.friend.pk))
+
+    @mock.patch("chess.friends.LOCK_WAIT", 0.05)
+    def test_missing_set_is_loaded_once_lock_expires(self):
+        cache.add(lock_key(self.user.pk), 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(friend_ids(self.user.pk), frozenset())
+
+
+class FriendSuggestionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.users = [
+            User.objects.create_user(
+                email=f"user{i}@test.com", username=f"user{i}", password="12345"
+            )
+            for i in range(6)
+        ]
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.users[0])
+
+    def tearDown(self):
+        cache.clear()
+
+    def befriend(self, first, second):
+        friend_request = FriendRequest.objects.create(
+            sender=self.users[first], receiver=self.users[second]
+        )
+        friend_request.accept()
+
+    def stale_ids(self):
+        return list(FriendSuggestions.objects.filter(is_stale=True).values_list("user_id", flat=True))
+
+    def test_pack_round_trip(self):
+        candidates = [(1, 3), (2**32 - 1, 1)]
+        data = pack_suggestions(candidates)
+        self.assertEqual(len(data), 12)
+        self.assertEqual(unpack_suggestions(data), candidates)
+
+    def test_ranked_by_mutual_friends(self):
+        # user0 - user1, user0 - user2; user3 shares both, user4 shares one
+        for first, second in [(0, 1), (0, 2), (1, 3), (2, 3), (2, 4), (1, 5)]:
+            self.befriend(first, second)
+        out = StringIO()
+        call_command("compute_friend_suggestions", all=True, stdout=out)
+        self.assertIn("Refreshed the suggestions of 6 users", out.getvalue())
+        response = self.api_client.get(reverse("profile-suggestion-list"))
+        self.assertEqual(
+            [(row["id"], row["mutual_friends"]) for row in response.data],
+            [(self.users[3].pk, 2), (self.users[4].pk, 1), (self.users[5].pk, 1)],
+        )
+        self.assertFalse(response.data[0]["is_friend"])
+
+    def test_friendship_changes_refresh_incrementally(self):
+        for first, second in [(0, 1), (1, 2)]:
+            self.befriend(first, second)
+        self.assertEqual(user_suggestions(self.users[0].pk), [(self.users[2].pk, 1)])
+        self.befriend(2, 3)
+        # user0's suggestions do not depend on user3's friends
+        self.assertNotIn(self.users[0].pk, self.stale_ids())
+        self.befriend(0, 2)
+        self.assertIn(self.users[0].pk, self.stale_ids())
+        # A stale row is recomputed when it is read
+        self.assertEqual(user_suggestions(self.users[0].pk), [(self.users[3].pk, 1)])
+        self.assertNotIn(self.users[0].pk, self.stale_ids())
+        out = StringIO()
+        call_command("compute_friend_suggestions", stdout=out)
+        self.assertFalse(FriendSuggestions.objects.filter(is_stale=True).exists())
+
+    def test_stale_row_refreshed_without_the_command(self):
+        url = reverse("profile-suggestion-list")
+        self.assertEqual(self.api_client.get(url).data, [])
+        for first, second in [(0, 1), (1, 2)]:
+            self.befriend(first, second)
+        response = self.api_client.get(url)
+        self.assertEqual(
+            [(row["id"], row["mutual_friends"]) for row in response.data],
+            [(self.users[2].pk, 1)],
+        )
+
+
+@override_settings(
+    PRESENCE_STORE={"BACKEND": "chess.presence.InMemoryPresenceStore"}
+)
+class PresenceTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email="test@test.com", username="test", password="12345"
+        )
+        self.friend = User.objects.create_user(
+            email="friend@test.com", username="friend", password="12345"
+        )
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.user)
+
+    def test_entries_expire(self):
+        store = InMemoryPresenceStore(ttl=0)
+        store.connect(self.user.pk, "channel")
+        self.assertFalse(store.is_online(self.user.pk))
+
+    def test_online_until_last_connection_closes(self):
+        store = InMemoryPresenceStore()
+        self.assertEqual(store.connect(self.user.pk, "phone"), 1)
+        self.assertEqual(store.connect(self.user.pk, "laptop"), 2)
+        self.assertEqual(store.disconnect(self.user.pk, "phone"), 1)
+        self.assertTrue(store.is_online(self.user.pk))
+        self.assertEqual(store.disconnect(self.user.pk, "laptop"), 0)
+        self.assertFalse(store.is_online(self.user.pk))
+
+    async def test_main_consumer_registers_presence(self):
+        communicator = AuthWebsocketCommunicator(
+            MainConsumer.as_asgi(), "/ws/main", user=self.user
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertTrue(get_presence_store().is_online(self.user.pk))
+        await communicator.disconnect()
+        self.assertFalse(get_presence_store().is_online(self.user.pk))
+
+    @override_settings(
+        PRESENCE_STORE={
+            "BACKEND": "chess.presence.InMemoryPresenceStore",
+            "OPTIONS": {"ttl": 0.3},
+        }
+    )
+    async def test_idle_socket_stays_online(self):
+        communicator = AuthWebsocketCommunicator(
+            MainConsumer.as_asgi(), "/ws/main", user=self.user
+        )
+        await communicator.connect()
+        # The client sends nothing for longer than the ttl
+        await asyncio.sleep(0.6)
+        self.assertTrue(get_presence_store().is_online(self.user.pk))
+        await communicator.disconnect()
+        self.assertFalse(get_presence_store().is_online(self.user.pk))
+        self.assertEqual(presence_keeper.connections, {})
+
+    async def test_events_reach_every_device(self):
+        devices = [
+            AuthWebsocketCommunicator(MainConsumer.as_asgi(), "/ws/main", user=self.user)
+            for _ in range(2)
+        ]
+        for device in devices:
+            await device.connect()
+        self.assertEqual(get_presence_store().count(self.user.pk), 2)
+        await get_channel_layer().group_send(
+            user_group_name(self.user.pk),
+            {"type": "on.challenge.accept", "game_id": 1},
+        )
+        for device in devices:
+            response = await device.receive_json_from()
+            self.assertEqual(response, {"type": "challenge_accepted", "game_id": 1})
+        await devices[0].disconnect()
+        self.assertTrue(get_presence_store().is_online(self.user.pk))
+        await devices[1].disconnect()
+        self.assertFalse(get_presence_store().is_online(self.user.pk))
+
+    def test_challenge_offline_user(self):
+        response = self.api_client.post(
+            reverse("game-challenge-send", args=(self.friend.pk,))
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_challenge_online_user(self):
+        get_presence_store().connect(self.friend.pk, "friend-channel")
+        response = self.api_client.post(
+            reverse("game-challenge-send", args=(self.friend.pk,))
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(GameRequest.objects.get().time_control, "10+0")
+
+    def test_challenge_with_invalid_time_control(self):
+        get_presence_store().connect(self.friend.pk, "friend-channel")
+        response = self.api_client.post(
+            reverse("game-challenge-send", args=(self.friend.pk,)), {"time_control": "fast"}
+        )
+        self.assertEqual(response.status_code, 400)
+        response = self.api_client.post(
+            reverse("game-challenge-send", args=(self.friend.pk,)), {"time_control": "inf+0"}
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_challenge_time_control_is_normalized(self):
+        get_presence_store().connect(self.friend.pk, "friend-channel")
+        response = self.api_client.post(
+            reverse("game-challenge-send", args=(self.friend.pk,)), {"time_control": "05.0+03"}
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(GameRequest.objects.get().time_control, "5+3")
+
+
+class RatingTests(TestCase):
+    def setUp(self):
+        self.white = User.objects.create_user(
+            email="white@test.com", username="white", password="12345"
+        )
+        self.black = User.objects.create_user(
+            email="black@test.com", username="black", password="12345"
+        )
+
+    def play(self, winner, time_control="3+2"):
+        game = Game.objects.create(
+            challenger=self.white, opponent=self.black, time_control=time_control
+        )
+        game.finish(winner, timezone.now())
+        return game
+
+    def ratings(self):
+        return {
+            (rating.user_id, rating.category): (round(rating.rating, 6), rating.games)
+            for rating in Rating.objects.all()
+        }
+
+    def test_glicko2_reference_example(self):
+        rating, deviation, volatility = glicko2(
+            1500, 200, 0.06, [(1400, 30, 1), (1550, 100, 0), (1700, 300, 0)]
+        )
+        self.assertAlmostEqual(rating, 1464.06, delta=0.01)
+        self.assertAlmostEqual(deviation, 151.52, delta=0.01)
+        self.assertAlmostEqual(volatility, 0.05999, delta=0.00001)
+
+    def test_time_control_category(self):
+        self.assertEqual(time_control_category("1+0"), "bullet")
+        self.assertEqual(time_control_category("3+2"), "blitz")
+        self.assertEqual(time_control_category("10+0"), "rapid")
+        self.assertEqual(time_control_category("30+20"), "classical")
+        self.assertEqual(time_control_category(""), "correspondence")
+
+    def test_finish_rates_players_once(self):
+        game = self.play(self.white)
+        white = Rating.objects.get(user=self.white, category="blitz")
+        black = Rating.objects.get(user=self.black, category="blitz")
+        self.assertGreater(white.rating, 1500)
+        self.assertAlmostEqual(white.rating - 1500, 1500 - black.rating)
+        self.assertLess(white.deviation, 350)
+        game.finish(self.black, timezone.now())
+        self.assertEqual(RatingHistory.objects.filter(game=game).count(), 2)
+        self.assertEqual(Rating.objects.get(pk=white.pk).games, 1)
+
+    def test_recompute_replays_history(self):
+        for winner in (self.white, None, self.black):
+            self.play(winner)
+        self.play(self.white, time_control="")
+        expected = self.ratings()
+        Rating.objects.update(rating=0)
+        out = StringIO()
+        call_command("recompute_ratings", batch_size=3, stdout=out)
+        self.assertIn("Replayed 4 games into 4 ratings", out.getvalue())
+        self.assertEqual(self.ratings(), expected)
+        self.assertEqual(RatingHistory.objects.count(), 8)
+
+
+class LeaderboardTests(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(
+                email=f"player{i}@test.com", username=f"player{i}", password="12345"
+            )
+            for i in range(5)
+        ]
+        Rating.objects.bulk_create(
+            [
+                Rating(user=user, category="blitz", rating=rating)
+                for user, rating in zip(self.users, [1500, 1700, 1400, 1600, 1650])
+            ]
+        )
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.users[0])
+
+    def tearDown(self):
+        get_leaderboard.cache_clear()
+        cache.clear()
+
+    def test_rank_queries(self):
+        board = InMemoryLeaderboard()
+        ids = [user.pk for user in self.users]
+        self.assertEqual([user_id for user_id, _ in board.top("blitz", 3)], [ids[1], ids[4], ids[3]])
+        self.assertEqual(board.rank("blitz", ids[0]), 3)
+        self.assertIsNone(board.rank("bullet", ids[0]))
+        board.update("blitz", [(ids[2], 1800)])
+        self.assertEqual(board.rank("blitz", ids[2]), 0)
+        self.assertEqual(board.size("blitz"), 5)
+        start, entries = board.around("blitz", ids[3], 1)
+        self.assertEqual(start, 2)
+        self.assertEqual([user_id for user_id, _ in entries], [ids[4], ids[3], ids[0]])
+
+    def test_finished_game_updates_leaderboard(self):
+        self.assertEqual(get_leaderboard().rank("blitz", self.users[2].pk), 4)
+        game = Game.objects.create(
+            challenger=self.users[2], opponent=self.users[1], time_control="3+2"
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            game.finish(self.users[2], timezone.now())
+        rating = Rating.objects.get(user=self.users[2], category="blitz")
+        self.assertEqual(get_leaderboard().ratings["blitz"][self.users[2].pk], rating.rating)
+        self.assertLess(get_leaderboard().rank("blitz", self.users[2].pk), 4)
+
+    def test_top_endpoint(self):
+        response = self.api_client.get(reverse("leaderboard", args=["blitz"]), {"limit": 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["players"], 5)
+        self.assertEqual(
+            response.data["results"],
+            [
+                {"rank": 1, "user": {"id": self.users[1].pk, "username": "player1"}, "rating": 1700},
+                {"rank": 2, "user": {"id": self.users[4].pk, "username": "player4"}, "rating": 1650},
+            ],
+        )
+        with self.assertNumQueries(0):
+            self.api_client.get(reverse("leaderboard", args=["blitz"]), {"limit": 2})
+        response = self.api_client.get(reverse("leaderboard", args=["chess960"]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_rank_endpoint(self):
+        response = self.api_client.get(reverse("leaderboard-rank", args=["blitz"]), {"count": 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["rank"], 4)
+        self.assertEqual(response.data["rating"], 1500)
+        self.assertEqual([entry["rank"] for entry in response.data["results"]], [3, 4, 5])
+        response = self.api_client.get(reverse("leaderboard-rank", args=["bullet"]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_rebuild_command(self):
+        get_leaderboard().update("blitz", [(self.users[0].pk, 2000)])
+        call_command("rebuild_leaderboard", stdout=StringIO())
+        self.assertEqual(get_leaderboard().rank("blitz", self.users[0].pk), 3)
+
+
+class MatchmakingTests(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(
+                email=f"player{i}@test.com", username=f"player{i}", password="12345"
+            )
+            for i in range(2)
+        ]
+
+    def tearDown(self):
+        matchmaker.queues.clear()
+        matchmaker.queued.clear()
+
+    def test_closest_rating_within_window(self):
+        queue = MatchmakingQueue()
+        now = time.monotonic()
+        for user_id, rating in enumerate([1500, 1900, 1530, 1300]):
+            queue.add(Ticket(user_id, f"player{user_id}", "channel", rating, now))
+        pairs = queue.pairs(now)
+        self.assertEqual([(a.user_id, b.user_id) for a, b in pairs], [(0, 2)])
+        self.assertEqual(len(queue), 2)
+
+    def test_window_widens_while_waiting(self):
+        queue = MatchmakingQueue()
+        now = time.monotonic()
+        queue.add(Ticket(1, "player1", "channel", 1500, now - 30))
+        queue.add(Ticket(2, "player2", "channel", 1800, now))
+        self.assertEqual(queue.pairs(now - 25), [])
+        self.assertEqual(len(queue.pairs(now)), 1)
+
+    async def test_queued_players_are_matched(self):
+        sockets = [
+            AuthWebsocketCommunicator(MainConsumer.as_asgi(), "/ws/main", user=user)
+            for user in self.users
+        ]
+        for socket in sockets:
+            await socket.connect()
+            await socket.send_json_to({"command": "queue", "time_control": "3+2"})
+            self.assertEqual(await socket.receive_json_from(), {"type": "queued", "time_control": "3+2"})
+        games = await matchmaker.pair()
+        self.assertEqual(len(games), 1)
+        matches = [await socket.receive_json_from() for socket in sockets]
+        self.assertEqual({match["game_id"] for match in matches}, {games[0].pk})
+        self.assertEqual({match["color"] for match in matches}, {"white", "black"})
+        self.assertEqual(matches[0]["opponent"]["username"], "player1")
+        game = await Game.objects.aget(pk=games[0].pk)
+        self.assertEqual(game.time_control, "3+2")
+        self.assertEqual(matchmaker.queued, {})
+        for socket in sockets:
+            await socket.disconnect()
+
+    async def test_players_with_a_game_in_progress_are_not_queued(self):
+        await Game.objects.acreate(challenger=self.users[0], opponent=self.users[1])
+        socket = AuthWebsocketCommunicator(MainConsumer.as_asgi(), "/ws/main", user=self.users[0])
+        await socket.connect()
+        await socket.send_json_to({"command": "queue", "time_control": "3+2"})
+        self.assertEqual(
+            await socket.receive_json_from(), {"type": "error", "message": "You are already playing"}
+        )
+        self.assertEqual(matchmaker.queued, {})
+        await socket.disconnect()
+
+    async def test_players_who_started_a_game_meanwhile_are_not_paired(self):
+        third = await database_sync_to_async(User.objects.create_user)(
+            email="player2@test.com", username="player2", password="12345"
+        )
+        sockets = [
+            AuthWebsocketCommunicator(MainConsumer.as_asgi(), "/ws/main", user=user)
+            for user in self.users
+        ]
+        for socket in sockets:
+            await socket.connect()
+            await socket.send_json_to({"command": "queue", "time_control": "3+2"})
+            await socket.receive_json_from()
+        # A challenge was accepted while the first player was waiting
+        await Game.objects.acreate(challenger=self.users[0], opponent=third)
+        self.assertEqual(await matchmaker.pair(), [])
+        self.assertEqual(await sockets[0].receive_json_from(), {"type": "queue_left"})
+        self.assertTrue(await sockets[1].receive_nothing())
+        self.assertEqual(list(matchmaker.queued), [self.users[1].pk])
+        for socket in sockets:
+            await socket.disconnect()
+
+    async def test_disconnect_leaves_queue(self):
+        socket = AuthWebsocketCommunicator(MainConsumer.as_asgi(), "/ws/main", user=self.users[0])
+        await socket.connect()
+        for time_control in ("untimed", "1e400+0"):
+            await socket.send_json_to({"command": "queue", "time_control": time_control})
+            self.assertEqual((await socket.receive_json_from())["type"], "error")
+        await socket.send_json_to({"command": "queue", "time_control": "1+0"})
+        await socket.receive_json_from()
+        self.assertIn(self.users[0].pk, matchmaker.queued)
+        await socket.disconnect()
+        self.assertEqual(matchmaker.queued, {})
+
+
+class GameEventStoreTests(TestCase):
+    def test_since(self):
+        store = InMemoryGameEventStore(size=2)
+        for ply in range(1, 4):
+            self.assertEqual(store.append(1, {"ply": ply})["seq"], ply)
+        self.assertEqual(store.since(1, 3), [])
+        self.assertEqual(store.since(1, 1), [{"ply": 2, "seq": 2}, {"ply": 3, "seq": 3}])
+        # The first event has been evicted, as have events of unknown games
+        self.assertIsNone(store.since(1, 0))
+        self.assertIsNone(store.since(2, 5))
+        self.assertEqual(store.since(2, 0), [])
+
+    def test_idle_games_expire(self):
+        store = InMemoryGameEventStore(ttl=0)
+        store.append(1, {})
+        self.assertEqual(store.last_seq(1), 0)
+
+
+class ClockTests(TestCase):
+    def test_parse_time_control(self):
+        self.assertEqual(parse_time_control("3+2"), (180000, 2000))
+        self.assertEqual(parse_time_control("0.5+0"), (30000, 0))
+        self.assertIsNone(parse_time_control(""))
+        for value in (
+            "3", "0+1", "a+b", "3+-1", "inf+0", "1e400+0", "10+1e999", " 3 + 2 ", "181+0", 5
+        ):
+            with self.assertRaises(ValueError):
+                parse_time_control(value)
+
+    def test_normalize_time_control(self):
+        self.assertEqual(normalize_time_control("03.0+2"), "3+2")
+        self.assertEqual(normalize_time_control("0.50+000"), "0.5+0")
+        self.assertEqual(normalize_time_control(""), "")
+        with self.assertRaises(ValueError):
+            normalize_time_control("3 +2")
+
+    def test_press(self):
+        clock = GameClock(60000, 1000)
+        # The clock starts with the first move, which costs nothing
+        self.assertEqual(clock.press(100.0), 60000)
+        self.assertEqual(clock.time_left(BLACK, 102.5), 57500)
+        self.assertEqual(clock.press(102.5), 58500)
+        self.assertEqual(clock.as_dict(103.0), {"white": 59500, "black": 58500})
+        self.assertEqual(clock.deadline(), 102.5 + 60)
+        self.assertFalse(clock.is_flagged(162.0))
+        self.assertTrue(clock.is_flagged(162.5))
+
+    async def test_scheduler_uses_one_loop_handle(self):
+        scheduler = TimerScheduler()
+        fired = []
+        now = time.monotonic()
+        timers = [scheduler.schedule(now + delay, fired.append, delay) for delay in (0.03, 0.01, 0.02)]
+        scheduler.cancel(timers[2])
+        self.assertEqual(len(scheduler), 2)
+        self.assertEqual(scheduler.handle_deadline, now + 0.01)
+        await asyncio.sleep(0.05)
+        self.assertEqual(fired, [0.01, 0.03])
+        self.assertIsNone(scheduler.handle)
+        self.assertEqual(len(scheduler), 0)
+
+    async def test_cancelled_timers_are_compacted(self):
+        scheduler = TimerScheduler()
+        deadline = time.monotonic() + 60
+        timers = [scheduler.schedule(deadline + i, print) for i in range(1000)]
+        for timer in timers[:900]:
+            scheduler.cancel(timer)
+        self.assertLess(len(scheduler.heap), 500)
+        self.assertEqual(len(scheduler), 100)
+
+
+class BoardTests(TestCase):
+    def play(self, board, *moves):
+        for uci in moves:
+            board.push(board.parse_uci(uci))
+
+    def test_starting_position(self):
+        board = Board()
+        self.assertEqual(len(board.legal_moves()), 20)
+        self.assertIsNone(board.outcome())
+
+    def test_checkmate(self):
+        board = Board()
+        self.play(board, "f2f3", "e7e5", "g2g4", "d8h4")
+        outcome = board.outcome()
+        self.assertEqual((outcome.reason, outcome.winner, outcome.result), ("checkmate", BLACK, "0-1"))
+
+    def test_stalemate(self):
+        board = Board("7k/5Q2/6K1/8/8/8/8/8 b - - 0 1")
+        self.assertEqual(board.outcome().reason, "stalemate")
+
+    def test_threefold_repetition(self):
+        board = Board()
+        for _ in range(2):
+            self.play(board, "g1f3", "g8f6", "f3g1", "f6g8")
+        self.assertEqual(board.outcome().reason, "threefold_repetition")
+
+    def test_fifty_moves(self):
+        board = Board("7k/8/8/8/8/8/8/R6K w - - 99 80")
+        self.play(board, "a1a2")
+        self.assertEqual(board.outcome().reason, "fifty_moves")
+
+    def test_king_cannot_stay_in_check(self):
+        board = Board("4k3/8/8/8/8/8/8/r3K3 w - - 0 1")
+        self.assertTrue(board.is_check())
+        self.assertIsNone(board.find_move(parse_square("e1"), parse_square("f1")))
+        self.assertIsNotNone(board.find_move(parse_square("e1"), parse_square("e2")))
+        with self.assertRaises(ValueError):
+            board.parse_uci("e1d1")
+
+    def test_special_moves_round_trip_fen(self):
+        board = Board("r3k2r/8/8/8/3pP3/8/8/R3K2R b KQkq e3 0 1")
+        self.play(board, "d4e3", "e1g1", "e8c8")
+        self.assertEqual(board.fen(), "2kr3r/8/8/8/8/4p3/8/R4RK1 w - - 2 3")
+        board.pop()
+        self.assertEqual(board.fen(), "r3k2r/8/8/8/8/4p3/8/R4RK1 b kq - 1 2")
+
+    def test_san(self):
+        cases = [
+            (STARTING_FEN, "g1f3", "Nf3"),
+            ("rnbqkbnr/ppppp2p/5p2/6p1/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 3", "d1h5", "Qh5#"),
+            ("r3k2r/8/8/8/3pP3/8/8/R3K2R b KQkq e3 0 1", "d4e3", "dxe3"),
+            ("r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1", "e1g1", "O-O"),
+            ("r3k2r/8/8/8/8/8/8/R3K2R b KQkq - 0 1", "e8c8", "O-O-O"),
+            ("k7/8/8/K7/8/8/8/R6R w - - 0 1", "a1d1", "Rad1"),
+            ("7k/R7/8/8/8/8/8/R6K w - - 0 1", "a1a4", "R1a4"),
+            ("8/8/8/7k/8/Q7/8/Q1Q1K3 w - - 0 1", "a1b2", "Qa1b2"),
+            ("7k/P7/8/8/8/8/8/K7 w - - 0 1", "a7a8q", "a8=Q+"),
+        ]
+        for fen, uci, san in cases:
+            with self.subTest(uci=uci):
+                board = Board(fen)
+                self.assertEqual(board.san(board.parse_uci(uci)), san)
+                self.assertEqual(board.fen(), Board(fen).fen())
+
+
+class PerftTests(TestCase):
+    def test_reference_positions(self):
+        for name, fen, counts in REFERENCE_POSITIONS:
+            with self.subTest(position=name):
+                self.assertEqual(perft(Board(fen), 2), counts[1])
+
+    def test_initial_position_depth_3(self):
+        self.assertEqual(perft(Board(), 3), 8902)
+
+    def test_command_reports_nodes_per_second(self):
+        out = StringIO()
+        call_command("perft", depth=2, stdout=out)
+        self.assertIn("nps", out.getvalue())
+        self.assertNotIn("MISMATCH", out.getvalue())
+
+    def test_command_fails_on_mismatch(self):
+        with self.assertRaises(CommandError):
+            call_command(
+                "perft", depth=1, fen=REFERENCE_POSITIONS[0][1], expected=21, stdout=StringIO()
+            )
+
+    def test_command_rejects_depths_below_one(self):
+        for depth in (0, -1):
+            with self.assertRaises(CommandError):
+                call_command("perft", depth=depth, stdout=StringIO())
+
+
+class GameConsumerTests(TestCase):
+    def setUp(self):
+        self.white = User.objects.create_user(
+            email="white@test.com", username="white", password="12345"
+        )
+        self.black = User.objects.create_user(
+            email="black@test.com", username="black", password="12345"
+        )
+        self.game = Game.objects.create(challenger=self.white, opponent=self.black)
+        self.path = f"/ws/games/game-{self.game.pk}/"
+
+    def tearDown(self):
+        live_games.clear()
+        move_log.pending.clear()
+        feeds.clear()
+        snapshots.clear()
+        get_event_store.cache_clear()
+
+    async def join(self, user, path=None):
+        communicator = AuthWebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), path or self.path, user=user
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_legal_move_is_relayed(self):
+        white = await self.join(self.white)
+        black = await self.join(self.black)
+        await white.send_json_to({"command": "move", "from": "e2", "to": "e4"})
+        for player in (white, black):
+            message = await player.receive_json_from()
+            self.assertEqual(message["msg_type"], "move")
+            self.assertEqual(message["player"], "white")
+        await white.disconnect()
+        await black.disconnect()
+
+    async def test_messages_are_instrumented(self):
+        instrumentation.reset()
+        white = await self.join(self.white)
+        await white.send_json_to({"command": "move", "from": "e2", "to": "e4"})
+        await white.receive_json_from()
+        await white.disconnect()
+        routes = instrumentation.snapshot()
+        self.assertGreater(routes["GameConsumer websocket.connect"]["queries"], 0)
+        self.assertEqual(routes["GameConsumer move"]["count"], 1)
+        self.assertEqual(routes["GameConsumer chess.move"]["count"], 1)
+
+    async def test_connections_and_sends_are_measured(self):
+        connects = instrumentation.connects.labels("GameConsumer")
+        open_sockets = instrumentation.connections.labels("GameConsumer")
+        group_sends = layers.send_duration.labels("group_send")
+        before = (connects.value, open_sockets.value, sum(group_sends.counts))
+        white = await self.join(self.white)
+        self.assertEqual(open_sockets.value, before[1] + 1)
+        self.assertEqual(layers.group_sizes[f"game-{self.game.pk}"], 1)
+        self.assertIn('channel_layer_group_size_bucket{kind="game",le="1"} 1', metrics.render())
+        await white.send_json_to({"command": "move", "from": "e2", "to": "e4"})
+        await white.receive_json_from()
+        await white.disconnect()
+        self.assertEqual(connects.value, before[0] + 1)
+        self.assertEqual(open_sockets.value, before[1])
+        self.assertGreater(sum(group_sends.counts), before[2])
+
+    async def test_resign(self):
+        white = await self.join(self.white)
+        black = await self.join(self.black)
+        await black.send_json_to({"command": "resign"})
+        for player in (white, black):
+            message = await player.receive_json_from()
+            self.assertEqual(
+                (message["msg_type"], message["reason"], message["winner"]),
+                ("end", "resignation", "white"),
+            )
+        await black.send_json_to({"command": "resign"})
+        self.assertEqual((await black.receive_json_from())["message"], "The game is over")
+        await white.disconnect()
+        await black.disconnect()
+        game = await Game.objects.aget(pk=self.game.pk)
+        self.assertEqual((game.is_active, game.winner), (False, self.white.pk))
+
+    def test_finish_endpoint_reports_only_server_results(self):
+        api_client = APIClient()
+        api_client.force_authenticate(user=self.white)
+        url = reverse("game-finish", args=(self.game.pk,))
+        # The winner is not the client's to choose
+        response = api_client.post(url, {"winner": "white"}, format="json")
+        self.assertEqual(response.status_code, 409)
+        self.game.refresh_from_db()
+        self.assertTrue(self.game.is_active)
+
+    def test_finish_endpoint_ends_game_on_time(self):
+        # Black has been thinking for two minutes of a one minute game
+        self.game.time_control = "1+0"
+        self.game.save()
+        board = Board()
+        GameMove.objects.create(
+            game=self.game,
+            ply=1,
+            move=compact_move(board.parse_uci("e2e4")),
+            clock=60000,
+            created_at=timezone.now() - timezone.timedelta(minutes=2),
+        )
+        api_client = APIClient()
+        api_client.force_authenticate(user=self.white)
+        url = reverse("game-finish", args=(self.game.pk,))
+        response = api_client.post(url, {"winner": "white"}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {"result": "1-0", "winner": "white"})
+        self.game.refresh_from_db()
+        self.assertEqual((self.game.is_active, self.game.winner), (False, self.white.pk))
+        # Reporting it again returns the same result
+        self.assertEqual(api_client.post(url).data, {"result": "1-0", "winner": "white"})
+
+    def test_resign_endpoint(self):
+        api_client = APIClient()
+        api_client.force_authenticate(user=self.white)
+        url = reverse("game-resign", args=(self.game.pk,))
+        response = api_client.post(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {"result": "0-1", "winner": "black"})
+        self.game.refresh_from_db()
+        self.assertEqual((self.game.is_active, self.game.winner), (False, self.black.pk))
+        self.assertEqual(api_client.post(url).status_code, 409)
+
+    async def test_illegal_and_out_of_turn_moves_are_rejected(self):
+        white = await self.join(self.white)
+        black = await self.join(self.black)
+        await white.send_json_to({"command": "move", "from": "e2", "to": "e5"})
+        self.assertEqual((await white.receive_json_from())["message"], "Illegal move")
+        await black.send_json_to({"command": "move", "from": "e7", "to": "e5"})
+        self.assertEqual((await black.receive_json_from())["message"], "It is not your turn")
+        self.assertTrue(await black.receive_nothing())
+        await white.disconnect()
+        await black.disconnect()
+
+    async def test_checkmate_finishes_game(self):
+        white = await self.join(self.white)
+        black = await self.join(self.black)
+        moves = [(white, "f2", "f3"), (black, "e7", "e5"), (white, "g2", "g4"), (black, "d8", "h4")]
+        for player, from_square, to_square in moves:
+            await player.send_json_to({"command": "move", "from": from_square, "to": to_square})
+            await white.receive_json_from()
+            await black.receive_json_from()
+        end = await white.receive_json_from()
+        self.assertEqual(
+            end,
+            {"msg_type": "end", "result": "0-1", "reason": "checkmate", "winner": "black", "clock": None, "seq": 5},
+        )
+        await self.game.arefresh_from_db()
+        self.assertFalse(self.game.is_active)
+        self.assertEqual(self.game.winner, self.black.pk)
+        await white.disconnect()
+        await black.disconnect()
+
+    async def test_promotion(self):
+        live_games[f"game-{self.game.pk}"] = live_game = LiveGame(
+            self.game.pk, self.white.pk, self.black.pk, Board("7k/P7/8/8/8/8/8/K7 w - - 0 1")
+        )
+        white = await self.join(self.white)
+        await white.send_json_to({"command": "move", "from": "a7", "to": "a8"})
+        await white.receive_json_from()
+        self.assertEqual(live_game.board.ply, 0)
+        await white.send_json_to({"command": "promote", "square": "a8", "piece": "queen"})
+        message = await white.receive_json_from()
+        self.assertEqual(message["msg_type"], "promote")
+        self.assertEqual(live_game.board.fen(), "Q6k/8/8/8/8/8/8/K7 b - - 0 1")
+        await white.disconnect()
+
+
+    async def test_moves_are_logged_in_batches(self):
+        white = await self.join(self.white)
+        black = await self.join(self.black)
+        for player, from_square, to_square in [(white, "e2", "e4"), (black, "e7", "e5")]:
+            await player.send_json_to({"command": "move", "from": from_square, "to": to_square})
+            await white.receive_json_from()
+            await black.receive_json_from()
+        self.assertEqual(await GameMove.objects.acount(), 0)
+        await white.disconnect()
+        plies = [move.ply async for move in GameMove.objects.order_by("ply")]
+        self.assertEqual(plies, [1, 2])
+        await black.disconnect()
+        # The board is rebuilt from the log once nobody holds the game in memory
+        self.assertEqual(live_games, {})
+        white = await self.join(self.white)
+        board = live_games[f"game-{self.game.pk}"].board
+        self.assertEqual(board.fen(), "rnbqkbnr/pppp1ppp/8/4p3/4P3/8/PPPP1PPP/RNBQKBNR w KQkq e6 0 2")
+        await white.disconnect()
+
+    async def play(self, white, black, moves):
+        players = {"w": white, "b": black}
+        for color, from_square, to_square in moves:
+            await players[color].send_json_to({"command": "move", "from": from_square, "to": to_square})
+            for player in (white, black):
+                await player.receive_json_from()
+
+    @override_settings(WEBSOCKET_SEND_WINDOW=2)
+    async def test_clients_that_do_not_acknowledge_are_closed(self):
+        white = await self.join(self.white)
+        black = await self.join(self.black)
+        await self.play(white, black, [("w", "e2", "e4"), ("b", "e7", "e5")])
+        await white.send_json_to({"command": "ack", "received": 2})
+        await white.send_json_to({"command": "move", "from": "g1", "to": "f3"})
+        self.assertEqual((await white.receive_json_from())["seq"], 3)
+        self.assertEqual(
+            await black.receive_output(), {"type": "websocket.close", "code": SLOW_CLIENT_CLOSE_CODE}
+        )
+        await black.disconnect()
+        await white.disconnect()
+
+    async def test_events_are_numbered(self):
+        white = await self.join(self.white)
+        await white.send_json_to({"command": "move", "from": "e2", "to": "e4"})
+        self.assertEqual((await white.receive_json_from())["seq"], 1)
+        await white.send_json_to({"command": "move", "from": "e2", "to": "e4"})
+        # Errors are personal and not numbered
+        self.assertNotIn("seq", await white.receive_json_from())
+        await white.disconnect()
+
+    async def test_reconnect_receives_missed_events(self):
+        white = await self.join(self.white)
+        black = await self.join(self.black)
+        await self.play(white, black, [("w", "e2", "e4"), ("b", "e7", "e5")])
+        await black.disconnect()
+        await white.send_json_to({"command": "move", "from": "g1", "to": "f3"})
+        await white.receive_json_from()
+        black = await self.join(self.black, f"{self.path}?last_seq=2")
+        self.assertEqual((await black.receive_json_from())["seq"], 3)
+        self.assertTrue(await black.receive_nothing())
+        await white.disconnect()
+        await black.disconnect()
+
+    @override_settings(
+        GAME_EVENT_STORE={
+            "BACKEND": "chess.events.InMemoryGameEventStore",
+            "OPTIONS": {"size": 1},
+        }
+    )
+    async def test_reconnect_after_eviction_receives_snapshot(self):
+        white = await self.join(self.white)
+        black = await self.join(self.black)
+        await self.play(white, black, [("w", "e2", "e4"), ("b", "e7", "e5"), ("w", "g1", "f3")])
+        black_again = await self.join(self.black, f"{self.path}?last_seq=1")
+        snapshot = await black_again.receive_json_from()
+        self.assertEqual(snapshot["msg_type"], "snapshot")
+        self.assertEqual(snapshot["seq"], 3)
+        self.assertEqual(snapshot["moves"], ["e2e4", "e7e5", "g1f3"])
+        await black.send_json_to({"command": "move", "from": "b8", "to": "c6"})
+        self.assertEqual((await black_again.receive_json_from())["seq"], 4)
+        for player in (white, black, black_again):
+            await player.disconnect()
+
+    async def test_moves_carry_server_clock(self):
+        self.game.time_control = "1+2"
+        await self.game.asave()
+        white = await self.join(self.white)
+        black = await self.join(self.black)
+        await self.play(white, black, [("w", "e2", "e4")])
+        await black.send_json_to({"command": "move", "from": "e7", "to": "e5"})
+        message = await white.receive_json_from()
+        self.assertEqual(message["clock"]["white"], 60000)
+        self.assertGreater(message["clock"]["black"], 60000)
+        self.assertLessEqual(message["clock"]["black"], 62000)
+        await black.receive_json_from()
+        await white.disconnect()
+        clocks = [move.clock async for move in GameMove.objects.order_by("ply")]
+        self.assertEqual(clocks[0], 60000)
+        self.assertEqual(clocks[1], message["clock"]["black"])
+        await black.disconnect()
+
+    async def test_flag_fall_ends_game(self):
+        self.game.time_control = "0.002+0"
+        await self.game.asave()
+        white = await self.join(self.white)
+        black = await self.join(self.black)
+        await self.play(white, black, [("w", "e2", "e4")])
+        end = await white.receive_json_from(timeout=2)
+        self.assertEqual((end["reason"], end["winner"]), ("timeout", "white"))
+        self.assertEqual(end["clock"]["black"], 0)
+        await self.game.arefresh_from_db()
+        self.assertFalse(self.game.is_active)
+        self.assertEqual(self.game.winner, self.white.pk)
+        await white.disconnect()
+        await black.disconnect()
+
+    @override_settings(MOVE_LOG_FLUSH_INTERVAL=0.01)
+    async def test_moves_are_flushed_on_interval(self):
+        white = await self.join(self.white)
+        await white.send_json_to({"command": "move", "from": "e2", "to": "e4"})
+        await white.receive_json_from()
+        await move_log.task
+        self.assertEqual(await GameMove.objects.acount(), 1)
+        await white.disconnect()
+
+    async def test_non_players_cannot_join_as_players(self):
+        watcher = await database_sync_to_async(User.objects.create_user)(
+            email="watcher@test.com", username="watcher", password="12345"
+        )
+        communicator = AuthWebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), self.path, user=watcher
+        )
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertEqual(live_games, {})
+
+    async def test_spectators_share_one_encoding(self):
+        white = await self.join(self.white)
+        spectators = [await self.join(self.white, f"{self.path}watch/") for _ in range(3)]
+        with mock.patch("chess.protocol.json.dumps", wraps=json.dumps) as dumps:
+            await white.send_json_to({"command": "move", "from": "e2", "to": "e4"})
+            await white.receive_json_from()
+            for spectator in spectators:
+                message = await spectator.receive_json_from()
+                self.assertEqual(message["msg_type"], "move")
+                self.assertEqual(message["seq"], 1)
+                self.assertEqual(
+                    message["fen"], "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1"
+                )
+        # One encoding for the players and one for all spectators
+        encoded = [call.args[0] for call in dumps.call_args_list if "seq" in call.args[0]]
+        self.assertEqual(len(encoded), 2)
+        # Spectators are read-only
+        await spectators[0].send_json_to({"command": "move", "from": "e7", "to": "e5"})
+        self.assertTrue(await white.receive_nothing())
+        for communicator in (white, *spectators):
+            await communicator.disconnect()
+
+    @override_settings(SPECTATOR_DELAY=0.05, SPECTATOR_BATCH_INTERVAL=0.05)
+    async def test_spectators_get_delayed_batches(self):
+        white = await self.join(self.white)
+        black = await self.join(self.black)
+        spectator = await self.join(self.white, f"{self.path}watch/")
+        await self.play(white, black, [("w", "e2", "e4"), ("b", "e7", "e5")])
+        self.assertTrue(await spectator.receive_nothing(timeout=0.03))
+        frame = await spectator.receive_json_from(timeout=1)
+        self.assertEqual(frame["msg_type"], "batch")
+        self.assertEqual(frame["seq"], 1)
+        self.assertEqual([event["from"] for event in frame["events"]], ["e2", "e7"])
+        # Late spectators get the position after the frames released so far
+        late = await self.join(self.black, f"{self.path}watch/")
+        snapshot = await late.receive_json_from()
+        self.assertEqual((snapshot["msg_type"], snapshot["seq"]), ("snapshot", 1))
+        self.assertEqual(snapshot["fen"], frame["events"][-1]["fen"])
+        # Reconnecting ones get the frames they missed
+        resumed = await self.join(self.black, f"{self.path}watch/?last_seq=0")
+        self.assertEqual(await resumed.receive_json_from(), frame)
+        for communicator in (white, black, spectator, late, resumed):
+            await communicator.disconnect()
+
+    async def test_joining_spectators_share_one_snapshot(self):
+        white = await self.join(self.white)
+        black = await self.join(self.black)
+        await self.play(white, black, [("w", "e2", "e4"), ("b", "e7", "e5"), ("w", "g1", "f3")])
+        with mock.patch("chess.protocol.json.dumps", wraps=json.dumps) as dumps:
+            spectators = [await self.join(self.white, f"{self.path}watch/") for _ in range(3)]
+            for spectator in spectators:
+                snapshot = await spectator.receive_json_from()
+                self.assertEqual((snapshot["msg_type"], snapshot["seq"]), ("snapshot", 3))
+                self.assertTrue(await spectator.receive_nothing())
+        self.assertEqual(dumps.call_count, 1)
+        for communicator in (white, black, *spectators):
+            await communicator.disconnect()
+
+    @override_settings(
+        GAME_EVENT_STORE={
+            "BACKEND": "chess.events.InMemoryGameEventStore",
+            "OPTIONS": {"size": 1},
+        }
+    )
+    async def test_late_spectator_gets_snapshot_after_eviction(self):
+        white = await self.join(self.white)
+        black = await self.join(self.black)
+        await self.play(white, black, [("w", "e2", "e4"), ("b", "e7", "e5")])
+        spectator = await self.join(self.white, f"{self.path}watch/")
+        snapshot = await spectator.receive_json_from()
+        self.assertEqual(snapshot["msg_type"], "snapshot")
+        self.assertEqual(snapshot["seq"], 2)
+        self.assertEqual(
+            snapshot["fen"], "rnbqkbnr/pppp1ppp/8/4p3/4P3/8/PPPP1PPP/RNBQKBNR w KQkq e6 0 2"
+        )
+        for communicator in (white, black, spectator):
+            await communicator.disconnect()
+
+    async def test_msgpack_subprotocol(self):
+        white = AuthWebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), self.path, subprotocols=[SUBPROTOCOL], user=self.white
+        )
+        connected, subprotocol = await white.connect()
+        self.assertEqual(subprotocol, SUBPROTOCOL)
+        black = await self.join(self.black)
+        await white.send_to(
+            bytes_data=game_protocol.encode_command({"command": "move", "from": "e2", "to": "e4"})
+        )
+        message = game_protocol.decode_message(await white.receive_from())
+        self.assertEqual((message["msg_type"], message["seq"], message["to"]), ("move", 1, "e4"))
+        # JSON clients of the same room are unaffected
+        self.assertEqual(await black.receive_json_from(), message)
+        await white.send_to(bytes_data=b"\xc1")
+        self.assertTrue(await white.receive_nothing())
+        await white.disconnect()
+        await black.disconnect()
+
+    @override_settings(WEBSOCKET_RATE_LIMITS={"move": (0.001, 1)})
+    async def test_move_flood_is_throttled(self):
+        white = await self.join(self.white)
+        throttled = metrics.value("websocket_commands_throttled", command="move")
+        await white.send_json_to({"command": "move", "from": "e2", "to": "e4"})
+        self.assertEqual((await white.receive_json_from())["msg_type"], "move")
+        await white.send_json_to({"command": "move", "from": "d2", "to": "d4"})
+        self.assertEqual((await white.receive_json_from())["message"], "Too many requests")
+        self.assertEqual(
+            metrics.value("websocket_commands_throttled", command="move"), throttled + 1
+        )
+        await white.disconnect()
+
+    @override_settings(MOVE_STORAGE="packed")
+    async def test_packed_move_storage(self):
+        white = await self.join(self.white)
+        black = await self.join(self.black)
+        for player, from_square, to_square in [(white, "e2", "e4"), (black, "e7", "e5")]:
+            await player.send_json_to({"command": "move", "from": from_square, "to": to_square})
+            await white.receive_json_from()
+            await black.receive_json_from()
+        await white.disconnect()
+        await black.disconnect()
+        self.assertEqual(await GameMove.objects.acount(), 0)
+        await self.game.arefresh_from_db()
+        self.assertEqual(len(self.game.packed_moves), 4)
+        white = await self.join(self.white)
+        board = live_games[f"game-{self.game.pk}"].board
+        self.assertEqual(board.fen(), "rnbqkbnr/pppp1ppp/8/4p3/4P3/8/PPPP1PPP/RNBQKBNR w KQkq e6 0 2")
+        await white.disconnect()
+
+
+class ProtocolTests(TestCase):
+    def test_round_trip(self):
+        message = {
+            "msg_type": "move",
+            "player": "white",
+            "from": "e2",
+            "to": "e4",
+            "timestamp": None,
+            "clock": {"white": 59000, "black": 60000},
+            "seq": 3,
+        }
+        data = game_protocol.encode_message(message)
+        self.assertEqual(game_protocol.decode_message(data), message)
+        self.assertLess(len(data), len(json.dumps(message)) / 3)
+        batch = {"msg_type": "batch", "seq": 4, "events": [message, {**message, "fen": "8/8"}]}
+        self.assertEqual(game_protocol.decode_message(game_protocol.encode_message(batch)), batch)
+        command = {"command": "queue", "time_control": "3+2"}
+        self.assertEqual(main_protocol.decode_command(main_protocol.encode_command(command)), command)
+
+    def test_malformed_frames(self):
+        for frame in ([], [99], [1, "e2", "e4", None, None, "extra"], {"command": 1}):
+            with self.subTest(frame=frame), self.assertRaises(ValueError):
+                game_protocol.commands.unpack(frame)
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command("bench_protocol", plies=10, repeat=1, stdout=out)
+        self.assertIn("json:", out.getvalue())
+        self.assertIn("msgpack:", out.getvalue())
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email="test@test.com", username="test", password="12345"
+        )
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.user)
+
+    def test_histogram_buckets(self):
+        histogram = metrics.HistogramValue((0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertAlmostEqual(histogram.sum, 3.65)
+
+    @override_settings(DEBUG=True)
+    def test_exposition(self):
+        self.api_client.get(reverse("home"))
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        lines = response.content.decode().splitlines()
+        self.assertIn("# TYPE http_request_duration_seconds histogram", lines)
+        self.assertIn("live_games 0", lines)
+        buckets = [
+            int(line.rsplit(" ", 1)[1])
+            for line in lines
+            if line.startswith('http_request_duration_seconds_bucket{route="GET home"')
+        ]
+        self.assertEqual(len(buckets), len(metrics.LATENCY_BUCKETS) + 1)
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertIn(
+            f'http_request_duration_seconds_count{{route="GET home"}} {buckets[-1]}', lines
+        )
+
+    def test_closed_without_token(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 404)
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_token(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+        response = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+
+    def test_observation_cost(self):
+        histogram = instrumentation.request_duration.labels("GET home")
+        counter = instrumentation.connects.labels("GameConsumer")
+        for observe in (lambda: histogram.observe(0.003), counter.inc):
+            # Best of a few runs, in seconds per observation
+            cost = min(timeit.repeat(observe, number=100000, repeat=5)) / 100000
+            self.assertLess(cost, 1e-6)
+
+
+class ThrottlingTests(TestCase):
+    def test_token_bucket_refills(self):
+        bucket = TokenBucket(2, 2, now=0)
+        self.assertTrue(bucket.take(0))
+        self.assertTrue(bucket.take(0))
+        self.assertFalse(bucket.take(0.1))
+        self.assertTrue(bucket.take(0.5))
+        self.assertFalse(bucket.take(0.5))
+
+    def test_commands_share_the_default_bucket(self):
+        throttle = CommandThrottle({"move": (1, 1), "*": (1, 2)})
+        self.assertTrue(throttle.allow("move", 0))
+        self.assertFalse(throttle.allow("move", 0))
+        self.assertTrue(throttle.allow("chat", 0))
+        self.assertTrue(throttle.allow(["not", "hashable"], 0))
+        self.assertFalse(throttle.allow(None, 0))
+
+    def test_send_window(self):
+        window = SendWindow(2)
+        dropped = metrics.value("websocket_frames_dropped")
+        self.assertEqual(window.put("snapshot"), "snapshot")
+        self.assertEqual(window.put("move"), "move")
+        # The client has acknowledged nothing, later spectator frames replace held ones
+        for seq in range(1, 4):
+            self.assertIsNone(window.put(f"frame {seq}", droppable=True))
+        with self.assertRaises(OverflowError):
+            window.put("end")
+        self.assertEqual(window.ack(1), "frame 3")
+        self.assertIsNone(window.ack(1))
+        self.assertEqual(len(window), 2)
+        # Frames that were never sent cannot be acknowledged
+        self.assertIsNone(window.ack(10))
+        self.assertEqual(len(window), 0)
+        self.assertIsNone(window.ack("2"))
+        self.assertEqual(metrics.value("websocket_frames_dropped"), dropped + 2)
+
+
+class MovePackingTests(TestCase):
+    def test_round_trip(self):
+        codes = [0, 1, 0x7FFF, 12 | 28 << 6]
+        data = pack_moves(codes)
+        self.assertEqual(len(data), 2 * len(codes))
+        self.assertEqual(unpack_moves(data), codes)
+
+    def test_packed_moves_sequence(self):
+        moves = PackedMoves(pack_moves([5, 6, 7]))
+        self.assertEqual(len(moves), 3)
+        self.assertEqual(moves[0], 5)
+        self.assertEqual(moves[-1], 7)
+        self.assertEqual(moves[1:], [6, 7])
+        self.assertEqual(list(moves), [5, 6, 7])
+        with self.assertRaises(IndexError):
+            moves[3]
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command("bench_move_storage", games=5, plies=4, reads=2, stdout=out)
+        self.assertIn("packed:", out.getvalue())
+        self.assertEqual(Game.objects.count(), 0)
+
+
+class PgnExportTests(TestCase):
+    def setUp(self):
+        self.white = User.objects.create_user(
+            email="white@test.com", username="white", password="12345"
+        )
+        self.black = User.objects.create_user(
+            email="black@test.com", username="black", password="12345"
+        )
+
+    def play(self, *moves, winner=None, packed=False):
+        board = Board()
+        codes = []
+        for uci in moves:
+            move = board.parse_uci(uci)
+            codes.append(compact_move(move))
+            board.push(move)
+        game = Game.objects.create(
+            challenger=self.white,
+            opponent=self.black,
+            packed_moves=pack_moves(codes) if packed else b"",
+        )
+        if not packed:
+            GameMove.objects.bulk_create(
+                [GameMove(game=game, ply=ply, move=code) for ply, code in enumerate(codes, 1)]
+            )
+        game.finish(winner, timezone.now())
+        return game
+
+    def test_game_pgn(self):
+        game = self.play("f2f3", "e7e5", "g2g4", "d8h4", winner=self.black)
+        pgn = game_pgn(Game.objects.select_related("challenger", "opponent").get(pk=game.pk))
+        self.assertIn('[White "white"]\n[Black "black"]\n[Result "0-1"]\n', pgn)
+        self.assertTrue(pgn.endswith("\n\n1. f3 e5 2. g4 Qh4# 0-1\n\n"))
+
+    def test_long_games_are_wrapped(self):
+        game = self.play(*["g1f3", "g8f6", "f3g1", "f6g8"] * 10, packed=True)
+        pgn = game_pgn(Game.objects.select_related("challenger", "opponent").get(pk=game.pk))
+        movetext = pgn.split("\n\n")[1].splitlines()
+        self.assertGreater(len(movetext), 1)
+        self.assertTrue(all(len(line) <= 80 for line in movetext))
+        self.assertTrue(movetext[-1].endswith("1/2-1/2"))
+
+    def test_query_count_does_not_grow_with_games(self):
+        for _ in range(10):
+            self.play("e2e4", "e7e5")
+        # Games with players and the moves of the chunk
+        with self.assertNumQueries(2):
+            pgn = "".join(iter_pgn(Game.objects.all()))
+        self.assertEqual(pgn.count("1. e4 e5 1/2-1/2"), 10)
+
+    async def test_stream_user_games(self):
+        await database_sync_to_async(self.play)("e2e4", winner=self.white)
+        await database_sync_to_async(self.play)("d2d4", "d7d5", packed=True)
+        response = await self.async_client.get(
+            reverse("user-game-pgn", args=(self.black.pk,))
+        )
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/x-chess-pgn")
+        pgn = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertEqual(pgn.count("[Event "), 2)
+        self.assertIn("1. d4 d5 1/2-1/2", pgn)
+        self.assertIn("1. e4 1-0", pgn)
+
+    async def test_stream_stats_recorded_when_the_body_ends(self):
+        await database_sync_to_async(self.play)("e2e4", winner=self.white)
+        instrumentation.reset()
+        response = await self.async_client.get(
+            reverse("user-game-pgn", args=(self.black.pk,))
+        )
+        self.assertNotIn("GET user-game-pgn", instrumentation.snapshot())
+        b"".join([chunk async for chunk in response.streaming_content])
+        stats = instrumentation.snapshot()["GET user-game-pgn"]
+        self.assertEqual(stats["count"], 1)
+        # The games are queried while the body is streamed
+        self.assertGreater(stats["queries"], 0)
+
+
 # class GameAPIViewsTests(TestCase):
 # def setUp(self):
 #     self.user = User.objects.create_user(
@@ -0,0 +1,114 @@
+"""
+Flow control of websocket connections: token buckets limit what a client may send,
+a window of unacknowledged frames limits what it may be sent.
+
+The ASGI server's send() does not tell when a frame has reached the client, daphne's
+returns as soon as the frame is buffered in its transport. Clients therefore
+acknowledge the frames they have received, and a socket never has more than a
+window of frames in flight, whatever the server buffers for it.
+"""
+
+from . import metrics
+
+# Bucket of the frames whose command has no limit of its own
+OTHER_COMMANDS = "*"
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = now
+
+    def take(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class CommandThrottle:
+    """
+    Token buckets of one connection, one per command type.
+    `limits` maps commands to (tokens per second, burst), see WEBSOCKET_RATE_LIMITS.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.buckets = {}
+
+    def bucket_name(self, command):
+        return command if isinstance(command, str) and command in self.limits else OTHER_COMMANDS
+
+    def allow(self, command, now):
+        name = self.bucket_name(command)
+        if name not in self.limits:
+            return True
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            bucket = self.buckets[name] = TokenBucket(*self.limits[name], now)
+        return bucket.take(now)
+
+
+class SendWindow:
+    """
+    Counts the frames sent to a client that it has not acknowledged yet, at most `size`.
+    While the window is full, droppable frames are superseded by later ones,
+    e.g. spectator updates that carry the whole position: the latest one is held back
+    and sent once the client acknowledges.
+    """
+
+    __slots__ = ("size", "sent", "acked", "held", "closed")
+
+    def __init__(self, size):
+        self.size = size
+        self.sent = 0
+        self.acked = 0
+        # Latest droppable frame that did not fit
+        self.held = None
+        self.closed = False
+
+    def __len__(self):
+        return self.sent - self.acked
+
+    def is_full(self):
+        return len(self) >= self.size
+
+    def put(self, frame, droppable=False):
+        """
+        Returns the frame to send now, None when it does not fit. Raises OverflowError
+        when it does not fit and may not be dropped.
+        """
+        if self.closed:
+            return None
+        if self.is_full():
+            if not droppable:
+                raise OverflowError("Send window is full")
+            if self.held is not None:
+                metrics.increment("websocket_frames_dropped")
+            self.held = frame
+            return None
+        self.sent += 1
+        return frame
+
+    def ack(self, received):
+        """
+        Records that the client has received `received` frames since the socket opened,
+        returns the held frame that may be sent now, if any.
+        """
+        if isinstance(received, int) and not isinstance(received, bool):
+            self.acked = max(self.acked, min(received, self.sent))
+        if self.held is None or self.is_full() or self.closed:
+            return None
+        frame, self.held = self.held, None
+        self.sent += 1
+        return frame
+
+    def close(self):
+        self.closed = True
+        self.held = None
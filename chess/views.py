@@ -2,6 +2,17 @@ from django.contrib.auth import authenticate, login, logout
 from rest_framework import status, generics
 from rest_framework.exceptions import AuthenticationFailed
 from .serializers import UserSerializer, FriendRequestSerialier, GameSerializer
+from .pagination import GameCursorPagination
+from .search import search_users
+from .pgn import aiter_pgn
+from .clock import normalize_time_control
+from .leaderboard import get_leaderboard
+from .friends import are_friends, friend_ids
+from .suggestions import user_suggestions
+from .ratings import CATEGORIES
+from .engine import WHITE, BLACK
+from .live import resign_live_game, settle_game
+from . import metrics
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework.response import Response
 from rest_framework.decorators import (
@@ -10,11 +21,16 @@ from rest_framework.decorators import (
     authentication_classes,
 )
 from rest_framework.permissions import IsAuthenticated, AllowAny
-from .models import User, Friendship, FriendRequest, Game, GameRequest, UserChannel
+from .models import User, Friendship, FriendRequest, Game, GameRequest
+from .presence import get_presence_store, user_group_name
 from django.shortcuts import get_object_or_404
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from django.db.models import Q
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden, StreamingHttpResponse, Http404
+from django.utils.crypto import constant_time_compare
+from django.core.cache import cache
 
 
 # Create your views here.
@@ -75,10 +91,10 @@ class CreateUserView(generics.CreateAPIView):
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def home(request):
-    games = request.user.profile.games()[:5]
+    games = request.user.profile.games(limit=5)[:5]
     serializer = GameSerializer(games, many=True, context={"request": request, "user": request.user})
     response_data = {"games": serializer.data}
-    if games.exists():
+    if serializer.data:
         latest_game = serializer.data[0]
         response_data["latest_game"] = latest_game
     return Response(response_data, status=status.HTTP_200_OK)
@@ -89,17 +105,13 @@ class UserListView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return User.objects.exclude(pk=self.request.user.pk)
+        return User.objects.exclude(pk=self.request.user.pk).select_related("profile")
 
     def get(self, request, *args, **kwargs):
-        query = request.GET.get("query", "")
+        query = request.GET.get("query", "").strip()
         if not query:
             return Response([])
-        queryset = self.get_queryset().filter(
-            Q(username__icontains=query)
-            | Q(first_name__icontains=query)
-            | Q(last_name__icontains=query)
-        )
+        queryset = search_users(self.get_queryset(), query)
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
@@ -124,7 +136,40 @@ class ProfileFriendListView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return self.request.user.friends
+        return User.objects.filter(pk__in=friend_ids(self.request.user.pk)).select_related(
+            "profile"
+        )
+
+
+def query_int(request, name, default, maximum):
+    try:
+        value = int(request.query_params[name])
+    except (KeyError, ValueError):
+        return default
+    return max(1, min(value, maximum))
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def friend_suggestions(request):
+    """
+    Users with friends in common with the user, most mutual friends first.
+    """
+    limit = query_int(request, "limit", 10, settings.FRIEND_SUGGESTIONS_LIMIT)
+    suggestions = user_suggestions(request.user.pk)[:limit]
+    users = User.objects.select_related("profile").in_bulk(
+        [user_id for user_id, _ in suggestions]
+    )
+    suggestions = [
+        (users[user_id], mutual) for user_id, mutual in suggestions if user_id in users
+    ]
+    serializer = UserSerializer(
+        [user for user, _ in suggestions], many=True, context={"request": request}
+    )
+    data = serializer.data
+    for row, (_, mutual) in zip(data, suggestions):
+        row["mutual_friends"] = mutual
+    return Response(data)
 
 
 class FriendRequestListView(generics.ListAPIView):
@@ -133,16 +178,22 @@ class FriendRequestListView(generics.ListAPIView):
 
     def get_queryset(self):
         user = self.request.user
-        return FriendRequest.objects.filter(receiver=user, is_active=True)
+        return FriendRequest.objects.filter(receiver=user, is_active=True).select_related(
+            "sender__profile"
+        )
 
 
 class ProfileGameListView(generics.ListAPIView):
     serializer_class = GameSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = GameCursorPagination
 
     def get_queryset(self):
         return self.request.user.profile.games()
 
+    def paginate_queryset(self, queryset):
+        return self.paginator.paginate_games(self.request.user.profile.games, self.request)
+
 
 class FriendListView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
@@ -153,18 +204,31 @@ class FriendListView(generics.ListAPIView):
         queryset = self.get_queryset()
         pk = kwargs["pk"]
         user = get_object_or_404(queryset, pk=pk)
-        serializer = self.get_serializer(user.friends, many=True)
+        serializer = self.get_serializer(
+            User.objects.filter(pk__in=friend_ids(user.pk)).select_related("profile"), many=True
+        )
         return Response(serializer.data)
 
 
 @api_view(["GET"])
 def user_games(request, pk):
-    user = get_object_or_404(User, pk=pk)
-    games = user.profile.games()
+    user = get_object_or_404(User.objects.select_related("profile"), pk=pk)
+    paginator = GameCursorPagination()
+    page = paginator.paginate_games(user.profile.games, request)
     serializer = GameSerializer(
-        games, many=True, context={"request": request, "user": user}
+        page, many=True, context={"request": request, "user": user}
     )
-    return Response(serializer.data)
+    return paginator.get_paginated_response(serializer.data)
+
+
+@api_view(["GET"])
+def user_games_pgn(request, pk):
+    user = get_object_or_404(User.objects.select_related("profile"), pk=pk)
+    response = StreamingHttpResponse(
+        aiter_pgn(user.profile.games()), content_type="application/x-chess-pgn"
+    )
+    response["Content-Disposition"] = f'attachment; filename="{user.username}.pgn"'
+    return response
 
 
 @api_view(["POST"])
@@ -173,7 +237,7 @@ def add_friend(request, pk):
     user = request.user
     friend = get_object_or_404(User, pk=pk)
     try:
-        if friend in user.friends.all():
+        if are_friends(user.pk, friend.pk):
             return Response(
                 {"message": f"You and {friend} are already friends."},
                 status=status.HTTP_405_METHOD_NOT_ALLOWED,
@@ -230,9 +294,8 @@ channel_layer = get_channel_layer()
 @permission_classes([IsAuthenticated])
 def send_challenge(request, user_id):
     opponent = get_object_or_404(User, pk=user_id)
-    # If friend is currently online send message to friend's channel
-    friend_channel = UserChannel.objects.filter(user=opponent)
-    if not friend_channel.exists():
+    # If friend is currently online send message to all of friend's devices
+    if not get_presence_store().is_online(opponent.pk):
         return Response(
             {"message": f"{opponent} is not currently online"},
             status=status.HTTP_404_NOT_FOUND,
@@ -242,10 +305,18 @@ def send_challenge(request, user_id):
             {"message": f"{opponent} is already playing"},
             status=status.HTTP_404_NOT_FOUND,
         )
-    game_request = GameRequest.objects.create(sender=request.user, receiver=opponent)
-    async_to_sync(channel_layer.send)(
-        friend_channel.first().name,
-        {"type": "on.challenge", "request_id": game_request.pk},
+    try:
+        time_control = normalize_time_control(
+            request.data.get("time_control", settings.DEFAULT_TIME_CONTROL)
+        )
+    except ValueError as error:
+        return Response({"message": str(error)}, status=status.HTTP_400_BAD_REQUEST)
+    game_request = GameRequest.objects.create(
+        sender=request.user, receiver=opponent, time_control=time_control
+    )
+    async_to_sync(channel_layer.group_send)(
+        user_group_name(opponent.pk),
+        {"type": "on.challenge", "request_id": game_request.pk, "time_control": time_control},
     )
     return Response(status=status.HTTP_201_CREATED)
 
@@ -256,14 +327,20 @@ def accept_challenge(request, pk):
     game_request = get_object_or_404(GameRequest, pk=pk)
     opponent = game_request.sender
     # If sender of request is no longer online, we return error response
-    opponent_socket_channel = get_object_or_404(UserChannel, user=opponent)
+    if not get_presence_store().is_online(opponent.pk):
+        return Response(
+            {"message": f"{opponent} is not currently online"},
+            status=status.HTTP_404_NOT_FOUND,
+        )
     # Invalidate game request
     game_request.is_active = False
     game_request.is_accepted = True
     game_request.save()
-    game = Game.objects.create(challenger=opponent, opponent=request.user)
-    async_to_sync(channel_layer.send)(
-        opponent_socket_channel.name,
+    game = Game.objects.create(
+        challenger=opponent, opponent=request.user, time_control=game_request.time_control
+    )
+    async_to_sync(channel_layer.group_send)(
+        user_group_name(opponent.pk),
         {"type": "on.challenge.accept", "game_id": game.pk},
     )
     return Response({"game_id": game.pk}, status=status.HTTP_201_CREATED)
@@ -286,28 +363,139 @@ class GameRetrieveView(generics.RetrieveAPIView):
     def get_queryset(self):
         return Game.objects.filter(
             Q(challenger=self.request.user) | Q(opponent=self.request.user)
-        )
+        ).select_related("challenger__profile", "opponent__profile")
+
+
+def game_result(game):
+    winner = None
+    if game.winner is not None:
+        winner = "white" if game.winner == game.challenger_id else "black"
+    result = {"white": "1-0", "black": "0-1", None: "1/2-1/2"}[winner]
+    return {"result": result, "winner": winner}
+
+
+def player_game(request, pk):
+    return get_object_or_404(
+        Game.objects.filter(Q(challenger=request.user) | Q(opponent=request.user)), pk=pk
+    )
 
 
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
 def finish_game(request, pk):
-    winner_color = request.data.get("winner", None)
-    finished_at = request.data.get("finished_at", None)
-    if finished_at is None:
+    """
+    Asks the server to end a game that is over on the board or on time and returns
+    its result. The posted winner is ignored: the result is the server's own.
+    """
+    game = player_game(request, pk)
+    if game.is_active:
+        async_to_sync(settle_game)(game.pk)
+        game.refresh_from_db()
+    if game.is_active:
         return Response(
-            {"message": "finished_at parameter is not provided!"},
-            status=status.HTTP_400_BAD_REQUEST,
+            {"message": "The game is not over"}, status=status.HTTP_409_CONFLICT
         )
+    return Response(game_result(game), status=status.HTTP_200_OK)
 
-    game = get_object_or_404(Game, pk=pk)
 
-    winner = None
-    if winner_color == "white":
-        winner = game.challenger
-    elif winner_color == "black":
-        winner = game.opponent
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def resign_game(request, pk):
+    """
+    Resigns the requesting player, the opponent wins.
+    """
+    game = player_game(request, pk)
+    color = WHITE if game.challenger_id == request.user.pk else BLACK
+    if not async_to_sync(resign_live_game)(game.pk, color):
+        return Response(
+            {"message": "The game is already over"}, status=status.HTTP_409_CONFLICT
+        )
+    game.refresh_from_db()
+    return Response(game_result(game), status=status.HTTP_200_OK)
 
-    game.finish(winner, finished_at)
 
-    return Response(status=status.HTTP_200_OK)
+def leaderboard_entries(first_rank, entries):
+    """
+    Serializes (user id, rating) entries, ranks are 1-based.
+    """
+    usernames = dict(
+        User.objects.filter(pk__in=[user_id for user_id, _ in entries]).values_list(
+            "pk", "username"
+        )
+    )
+    return [
+        {
+            "rank": first_rank + index + 1,
+            "user": {"id": user_id, "username": usernames.get(user_id)},
+            "rating": round(rating),
+        }
+        for index, (user_id, rating) in enumerate(entries)
+    ]
+
+
+@api_view(["GET"])
+def leaderboard(request, category):
+    if category not in CATEGORIES:
+        raise Http404
+    limit = query_int(request, "limit", 50, 100)
+
+    def top():
+        board = get_leaderboard()
+        return {
+            "category": category,
+            "players": board.size(category),
+            "results": leaderboard_entries(0, board.top(category, limit)),
+        }
+
+    return Response(
+        cache.get_or_set(
+            f"leaderboard:{category}:top:{limit}", top, settings.LEADERBOARD_CACHE_TIMEOUT
+        )
+    )
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def leaderboard_rank(request, category):
+    """
+    Rank of the user and the players ranked around them.
+    """
+    if category not in CATEGORIES:
+        raise Http404
+    count = query_int(request, "count", 5, 25)
+    user = request.user
+
+    def around():
+        found = get_leaderboard().around(category, user.pk, count)
+        if found is None:
+            return None
+        start, entries = found
+        results = leaderboard_entries(start, entries)
+        me = next(entry for entry in results if entry["user"]["id"] == user.pk)
+        return {"rank": me["rank"], "rating": me["rating"], "results": results}
+
+    data = cache.get_or_set(
+        f"leaderboard:{category}:around:{user.pk}:{count}",
+        around,
+        settings.LEADERBOARD_CACHE_TIMEOUT,
+    )
+    if data is None:
+        return Response(
+            {"message": f"You have no {category} rating yet"},
+            status=status.HTTP_404_NOT_FOUND,
+        )
+    return Response(data)
+
+
+def prometheus_metrics(request):
+    """
+    Metrics of this process in the Prometheus text format. Scrapers authenticate with
+    METRICS_TOKEN as a bearer token, without one the endpoint only exists with DEBUG on.
+    """
+    token = settings.METRICS_TOKEN
+    if not token:
+        if not settings.DEBUG:
+            raise Http404
+    elif not constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
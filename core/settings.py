@@ -47,6 +47,9 @@ SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(days=2),
 }
 
+# Maximum number of users returned by a single search request
+USER_SEARCH_LIMIT = 20
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -64,6 +67,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "chess.instrumentation.InstrumentationMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -98,7 +102,7 @@ ASGI_APPLICATION = "core.asgi.application"
 
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "chess.layers.RedisChannelLayer",
         "CONFIG": {
             "hosts": [
                 {
@@ -112,6 +116,133 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Short-lived API responses, shared by all processes when Redis is available
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+}
+
+if os.environ.get("REDIS_HOST"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": f"redis://{os.environ.get('REDIS_HOST')}:{os.environ.get('REDIS_PORT')}",
+            "OPTIONS": {
+                "username": os.environ.get("REDIS_USERNAME"),
+                "password": os.environ.get("REDIS_PASSWORD"),
+            },
+        }
+    }
+
+# Seconds a user's cached friend ids are used before they are reloaded, see chess.friends
+FRIENDS_CACHE_TIMEOUT = 300
+
+# Friend suggestions kept per user, see chess.suggestions
+FRIEND_SUGGESTIONS_LIMIT = 20
+
+# Online users and the websocket channel they are reachable at.
+# Connections refresh their entry with heartbeats, stale entries expire after "ttl" seconds.
+PRESENCE_STORE = {
+    "BACKEND": "chess.presence.InMemoryPresenceStore",
+    "OPTIONS": {"ttl": 120},
+}
+
+if os.environ.get("REDIS_HOST"):
+    PRESENCE_STORE = {
+        "BACKEND": "chess.presence.RedisPresenceStore",
+        "OPTIONS": {
+            "ttl": 120,
+            "host": os.environ.get("REDIS_HOST"),
+            "port": os.environ.get("REDIS_PORT"),
+            "username": os.environ.get("REDIS_USERNAME"),
+            "password": os.environ.get("REDIS_PASSWORD"),
+        },
+    }
+
+# Numbered events of live games kept for players who reconnect.
+# The last "size" events of a game are kept until it has been idle for "ttl" seconds.
+GAME_EVENT_STORE = {
+    "BACKEND": "chess.events.InMemoryGameEventStore",
+    "OPTIONS": {"size": 200, "ttl": 3600},
+}
+
+if os.environ.get("REDIS_HOST"):
+    GAME_EVENT_STORE = {
+        "BACKEND": "chess.events.RedisGameEventStore",
+        "OPTIONS": {
+            "size": 200,
+            "ttl": 3600,
+            "host": os.environ.get("REDIS_HOST"),
+            "port": os.environ.get("REDIS_PORT"),
+            "username": os.environ.get("REDIS_USERNAME"),
+            "password": os.environ.get("REDIS_PASSWORD"),
+        },
+    }
+
+# Token buckets of the commands a websocket client may send: command -> (tokens per second,
+# burst). "*" applies to frames of any other command, including malformed ones.
+WEBSOCKET_RATE_LIMITS = {
+    "move": (5, 10),
+    "promote": (5, 10),
+    "resign": (1, 3),
+    "queue": (1, 5),
+    "leave_queue": (1, 5),
+    "ack": (10, 20),
+    "*": (10, 20),
+}
+
+# Frames a websocket client may be sent before it acknowledges them, see chess.throttling.
+# Beyond it spectator updates are held back, only the latest is kept, and other sockets
+# are closed, their clients reconnect to catch up.
+WEBSOCKET_SEND_WINDOW = 64
+
+# Bearer token Prometheus scrapes /metrics with, without it /metrics is served only with DEBUG on
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+# Time control of challenges that do not specify one, "<minutes>+<increment seconds>"
+DEFAULT_TIME_CONTROL = "10+0"
+
+# Seconds moves are held back from spectators, e.g. to keep them from relaying moves to a player
+SPECTATOR_DELAY = 0
+
+# Spectator messages released within this many seconds of each other are sent as one frame
+SPECTATOR_BATCH_INTERVAL = 0
+
+# Players ranked by rating in every rating category, see chess.leaderboard
+LEADERBOARD_STORE = {
+    "BACKEND": "chess.leaderboard.InMemoryLeaderboard",
+}
+
+if os.environ.get("REDIS_HOST"):
+    LEADERBOARD_STORE = {
+        "BACKEND": "chess.leaderboard.RedisLeaderboard",
+        "OPTIONS": {
+            "host": os.environ.get("REDIS_HOST"),
+            "port": os.environ.get("REDIS_PORT"),
+            "username": os.environ.get("REDIS_USERNAME"),
+            "password": os.environ.get("REDIS_PASSWORD"),
+        },
+    }
+
+# Seconds leaderboard responses are cached for
+LEADERBOARD_CACHE_TIMEOUT = 5
+
+# Seconds between pairing passes of the matchmaking queues
+MATCHMAKING_INTERVAL = 1
+
+# Players are paired when their ratings differ by at most the window of the longest
+# waiting one, which starts at MATCHMAKING_INITIAL_WINDOW rating points and grows by
+# MATCHMAKING_WINDOW_GROWTH points per second waited, up to MATCHMAKING_MAX_WINDOW
+MATCHMAKING_INITIAL_WINDOW = 50
+MATCHMAKING_WINDOW_GROWTH = 10
+MATCHMAKING_MAX_WINDOW = 500
+
+# Seconds between bulk writes of buffered moves of live games
+MOVE_LOG_FLUSH_INTERVAL = 2
+
+# How moves are stored: "rows" writes a GameMove row per ply,
+# "packed" keeps the whole move list in Game.packed_moves
+MOVE_STORAGE = "rows"
+
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
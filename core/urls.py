@@ -17,7 +17,7 @@ Including another URLconf
 
 from django.contrib import admin
 from django.urls import path, include
-from chess.views import user_signin, CreateUserView, user_signout
+from chess.views import user_signin, CreateUserView, user_signout, prometheus_metrics
 
 urlpatterns = [
     path("admin/", admin.site.urls),
@@ -26,4 +26,5 @@ urlpatterns = [
     path("api/auth/signup/", CreateUserView.as_view(), name="signup"),
     path("api/auth/signout/", user_signout, name="signout"),
     path("api/", include("chess.urls")),
+    path("metrics", prometheus_metrics, name="metrics"),
 ]